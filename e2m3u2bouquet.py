@@ -18,25 +18,71 @@ import unicodedata
 import datetime
 import urllib
 import urlparse
-import imghdr
-import tempfile
 import glob
-import ssl
-import hashlib
+import shutil
 import socket
-from PIL import Image
+import threading
+import gc
+import importlib
+import math
+import json
+import io
+import codecs
+import copy
+import struct
+import zlib
+import bisect
 from collections import OrderedDict
 try:
-    import xml.etree.cElementTree as ET
+    import cPickle as pickle
 except ImportError:
-    import xml.etree.ElementTree as ET
+    import pickle
 try:
     from enigma import eDVBDB
 except ImportError:
     eDVBDB = None
-from argparse import ArgumentParser
-from argparse import RawDescriptionHelpFormatter
-from xml.sax.saxutils import escape
+try:
+    from enigma import eEPGCache
+except ImportError:
+    eEPGCache = None
+
+
+class LazyModule:
+    """Stand in for a module that is only imported on first use
+    keeps start up fast when imported from the plugin (PIL alone is slow to load on MIPS/ARM boxes)
+    """
+    def __init__(self, *names):
+        # names are tried in order, the first that imports is used
+        self._names = names
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            for name in self._names:
+                try:
+                    self._module = importlib.import_module(name)
+                    break
+                except ImportError:
+                    if name == self._names[-1]:
+                        raise
+        return getattr(self._module, attr)
+
+
+imghdr = LazyModule('imghdr')
+hashlib = LazyModule('hashlib')
+tempfile = LazyModule('tempfile')
+ssl = LazyModule('ssl')
+Image = LazyModule('PIL.Image')
+ET = LazyModule('xml.etree.cElementTree', 'xml.etree.ElementTree')
+saxutils = LazyModule('xml.sax.saxutils')
+sqlite3 = LazyModule('sqlite3')
+gzip = LazyModule('gzip')
+tarfile = LazyModule('tarfile')
+mmap = LazyModule('mmap')
+multiprocessing = LazyModule('multiprocessing')
+calendar = LazyModule('calendar')
+httplib = LazyModule('httplib')
+Queue = LazyModule('Queue')
 
 __all__ = []
 __version__ = '0.8.5'
@@ -50,10 +96,54 @@ ENIGMAPATH = '/etc/enigma2/'
 EPGIMPORTPATH = '/etc/epgimport/'
 CFGPATH = os.path.join(ENIGMAPATH, 'e2m3u2bouquet/')
 PICONSPATH = '/usr/share/enigma2/picon/'
+# set when building into an output root rather than the boxes own folders (see set_output_root)
+OUTPUT_ROOT = ''
 IMPORTED = False
 PLACEHOLDER_SERVICE = '#SERVICE 1:832:d:0:0:0:0:0:0:0:'
 
 
+STARTUP_BENCH_CODE = """
+import sys, time
+start = time.time()
+sys.path.insert(0, {path!r})
+import {module} as e2m3u2b
+imported = time.time()
+downloaded = imported
+if {url!r}:
+    config = e2m3u2b.ProviderConfig()
+    config.name = 'startupbench'
+    config.m3u_url = {url!r}
+    provider = e2m3u2b.Provider(config)
+    provider.download_m3u()
+    downloaded = time.time()
+    if provider._m3u_file:
+        e2m3u2b.os.remove(provider._m3u_file)
+sys.stdout.write('\\n%f %f\\n' % (imported - start, downloaded - start))
+"""
+
+
+def benchmark_startup(url=None, runs=5):
+    """Time importing this module (and the first m3u download) in fresh interpreters
+    """
+    import subprocess
+    module_path, module_file = os.path.split(os.path.abspath(__file__))
+    code = STARTUP_BENCH_CODE.format(path=module_path, module=os.path.splitext(module_file)[0], url=url or '')
+    results = []
+    for i in xrange(runs):
+        start = time.time()
+        output = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE).communicate()[0]
+        total = time.time() - start
+        import_time, download_time = [float(v) for v in output.strip().splitlines()[-1].split()]
+        results.append((total, import_time, download_time))
+
+    print('----Startup benchmark ({} cold runs)----'.format(runs))
+    for label, index in (('interpreter + import + download', 0), ('module import', 1), ('time to first download', 2)):
+        values = sorted(r[index] * 1000 for r in results)
+        if index == 2 and not url:
+            continue
+        print('{:<32} min {:8.1f} ms  median {:8.1f} ms'.format(label, values[0], values[len(values) // 2]))
+
+
 class CLIError(Exception):
     """Generic exception to raise and log different fatal errors."""
     def __init__(self, msg):
@@ -73,6 +163,83 @@ class AppUrlOpener(urllib.FancyURLopener):
     version = 'Mozilla/5.0 (Windows NT 6.1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/60.0.3112.113 Safari/537.36'
 
 
+DOWNLOAD_RETRIES = 2
+DOWNLOAD_RETRY_DELAY = 2
+DOWNLOAD_DEADLINE = 600
+PICON_DOWNLOAD_DEADLINE = 30
+DOWNLOAD_CHUNK_SIZE = 8 * 1024
+
+
+class DownloadError(IOError):
+    """Download failed (bad HTTP status, truncated body, deadline exceeded...)
+    retry is False for failures that won't go away by asking again e.g. 404
+    """
+    def __init__(self, msg, retry=True):
+        IOError.__init__(self, msg)
+        self.retry = retry
+
+
+def _download_file_once(url, filename, deadline, context=None, content_check=None):
+    start = time.time()
+    if context is not None:
+        response = urllib.urlopen(url, context=context)
+    else:
+        response = urllib.urlopen(url)
+    try:
+        # FancyURLopener hands back error pages rather than raising so check the status ourselves
+        code = response.getcode()
+        if code is not None and code >= 400:
+            raise DownloadError('HTTP error {}'.format(code), retry=code >= 500 or code in (408, 429))
+        info = response.info()
+        if content_check is not None and not content_check(info):
+            return None
+        expected = info.getheader('Content-Length')
+        received = 0
+        part_filename = filename + '.part'
+        with open(part_filename, 'wb') as f:
+            while True:
+                # checked between reads, a stalled read is still bounded by the socket timeout
+                if time.time() - start > deadline:
+                    raise DownloadError('deadline of {}s exceeded after {} bytes'.format(deadline, received),
+                                        retry=False)
+                chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+                received += len(chunk)
+        if expected and expected.isdigit() and received < int(expected):
+            raise DownloadError('truncated, received {} of {} bytes'.format(received, expected))
+        os.rename(part_filename, filename)
+        return info
+    finally:
+        response.close()
+
+
+def download_file(url, filename, retries=DOWNLOAD_RETRIES, deadline=DOWNLOAD_DEADLINE, context=None,
+                  content_check=None):
+    """Download url to filename, retrying transient failures
+    deadline (seconds) covers all the attempts. The file is only replaced once the whole body has been received.
+    content_check(info) can reject the response from its headers, None is then returned without
+    writing anything, otherwise the response headers are returned
+    Raises DownloadError (or the underlying IOError) once the retries are used up
+    """
+    end = time.time() + deadline
+    attempt = 0
+    while True:
+        try:
+            return _download_file_once(url, filename, end - time.time(), context, content_check)
+        except (IOError, socket.error), e:
+            if os.path.isfile(filename + '.part'):
+                os.remove(filename + '.part')
+            delay = DOWNLOAD_RETRY_DELAY * 2 ** attempt
+            if attempt >= retries or not getattr(e, 'retry', True) or time.time() + delay >= end:
+                raise
+            if DEBUG:
+                print('Download error, retrying', url, e)
+            time.sleep(delay)
+            attempt += 1
+
+
 def display_welcome():
     print('\n********************************')
     print('Starting Enigma2 IPTV bouquets v{}'.format(__version__))
@@ -134,6 +301,198 @@ def uninstaller():
     print('----Uninstall complete----')
 
 
+def set_output_root(root):
+    """Write everything under root (laid out like the box's file system) instead of the box's own folders
+    """
+    global ENIGMAPATH, EPGIMPORTPATH, CFGPATH, PICONSPATH, OUTPUT_ROOT
+    OUTPUT_ROOT = os.path.abspath(root)
+    ENIGMAPATH = os.path.join(OUTPUT_ROOT, 'etc/enigma2/')
+    EPGIMPORTPATH = os.path.join(OUTPUT_ROOT, 'etc/epgimport/')
+    CFGPATH = os.path.join(ENIGMAPATH, 'e2m3u2bouquet/')
+    PICONSPATH = os.path.join(OUTPUT_ROOT, 'usr/share/enigma2/picon/')
+    for path in (ENIGMAPATH, EPGIMPORTPATH, CFGPATH, PICONSPATH):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+
+def get_box_path(path):
+    """Return the path a file written under the output root will have on the box
+    """
+    if OUTPUT_ROOT and path.startswith(OUTPUT_ROOT + os.sep):
+        return path[len(OUTPUT_ROOT):]
+    return path
+
+
+def get_output_path(path):
+    """Return where a file the box expects at path is written (under the output root if set)
+    """
+    if OUTPUT_ROOT:
+        return os.path.join(OUTPUT_ROOT, path.lstrip('/'))
+    return path
+
+
+def prepare_box_root(box_dir):
+    """Set up the config folder and bouquets.tv of a box root from the box's folder (box_dir)
+    before it is built, returns True if the box's own bouquets.tv was supplied
+    """
+    box_files = os.listdir(box_dir)
+    # override files deleted from the box's folder mustn't be applied again
+    for fname in os.listdir(CFGPATH):
+        if fname.endswith('-sort-override.xml') and fname not in box_files:
+            os.remove(os.path.join(CFGPATH, fname))
+    for fname in box_files:
+        if fname.endswith('.xml'):
+            shutil.copy(os.path.join(box_dir, fname), CFGPATH)
+    # the IPTV entries are merged into the box's own bouquets.tv
+    bouquets_tv = os.path.join(ENIGMAPATH, 'bouquets.tv')
+    if 'bouquets.tv' in box_files:
+        shutil.copy(os.path.join(box_dir, 'bouquets.tv'), bouquets_tv)
+        return True
+    if os.path.isfile(bouquets_tv):
+        os.remove(bouquets_tv)
+    return False
+
+
+def get_box_files(icon_paths, with_bouquets_tv, epgdat_file=None):
+    """Return the generated files under the output root that go to a box, the bouquets, the
+    EPG-Importer files, the picons and epg.dat. The config folder and caches stay on the build server
+    """
+    files = []
+    for fname in sorted(os.listdir(ENIGMAPATH)):
+        if fname.startswith('userbouquet.suls_iptv_') or (fname == 'bouquets.tv' and with_bouquets_tv):
+            files.append(os.path.join(ENIGMAPATH, fname))
+    for fname in sorted(os.listdir(EPGIMPORTPATH)):
+        # not the hash kept to skip unchanged channels file writes
+        if fname.startswith('suls_iptv_') and not fname.endswith('.md5'):
+            files.append(os.path.join(EPGIMPORTPATH, fname))
+    for icon_path in sorted(set(icon_paths)):
+        if os.path.isdir(icon_path):
+            for fname in sorted(os.listdir(icon_path)):
+                # not the markers of failed or unfinished downloads
+                if os.path.splitext(fname)[1] not in ('', '.part', '.None'):
+                    files.append(os.path.join(icon_path, fname))
+    if epgdat_file and os.path.isfile(epgdat_file):
+        files.append(epgdat_file)
+    return [f for f in files if os.path.isfile(f)]
+
+
+def build_boxes(provider_configs, boxes_dir, output_root, run_context):
+    """Build server mode, download and parse each provider once then render the output for every box
+    boxes_dir holds a folder per box with that box's override files and optionally its bouquets.tv.
+    Each box is built under output_root/boxes/<box> and its bouquets, EPG-Importer files and picons
+    packed into output_root/<box>.tar.gz to be extracted on the box at /
+    """
+    boxes = sorted(d for d in os.listdir(boxes_dir) if os.path.isdir(os.path.join(boxes_dir, d)))
+    # the picons have to be in place before each box is archived
+    run_context.background_picons = False
+    set_output_root(output_root)
+    fetched = []
+    for config in provider_configs:
+        print('\n********************************')
+        print('Build server - downloading {}'.format(config.name.encode('utf-8') if config.name else ''))
+        print('********************************\n')
+        icon_path = config.icon_path or 'usr/share/enigma2/picon/'
+        provider = Provider(config, run_context)
+        fetched.append((provider, icon_path, provider.fetch_services()))
+
+    for box in boxes:
+        print('\n********************************')
+        print('Build server - box {}'.format(box))
+        print('********************************\n')
+        box_root = os.path.join(output_root, 'boxes', box)
+        set_output_root(box_root)
+        with_bouquets_tv = prepare_box_root(os.path.join(boxes_dir, box))
+        icon_paths = []
+        for provider, icon_path, services in fetched:
+            if services:
+                box_config = copy.copy(provider.config)
+                box_config.icon_path = os.path.join(OUTPUT_ROOT, icon_path.lstrip('/'))
+                icon_paths.append(box_config.icon_path)
+                Provider(box_config, run_context).render_services(services, provider.get_panel_bouquet())
+        epgdat_file = None
+        if run_context.epgdat_file:
+            epgdat_file = get_output_path(run_context.epgdat_file)
+            write_epgdat(run_context, epgdat_file)
+        run_context.output.commit()
+        run_context.collect_picons()
+
+        artefact = os.path.join(output_root, '{}.tar.gz'.format(box))
+        with tarfile.open(artefact + '.tmp', 'w:gz') as tar:
+            for filepath in get_box_files(icon_paths, with_bouquets_tv, epgdat_file):
+                tar.add(filepath, arcname=filepath[len(OUTPUT_ROOT) + 1:])
+        os.rename(artefact + '.tmp', artefact)
+        print('Box output written to {}'.format(artefact))
+        if not with_bouquets_tv:
+            print('No bouquets.tv in {} so the archive leaves the box\'s bouquets.tv as it is, '
+                  'add the box\'s bouquets.tv to that folder to have the IPTV bouquets listed in it'.format(
+                      os.path.join(boxes_dir, box)))
+    set_output_root(output_root)
+
+
+WATCH_INTERVAL = 1
+
+
+def get_file_state(filename):
+    """Return what identifies a version of a file (None if it doesn't exist)
+    """
+    try:
+        stat = os.stat(filename)
+    except (OSError, TypeError):
+        return None
+    return filename, stat.st_mtime, stat.st_size
+
+
+def watch_overrides(provider_configs, run_context):
+    """Watch mode, re-create the bouquets and EPG config whenever a providers override file changes
+    each playlist is only downloaded and parsed once, the parsed services are kept for the re-runs.
+    Returns once stopped with Ctrl+C
+    """
+    watched = []
+    for config in provider_configs:
+        provider = Provider(config, run_context)
+        services = provider.fetch_services()
+        provider.render_services(services, provider.get_panel_bouquet())
+        watched.append([config, services, provider.get_panel_bouquet(), get_file_state(provider.get_mapping_file())])
+    run_context.output.commit()
+    if run_context.epgdat_file:
+        write_epgdat(run_context, get_output_path(run_context.epgdat_file))
+    reload_bouquets()
+
+    print('\nWatching override files for changes (Ctrl+C to stop)...')
+    try:
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            changed = []
+            for item in watched:
+                config, services, panel_bouquet, file_state = item
+                # checked each time as a new override file may have been created
+                new_file_state = get_file_state(Provider(config, run_context).get_mapping_file())
+                if services and new_file_state != file_state:
+                    item[3] = new_file_state
+                    changed.append(item)
+            if changed and run_context.epgdat_file:
+                # epg.dat holds the EPG of every provider so they all need their mappings again
+                changed = [item for item in watched if item[1]]
+            for config, services, panel_bouquet, file_state in changed:
+                start = time.time()
+                # picons don't depend on the override file
+                render_config = copy.copy(config)
+                render_config.picons = False
+                Provider(render_config, run_context).render_services(services, panel_bouquet)
+                print('{}: override file change applied in {:.2f}s'.format(config.name.encode('utf-8'),
+                                                                         time.time() - start))
+            if changed:
+                run_context.output.commit()
+                if run_context.epgdat_file:
+                    write_epgdat(run_context, get_output_path(run_context.epgdat_file))
+                reload_bouquets()
+    except KeyboardInterrupt:
+        # a change being applied is dropped, the files of the last applied change stay in place
+        run_context.output.rollback()
+        run_context.epg_sources = OrderedDict()
+        print('\nStopped watching override files')
+
+
 def get_category_title(cat, category_options):
     """Return the title override if set else the title
     """
@@ -149,7 +508,7 @@ def get_service_title(channel):
 
 
 def reload_bouquets():
-    if not TESTRUN:
+    if not TESTRUN and not OUTPUT_ROOT:
         print("\n----Reloading bouquets----")
         if eDVBDB:
             eDVBDB.getInstance().reloadBouquets()
@@ -158,8 +517,21 @@ def reload_bouquets():
             os.system("wget -qO - http://127.0.0.1/web/servicelistreload?mode=2 > /dev/null 2>&1 &")
             print("bouquets reloaded...")
 
+
+def reload_epg():
+    """Have Enigma2 load the epg.dat just written, otherwise it is overwritten by Enigma2's own EPG cache
+    the next time that is saved
+    """
+    if not TESTRUN and not OUTPUT_ROOT:
+        print("\n----Loading epg.dat----")
+        if eEPGCache:
+            eEPGCache.getInstance().load()
+        else:
+            os.system("wget -qO - http://127.0.0.1/web/loadepg > /dev/null 2>&1 &")
+        print("epg.dat loaded...")
+
 def xml_escape(string):
-    return escape(string, {'"': '&quot;', "'": "&apos;"})
+    return saxutils.escape(string, {'"': '&quot;', "'": "&apos;"})
 
 
 def xml_safe_comment(string):
@@ -180,7 +552,18 @@ def get_safe_filename(filename, fallback=''):
     return name
 
 
+def get_config_int(text, default=0):
+    """Integer value of a config setting, default if it isn't set or isn't a number
+    """
+    try:
+        return int(text.strip())
+    except (AttributeError, ValueError):
+        return default
+
+
 def get_parser_args(program_license, program_version_message):
+    from argparse import ArgumentParser
+    from argparse import RawDescriptionHelpFormatter
     parser = ArgumentParser(description=program_license, formatter_class=RawDescriptionHelpFormatter)
     # URL Based Setup
     urlgroup = parser.add_argument_group('URL Based Setup')
@@ -203,8 +586,16 @@ def get_parser_args(program_license, program_version_message):
                         help='Stream type for TV (e.g. 1, 4097, 5001 or 5002) overrides iptvtypes')
     parser.add_argument('-stvod', '--streamtype_vod', dest='stvod', action='store', type=int,
                         help='Stream type for VOD (e.g. 4097, 5001 or 5002) overrides iptvtypes')
+    parser.add_argument('-ps', '--probestreams', dest='probestreams', action='store_true',
+                        help='Check the live streams and disable channels whose stream keeps failing')
+    parser.add_argument('-eg', '--epggzip', dest='epggzip', action='store_true',
+                        help='Write the EPG-Importer channels file gzipped')
+    parser.add_argument('-xa', '--xtreamapi', dest='xtreamapi', action='store_true',
+                        help='Load channels from the Xtream Codes panel api (player_api.php) rather than the m3u')
     parser.add_argument('-M', '--multivod', dest='multivod', action='store_true',
                         help='Create multiple VOD bouquets rather single VOD bouquet')
+    parser.add_argument('-vs', '--vodshardsize', dest='vodshardsize', action='store', type=int,
+                        help='Split the single VOD bouquet into bouquets of at most this many services')
     parser.add_argument('-a', '--allbouquet', dest='allbouquet', action='store_true',
                         help='Create all channels bouquet')
     parser.add_argument('-P', '--picons', dest='picons', action='store_true',
@@ -219,6 +610,41 @@ def get_parser_args(program_license, program_version_message):
                         help='Download providers bouquet (use default url) - to map custom service references')
     parser.add_argument('-bt', '--bouquettop', dest='bouquettop', action='store_true',
                         help='Place IPTV bouquets at top')
+    parser.add_argument('--watch', dest='watch', action='store_true',
+                        help='Keep running and re-create the bouquets whenever an override file is changed '
+                             '(without downloading the playlists again)')
+    parser.add_argument('--outputroot', dest='outputroot', action='store',
+                        help='Write all output under this folder (laid out like the box) rather than to the box')
+    parser.add_argument('--boxes', dest='boxes', action='store',
+                        help='Build server mode, folder with a sub folder of override files (and the '
+                             'box\'s bouquets.tv) for each box. Downloads once and writes an archive per box '
+                             'to the output root')
+    parser.add_argument('--epgdat', dest='epgdat', action='store',
+                        help='Also write the EPG for the mapped channels straight to this epg.dat file '
+                             '(e.g. /media/hdd/epg.dat) rather than leaving it to EPG-Importer')
+    parser.add_argument('--piconbudget', dest='piconbudget', action='store', type=float,
+                        help='Size budget in MB for the picons created by this script, the least recently '
+                             'used are removed to keep to it')
+    parser.add_argument('--parseworkers', dest='parseworkers', action='store', type=int, default=1,
+                        help='Parse large m3u files in this many worker processes (default 1)')
+    parser.add_argument('--probeconnections', dest='probeconnections', action='store', type=int,
+                        default=PROBE_HOST_CONNECTIONS,
+                        help='Connections to each panel when checking streams (default {}), panels usually '
+                             'only allow an account 1 or 2'.format(PROBE_HOST_CONNECTIONS))
+    parser.add_argument('--runbudget', dest='runbudget', action='store', type=float,
+                        help='Time budget in seconds for the whole run, stages are cut short to keep to it')
+    parser.add_argument('--budgets', dest='budgets', action='store',
+                        help='Time budgets in seconds for stages of each provider '
+                             'e.g. download=120,parse=60,probe=300,picons=600')
+    parser.add_argument('--stages', dest='stages', action='store',
+                        help='Only run these stages e.g. picons,epg using the channels parsed by the last run, '
+                             'stages are: ' + ', '.join(RUN_STAGE_NAMES))
+    parser.add_argument('--profile', dest='profile', action='store_true',
+                        help='Report time, peak memory and allocation growth for each stage of each provider')
+    parser.add_argument('--profilestats', dest='profilestats', action='store',
+                        help='Also write cProfile stats for the parse and override stages to this folder')
+    parser.add_argument('--startupbench', dest='startupbench', action='store_true',
+                        help='Measure cold start import time (and time to first download of the m3u url if given) then exit')
     parser.add_argument('-U', '--uninstall', dest='uninstall', action='store_true',
                         help='Uninstall all changes made by this script')
     parser.add_argument('-V', '--version', action='version', version=program_version_message)
@@ -246,6 +672,10 @@ class ProviderConfig:
         self.streamtype_tv = ''
         self.streamtype_vod = ''
         self.multi_vod = False
+        self.vod_shard_size = 0
+        self.xtream_api = False
+        self.epg_gzip = False
+        self.probe_streams = False
         self.all_bouquet = False
         self.picons = False
         self.icon_path = ''
@@ -254,17 +684,1772 @@ class ProviderConfig:
         self.bouquet_download = False
         self.bouquet_top = False
         self.last_provider_update = 0
+        # include / exclude rules [(action, field, pattern)]
+        self.rules = []
+
+
+# key="value" pairs on an #EXTINF line, a value only ends at a quote followed by the next attribute
+# (with or without a space between them), the comma before the display name or the end of the line
+# so quotes and commas inside values are kept
+EXTINF_ATTR_RE = re.compile(r'([A-Za-z0-9_-]+)\s*=\s*"([^"]*(?:"(?!\s*[A-Za-z0-9_-]+\s*=\s*"|\s*,|\s*$)[^"]*)*)"')
+STREAM_URL_PREFIXES = (u'http:', u'https:', u'rtmp:', u'rtsp:')
+
+
+# bytes checked for the codec of an m3u file without a byte order mark
+M3U_ENCODING_SAMPLE = 1024 * 1024
+
+
+def detect_m3u_encoding(filename):
+    """Pick the codec for a whole m3u file from its byte order mark, without one a sample
+    that isn't valid utf-8 is taken as a cp1252 (latin-1) playlist
+    """
+    with open(filename, 'rb') as f:
+        sample = f.read(M3U_ENCODING_SAMPLE)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith(codecs.BOM_UTF16_LE) or sample.startswith(codecs.BOM_UTF16_BE):
+        return 'utf-16'
+    try:
+        # not final so a character cut off at the end of the sample doesn't count
+        codecs.getincrementaldecoder('utf-8')('strict').decode(sample, False)
+    except UnicodeDecodeError:
+        return 'cp1252'
+    return 'utf-8'
+
+
+def parse_extinf(line):
+    """Split a (unicode) #EXTINF line into a dict of its attributes and the display name
+    """
+    # skip '#EXTINF:<duration>'
+    pos = line.find(u' ')
+    if pos == -1:
+        return {}, None
+    attributes = {}
+    end = -1
+    for match in EXTINF_ATTR_RE.finditer(line, pos):
+        attributes[match.group(1).lower()] = match.group(2)
+        end = match.end()
+    # the display name follows the comma after the last attribute, it can have '",' in it
+    name = None
+    if end != -1:
+        name_pos = line.find(u',', end)
+        if name_pos != -1 and not line[end:name_pos].strip():
+            name = line[name_pos + 1:].strip()
+    else:
+        name_pos = line.rfind(u'",')
+        if name_pos != -1:
+            name = line[name_pos + 2:].strip()
+    return attributes, name
+
+
+def new_service_dict(attributes, name=None):
+    """Create the channel record for a stream from its m3u attributes and display name
+    """
+    service_dict = {'tvg-id': u'', 'tvg-name': u'', 'tvg-logo': u'', 'group-title': u'',
+                    'stream-name': u'', 'category_type': 'live', 'has_archive': False,
+                    'stream-url': '', 'enabled': True, 'nameOverride': '', 'categoryOverride': '',
+                    'serviceRef': '', 'serviceRefOverride': False
+                    }
+    service_dict.update(attributes)
+    if name is not None:
+        service_dict['stream-name'] = name
+    # Set default name for any blank groups
+    if service_dict['group-title'] == u'':
+        service_dict['group-title'] = u'None'
+    return service_dict
+
+
+# service strings shared by the copies of a stream listed in several categories
+SHARED_SERVICE_FIELDS = ('stream-url', 'tvg-id', 'tvg-name', 'tvg-logo', 'stream-name')
+
+RULE_FIELDS = {'group': 'group-title', 'name': 'stream-name', 'tvg-id': 'tvg-id', 'type': 'category_type'}
+
+
+class ChannelRules:
+    """Include / exclude rules from a providers config compiled once and evaluated while parsing
+    Rules are (action, field, pattern) with action include or exclude and field one of RULE_FIELDS.
+    A channel is dropped if any exclude pattern matches or, when a field has include patterns, none of them match
+    """
+    def __init__(self, rules):
+        self.includes = {}
+        self.excludes = {}
+        for action, field, pattern in rules:
+            if action not in ('include', 'exclude') or field not in RULE_FIELDS:
+                print('Ignoring unknown rule: {} {}'.format(action, field))
+                continue
+            try:
+                regex = re.compile(pattern, re.UNICODE)
+            except re.error, e:
+                print('Ignoring invalid rule pattern {}: {}'.format(pattern, e))
+                continue
+            rule_dict = self.includes if action == 'include' else self.excludes
+            rule_dict.setdefault(RULE_FIELDS[field], []).append(regex)
+        self._info_fields = [field for field in ('group-title', 'stream-name', 'tvg-id')
+                             if field in self.includes or field in self.excludes]
+        self._check_type = 'category_type' in self.includes or 'category_type' in self.excludes
+
+    def __nonzero__(self):
+        return bool(self.includes or self.excludes)
+
+    def _allowed(self, field, value):
+        for regex in self.excludes.get(field, ()):
+            if regex.search(value):
+                return False
+        includes = self.includes.get(field)
+        if includes:
+            return any(regex.search(value) for regex in includes)
+        return True
+
+    def allows_info(self, attributes, name):
+        """Check the #EXTINF details (group, name and tvg-id) before a channel record is created
+        """
+        for field in self._info_fields:
+            if field == 'stream-name':
+                value = name if name is not None else attributes.get(field, u'')
+            elif field == 'group-title':
+                value = attributes.get(field) or u'None'
+            else:
+                value = attributes.get(field, u'')
+            if not self._allowed(field, value):
+                return False
+        return True
+
+    def allows_type(self, service_dict):
+        """Check the stream type (live / vod) once it is known from the stream url
+        """
+        return self.allows_category_type(service_dict['category_type'])
+
+    def allows_category_type(self, category_type):
+        return not self._check_type or self._allowed('category_type', category_type)
+
+
+class M3uTokenizer:
+    """Single pass m3u_plus tokenizer
+    """
+    def __init__(self, rules=None):
+        self.valid_services_found = False
+        self._rules = rules
+
+    def services(self, lines):
+        """Yield a service dict for each #EXTINF entry that is followed by a stream url
+        """
+        rules = self._rules
+        pending = None
+        for line in lines:
+            if line.startswith(u'#EXTINF'):
+                pending = None
+                if line.find(u'tvg-') == -1 and line.find(u'group-') == -1:
+                    if DEBUG:
+                        msg = "No extended playlist info found for this service'"
+                        print(msg)
+                    continue
+                self.valid_services_found = True
+
+                attributes, name = parse_extinf(line)
+                if rules and not rules.allows_info(attributes, name):
+                    # excluded - don't create a record for it
+                    continue
+                pending = (attributes, name)
+            elif line.startswith(u'#'):
+                # header or comments we are not interested in
+                continue
+            elif pending is not None:
+                stream_url = line.strip()
+                if stream_url.startswith(STREAM_URL_PREFIXES):
+                    service_dict = new_service_dict(*pending)
+                    service_dict['stream-url'] = stream_url.encode('utf-8')
+                    yield service_dict
+                    pending = None
+
+
+# files smaller than this are always parsed in one process
+PARALLEL_PARSE_MIN_SIZE = 16 * 1024 * 1024
+PARALLEL_PARSE_CHUNKS_PER_WORKER = 4
+
+
+def find_m3u_chunks(filename, chunks):
+    """Split an m3u file into about chunks byte ranges that each start at an #EXTINF line
+    """
+    with open(filename, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            size = mapped.size()
+            offsets = [0]
+            for n in xrange(1, chunks):
+                pos = mapped.find('\n#EXTINF', max(size * n // chunks, offsets[-1]))
+                if pos == -1:
+                    break
+                if pos + 1 > offsets[-1]:
+                    offsets.append(pos + 1)
+            offsets.append(size)
+        finally:
+            mapped.close()
+    return zip(offsets[:-1], offsets[1:])
+
+
+def _tokenize_m3u_chunk(args):
+    """Worker process side of ParallelM3uTokenizer
+    """
+    filename, start, end, encoding, rules = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        text = f.read(end - start).decode(encoding, 'ignore')
+    tokenizer = M3uTokenizer(ChannelRules(rules))
+    # newline=None splits the lines the same way io.open does for the single process parse
+    services = list(tokenizer.services(io.StringIO(text, newline=None)))
+    return tokenizer.valid_services_found, services
+
+
+class ParallelM3uTokenizer:
+    """Tokenize a large m3u file in worker processes
+    the file is split at #EXTINF lines and the chunks yielded back in file order so the
+    categories end up in the same order as a single process parse
+    """
+    def __init__(self, rules, workers):
+        self.valid_services_found = False
+        # the rules as configured, the workers compile their own
+        self._rules = rules
+        self._workers = workers
+
+    def services(self, filename, encoding):
+        chunks = find_m3u_chunks(filename, self._workers * PARALLEL_PARSE_CHUNKS_PER_WORKER)
+        # only the first chunk can have a byte order mark, the others are in the same codec without one
+        chunk_encoding = 'utf-8' if encoding == 'utf-8-sig' else encoding
+        args = [(filename, start, end, encoding if start == 0 else chunk_encoding, self._rules)
+                for start, end in chunks]
+        pool = multiprocessing.Pool(self._workers)
+        try:
+            for valid_services_found, services in pool.imap(_tokenize_m3u_chunk, args):
+                self.valid_services_found = self.valid_services_found or valid_services_found
+                for service_dict in services:
+                    yield service_dict
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+class XtreamApi:
+    """Minimal Xtream Codes player_api.php client
+    """
+    def __init__(self, server, username, password, output='ts'):
+        # server is the panel root url e.g. http://host:port/
+        self.server = server
+        self.username = username
+        self.password = password
+        self.output = output
+
+    @staticmethod
+    def from_m3u_url(m3u_url, username, password):
+        """Return an XtreamApi for a panel get.php m3u url (None if it isn't one)
+        """
+        pos = m3u_url.find('get.php')
+        if pos == -1:
+            return None
+        query = urlparse.parse_qs(urlparse.urlparse(m3u_url).query)
+        username = query.get('username', [username])[0]
+        password = query.get('password', [password])[0]
+        if not username or not password:
+            return None
+        return XtreamApi(m3u_url[:pos], username, password, query.get('output', ['ts'])[0])
+
+    def get(self, action=None):
+        url = '{}player_api.php?username={}&password={}'.format(
+            self.server, urllib.quote_plus(self.username), urllib.quote_plus(self.password))
+        if action:
+            url += '&action={}'.format(action)
+        response = urllib.urlopen(url)
+        try:
+            if response.getcode() not in (None, 200):
+                raise IOError('player_api.php {} returned HTTP {}'.format(action, response.getcode()))
+            return json.load(response)
+        finally:
+            response.close()
+
+    def get_stream_url(self, stream, category_type):
+        if category_type == 'vod':
+            return '{}movie/{}/{}/{}.{}'.format(self.server, self.username, self.password, stream['stream_id'],
+                                               stream.get('container_extension') or 'mp4')
+        if self.output in ('m3u8', 'hls'):
+            return '{}live/{}/{}/{}.m3u8'.format(self.server, self.username, self.password, stream['stream_id'])
+        return '{}{}/{}/{}'.format(self.server, self.username, self.password, stream['stream_id'])
+
+
+class OverrideModel:
+    """Indexed view of a sort-override.xml file
+    """
+    def __init__(self):
+        self.category_order = []
+        self.category_options = {}
+        # channel attributes in document order plus lookups by category / categoryOverride / (category, name)
+        self.channels = []
+        self.channels_by_category = {}
+        self.channels_by_category_override = {}
+        self.channels_by_key = {}
+        self.xmltv_sources = OrderedDict()
+
+
+OVERRIDE_CACHE_VERSION = 1
+
+
+def _parse_override_file(mapping_file):
+    """Build an OverrideModel from the override file in a single streaming pass
+    """
+    model = OverrideModel()
+    in_xmltv_sources = False
+    group_urls = None
+
+    for event, elem in ET.iterparse(mapping_file, events=('start', 'end')):
+        tag = elem.tag
+        if event == 'start':
+            if tag == 'xmltvextrasources':
+                in_xmltv_sources = True
+            elif tag == 'group' and in_xmltv_sources:
+                group_urls = []
+                model.xmltv_sources[elem.attrib.get('id')] = group_urls
+            continue
+
+        if tag == 'category':
+            category = elem.attrib.get('name')
+            if not type(category) is unicode:
+                category = category.decode("utf-8")
+            cat_title_override = elem.attrib.get('nameOverride', '')
+            if not type(cat_title_override) is unicode:
+                cat_title_override = cat_title_override.decode("utf-8")
+            dictoption = {'nameOverride': cat_title_override,
+                          'enabled': elem.attrib.get('enabled', True) == 'true'}
+            if elem.attrib.get('customCategory', False) == 'true':
+                dictoption['customCategory'] = True
+            model.category_order.append(category)
+            model.category_options[category] = dictoption
+            elem.clear()
+        elif tag == 'channel':
+            node = dict(elem.attrib)
+            model.channels.append(node)
+            model.channels_by_category.setdefault(node.get('category'), []).append(node)
+            if node.get('categoryOverride') is not None:
+                model.channels_by_category_override.setdefault(node['categoryOverride'], []).append(node)
+            model.channels_by_key.setdefault((node.get('category'), node.get('name')), node)
+            elem.clear()
+        elif tag == 'url' and group_urls is not None:
+            group_urls.append(elem.text)
+        elif tag == 'group' and in_xmltv_sources:
+            group_urls = None
+            elem.clear()
+        elif tag == 'xmltvextrasources':
+            in_xmltv_sources = False
+    return model
+
+
+def load_override_model(mapping_file, cache_file=None):
+    """Return the OverrideModel for mapping_file
+    The parsed model is cached in cache_file and reused while the override file content is unchanged
+    (hashing the file is far cheaper than parsing it and, unlike its mtime, catches an edit within the same second)
+    """
+    with open(mapping_file, 'rb') as f:
+        content_md5 = hashlib.md5(f.read()).hexdigest()
+    cache_key = (OVERRIDE_CACHE_VERSION, os.path.abspath(mapping_file), content_md5)
+
+    if cache_file and os.path.isfile(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+            if cached.get('key') == cache_key:
+                model = OverrideModel()
+                model.__dict__.update(cached['model'])
+                return model
+        except Exception, e:
+            if DEBUG:
+                print('Unable to read override cache', e)
+
+    model = _parse_override_file(mapping_file)
+
+    if cache_file:
+        try:
+            with open(cache_file, 'wb') as f:
+                # store plain containers so the cache loads whether we run as a script or from the plugin
+                pickle.dump({'key': cache_key, 'model': model.__dict__}, f, pickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            if DEBUG:
+                print('Unable to write override cache', e)
+    return model
+
+
+class StageGraph:
+    """Run a set of stages concurrently
+    each stage gets its own thread and starts as soon as the stages it requires have completed
+    """
+    def __init__(self, concurrent=True):
+        self._stages = OrderedDict()
+        self._concurrent = concurrent
+
+    def add(self, name, func, requires=()):
+        self._stages[name] = (func, tuple(requires))
+
+    def run(self):
+        """Run all stages and wait for them to finish
+        Stages whose requirements failed are skipped, the first error is re-raised
+        """
+        if not self._concurrent:
+            # one at a time in the order added
+            for func, requires in self._stages.itervalues():
+                func()
+            return
+
+        finished = dict((name, threading.Event()) for name in self._stages)
+        failed = set()
+        errors = []
+
+        def run_stage(name, func, requires):
+            try:
+                for required in requires:
+                    finished[required].wait()
+                if failed.intersection(requires):
+                    failed.add(name)
+                    return
+                func()
+            except Exception:
+                failed.add(name)
+                errors.append(sys.exc_info())
+            finally:
+                finished[name].set()
+
+        threads = []
+        for name, (func, requires) in self._stages.iteritems():
+            thread = threading.Thread(target=run_stage, name=name, args=(name, func, requires))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+
+PROFILE_STATS_STAGES = ('override', 'parse_m3u', 'parse_data')
+
+
+def get_memory_usage():
+    """Return (current rss, peak rss) in kB
+    """
+    rss = peak = 0
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1])
+                elif line.startswith('VmHWM:'):
+                    peak = int(line.split()[1])
+    except (IOError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss, peak
+
+
+def reset_peak_memory():
+    """Reset the kernels peak rss counter so each stage gets its own peak (Linux 4.0+)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except IOError:
+        return False
+
+
+def get_approx_size(obj, seen=None):
+    """Approximate deep size in bytes of a structure made from dicts, lists, tuples, sets and strings
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += get_approx_size(key, seen) + get_approx_size(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += get_approx_size(item, seen)
+    elif hasattr(obj, '__dict__'):
+        size += get_approx_size(obj.__dict__, seen)
+    return size
+
+
+class StageProfiler:
+    """Record time, rss and allocation growth for each process_provider stage
+    """
+    def __init__(self, stats_path=None):
+        # directory to write cProfile stats for the parse and override stages to (None = don't profile)
+        self.stats_path = stats_path
+        self.records = []
+
+    def run(self, provider, stage, func, *args):
+        provider_filename = provider._get_safe_provider_filename()
+        peak_reset = reset_peak_memory()
+        rss_before, peak_before = get_memory_usage()
+        objects_before = len(gc.get_objects())
+        start = time.time()
+        try:
+            if self.stats_path and stage in PROFILE_STATS_STAGES:
+                import cProfile
+                profile = cProfile.Profile()
+                try:
+                    return profile.runcall(func, *args)
+                finally:
+                    profile.dump_stats(os.path.join(self.stats_path, '{}-{}.pstats'.format(provider_filename, stage)))
+            return func(*args)
+        finally:
+            rss_after, peak_after = get_memory_usage()
+            self.records.append({
+                'provider': provider_filename,
+                'stage': stage,
+                'seconds': time.time() - start,
+                'rss': rss_after,
+                'rss_growth': rss_after - rss_before,
+                # without a peak reset we can only say whether this stage raised the process peak
+                'peak': peak_after if peak_reset or peak_after > peak_before else 0,
+                'objects_growth': len(gc.get_objects()) - objects_before,
+            })
+
+    def report(self, provider):
+        """Print (and save) the stage report for provider along with the sizes of its largest structures
+        """
+        provider_filename = provider._get_safe_provider_filename()
+        records = [r for r in self.records if r['provider'] == provider_filename]
+        structures = [
+            ('_dictchannels', provider._dictchannels),
+            ('_category_options', provider._category_options),
+            ('_panel_bouquet', provider._panel_bouquet),
+            ('override model', provider._override_model),
+            ('run context picon/epg caches', provider._run.__dict__),
+        ]
+        lines = ['----Memory profile for {}----'.format(provider_filename),
+                 '{:<28}{:>9}{:>12}{:>12}{:>12}{:>12}'.format('stage', 'secs', 'peak kB', 'rss kB', 'rss +kB',
+                                                                'objects +')]
+        for r in records:
+            lines.append('{:<28}{:>9.2f}{:>12}{:>12}{:>12}{:>12}'.format(
+                r['stage'], r['seconds'], r['peak'] or '-', r['rss'], r['rss_growth'], r['objects_growth']))
+        if records:
+            worst = max(records, key=lambda r: r['peak'])
+            lines.append('highest peak rss: {} ({} kB)'.format(worst['stage'], worst['peak']))
+        lines.append('largest structures:')
+        sizes = sorted(((get_approx_size(obj) // 1024, name) for name, obj in structures), reverse=True)
+        for size, name in sizes:
+            lines.append('  {:<36}{:>10} kB'.format(name, size))
+        mapping_file = os.path.join(CFGPATH, provider_filename + '-sort-current.xml')
+        if os.path.isfile(mapping_file):
+            lines.append('  {:<36}{:>10} kB'.format('save_map_xml output', os.path.getsize(mapping_file) // 1024))
+
+        report = '\n'.join(lines)
+        print('\n{}'.format(report))
+        report_path = self.stats_path or CFGPATH
+        try:
+            with open(os.path.join(report_path, '{}-profile.txt'.format(provider_filename)), 'w') as f:
+                f.write(report + '\n')
+        except IOError, e:
+            print('Unable to save profile report', e)
+
+
+STAGE_BUDGET_NAMES = ('download', 'parse', 'probe', 'picons')
+# stages that can be run on their own with --stages
+RUN_STAGE_NAMES = ('mapxml', 'probe', 'picons', 'bouquets', 'epg')
+# seconds of the run budget (at most a tenth of it) kept back for writing the bouquets and EPG config
+RUN_BUDGET_RESERVE = 60
+
+
+class StageTimeout(Exception):
+    """A stage ran out of its time budget"""
+
+
+def parse_stages(stages):
+    """Parse --stages 'stage,...' into a set
+    """
+    selected = set(stage.strip() for stage in stages.split(','))
+    for stage in selected:
+        if stage not in RUN_STAGE_NAMES:
+            raise ValueError('invalid stage {!r}, stages are: {}'.format(stage, ', '.join(RUN_STAGE_NAMES)))
+    return selected
+
+
+def parse_budgets(budgets):
+    """Parse --budgets 'stage=seconds,...' into a dict
+    """
+    stage_budgets = {}
+    for item in budgets.split(','):
+        stage, sep, seconds = item.partition('=')
+        stage = stage.strip()
+        if not sep or stage not in STAGE_BUDGET_NAMES:
+            raise ValueError('invalid stage budget {!r}, stages are: {}'.format(item, ', '.join(STAGE_BUDGET_NAMES)))
+        try:
+            stage_budgets[stage] = float(seconds)
+        except ValueError:
+            raise ValueError('invalid stage budget {!r}, seconds must be a number'.format(item))
+    return stage_budgets
+
+
+PROBE_WORKERS = 10
+# panels only allow an account a connection or two, so streams on the same host are checked one at a time
+PROBE_HOST_CONNECTIONS = 1
+PROBE_TIMEOUT = 5
+# replies telling the account is at its connection limit (or the panel is busy) rather than the stream is dead
+PROBE_INCONCLUSIVE_STATUSES = (403, 429, 456, 458, 503, 509)
+PROBE_MAX_REDIRECTS = 3
+# how long a probe result is trusted before the stream is checked again
+PROBE_OK_TTL = 24 * 3600
+PROBE_FAIL_TTL = 3600
+# channels are disabled once their stream has failed this many checks in a row
+PROBE_FAIL_THRESHOLD = 3
+
+
+def probe_stream(url, timeout=PROBE_TIMEOUT):
+    """Return True if url looks alive, False if it looks dead and None if it can't be told
+    (connection limit replies, timeouts and other socket errors).
+    tries a HEAD request first and falls back to a short range GET as plenty of panels reject HEAD
+    """
+    method = 'HEAD'
+    redirects = 0
+    while True:
+        parts = urlparse.urlsplit(url)
+        if parts.scheme == 'https':
+            conn = httplib.HTTPSConnection(parts.netloc, timeout=timeout, context=ssl._create_unverified_context())
+        elif parts.scheme == 'http':
+            conn = httplib.HTTPConnection(parts.netloc, timeout=timeout)
+        else:
+            # rtmp, rtsp etc. can't be checked this way
+            return True
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+        headers = {'User-Agent': AppUrlOpener.version}
+        if method == 'GET':
+            headers['Range'] = 'bytes=0-1023'
+        try:
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307, 308) and location and redirects < PROBE_MAX_REDIRECTS:
+                url = urlparse.urljoin(url, location)
+                redirects += 1
+                continue
+            if response.status >= 400 and method == 'HEAD':
+                method = 'GET'
+                continue
+            if response.status in PROBE_INCONCLUSIVE_STATUSES:
+                return None
+            return response.status < 400
+        except (socket.error, httplib.HTTPException):
+            return None
+        finally:
+            conn.close()
+
+
+class StreamProber:
+    """Check streams concurrently with a bounded number of connections, in total and per host
+    results are cached per stream url with a TTL and the number of failed checks in a row kept,
+    inconclusive checks aren't recorded so the stream is checked again next time
+    """
+    def __init__(self, cache_file, workers=PROBE_WORKERS, timeout=PROBE_TIMEOUT,
+                 host_connections=PROBE_HOST_CONNECTIONS):
+        self._cache_file = cache_file
+        self._workers = workers
+        self._timeout = timeout
+        self._host_connections = max(1, host_connections)
+        # stream url -> (time checked, alive, failed checks in a row)
+        self._results = {}
+        if os.path.isfile(cache_file):
+            try:
+                with open(cache_file, 'rb') as f:
+                    self._results = pickle.load(f)
+            except Exception, e:
+                if DEBUG:
+                    print('Ignoring unreadable probe cache', e)
+
+    def _is_fresh(self, url, now):
+        result = self._results.get(url)
+        return result is not None and now - result[0] < (PROBE_OK_TTL if result[1] else PROBE_FAIL_TTL)
+
+    def probe(self, urls, deadline=None):
+        """Check the urls without a fresh cached result, stops starting new checks at deadline
+        returns the number of streams checked
+        """
+        now = time.time()
+        # host -> urls to check, each host has its own workers so it never gets more than its connections
+        todo = OrderedDict()
+        for url in OrderedDict((url, True) for url in urls if not self._is_fresh(url, now)):
+            todo.setdefault(urlparse.urlsplit(url).netloc.lower(), Queue.Queue()).put(url)
+        checked = []
+        lock = threading.Lock()
+        connections = threading.BoundedSemaphore(self._workers)
+
+        def worker(host_todo):
+            while deadline is None or time.time() < deadline:
+                try:
+                    url = host_todo.get_nowait()
+                except Queue.Empty:
+                    return
+                with connections:
+                    alive = probe_stream(url, self._timeout)
+                with lock:
+                    checked.append(url)
+                    if alive is None:
+                        continue
+                    failures = 0 if alive else self._results.get(url, (0, False, 0))[2] + 1
+                    self._results[url] = (time.time(), alive, failures)
+
+        threads = [threading.Thread(target=worker, args=(host_todo,)) for host_todo in todo.itervalues()
+                   for i in xrange(min(self._host_connections, self._workers, host_todo.qsize()))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return len(checked)
+
+    def is_dead(self, url):
+        result = self._results.get(url)
+        return result is not None and result[2] >= PROBE_FAIL_THRESHOLD
+
+    def save(self, urls=None):
+        """Write the cache, keeping only urls when given so streams that have gone don't pile up
+        """
+        results = self._results
+        if urls is not None:
+            results = dict((url, results[url]) for url in urls if url in results)
+        with open(self._cache_file + '.tmp', 'wb') as f:
+            pickle.dump(results, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(self._cache_file + '.tmp', self._cache_file)
+
+
+# picons downloaded before the bouquets are written, the rest finish in the background
+PICON_PRIORITY_COUNT = 200
+PICON_PENDING_SAVE_INTERVAL = 100
+PICON_INDEX_FILE = 'picons.index'
+# no picon markers (.None) are left this long before the logo is tried again
+PICON_MARKER_MAX_AGE = 7 * 86400
+
+
+class PiconIndex:
+    """Record of the picons created by this script so they can be removed once no provider wants them
+    picon folder -> picon name -> provider -> time the provider last wanted it. Picons in the folder that
+    aren't in the index (e.g. the users own) are left alone
+    """
+    def __init__(self, index_file):
+        self._index_file = index_file
+        self._index = {}
+        if os.path.isfile(index_file):
+            try:
+                with open(index_file, 'r') as f:
+                    self._index = json.load(f)
+            except (IOError, ValueError), e:
+                print('Picon index unreadable, starting a new one', e)
+
+    def update(self, icon_path, created, wanted):
+        """Add the picons created this run and refresh the claims of the providers that ran
+        wanted is provider -> picon names it wants, providers not in it keep their claims
+        """
+        now = int(time.time())
+        picons = self._index.setdefault(icon_path, {})
+        for piconname in created:
+            picons.setdefault(piconname, {})
+        for piconname, claims in picons.iteritems():
+            for provider, piconnames in wanted.iteritems():
+                if piconname in piconnames:
+                    claims[provider] = now
+                else:
+                    claims.pop(provider, None)
+
+    def collect(self, icon_path, size_budget=None, in_use=()):
+        """Remove the orphaned picons, stale no picon markers and partial downloads from icon_path
+        then the least recently wanted picons until the ones created by this script are within size_budget bytes.
+        Picons in in_use (wanted this run) are never removed to keep to the budget
+        returns the number of files removed, the bytes freed and the size of the indexed picons left
+        """
+        picons = self._index.setdefault(icon_path, {})
+        files = {}
+        for fname in os.listdir(icon_path):
+            filepath = os.path.join(icon_path, fname)
+            if os.path.isfile(filepath):
+                files.setdefault(os.path.splitext(fname)[0], []).append(filepath)
+
+        now = time.time()
+        remove = []
+        for piconname, filepaths in files.iteritems():
+            if piconname not in picons:
+                # not created by this script
+                continue
+            claims = picons[piconname]
+            if not claims:
+                # orphan, no provider wants it any more
+                remove.extend(filepaths)
+                del picons[piconname]
+                continue
+            for filepath in filepaths:
+                ext = os.path.splitext(filepath)[1]
+                if ext == '.None':
+                    # so the logo is tried again
+                    if now - os.path.getmtime(filepath) > PICON_MARKER_MAX_AGE:
+                        remove.append(filepath)
+                elif ext in ('', '.part'):
+                    # download or conversion that didn't finish
+                    remove.append(filepath)
+        for piconname in [p for p in picons if p not in files]:
+            # removed by hand
+            del picons[piconname]
+
+        removed = set(remove)
+        total = sum(os.path.getsize(filepath) for piconname in picons
+                    for filepath in files[piconname] if filepath not in removed)
+        if size_budget:
+            lru = sorted((max(claims.itervalues()) if claims else 0, piconname)
+                         for piconname, claims in picons.iteritems() if piconname not in in_use)
+            for last_wanted, piconname in lru:
+                if total <= size_budget:
+                    break
+                for filepath in files[piconname]:
+                    if filepath not in removed:
+                        total -= os.path.getsize(filepath)
+                        remove.append(filepath)
+                del picons[piconname]
+
+        freed = 0
+        for filepath in remove:
+            try:
+                freed += os.path.getsize(filepath)
+                os.remove(filepath)
+            except OSError, e:
+                if DEBUG:
+                    print('Picon clean up - unable to remove', filepath, e)
+        return len(remove), freed, total
+
+    def save(self):
+        with open(self._index_file + '.tmp', 'w') as f:
+            json.dump(self._index, f)
+        os.rename(self._index_file + '.tmp', self._index_file)
+
+
+OUTPUT_STAGING_DIR = '.e2m3u2bouquet-staging'
+
+
+class OutputTransaction:
+    """Generated files are written to a staging folder next to where they belong and moved into place
+    together by commit(), so Enigma2 and EPG-Importer never see the output of a half finished run.
+    bouquets.tv is written once at commit with the index entries of every provider merged
+    """
+    def __init__(self):
+        # final path -> staged path
+        self._staged = OrderedDict()
+        self._removals = []
+        # bouquets.tv path -> [(provider filename, index entries, bouquet top)]
+        self._bouquet_indexes = OrderedDict()
+        self._staging_dirs = []
+        # called once the files are in place
+        self._on_commit = []
+
+    def path(self, final_path):
+        """Return the path to write final_path to, it is moved into place at commit
+        """
+        directory, name = os.path.split(final_path)
+        staging_dir = os.path.join(directory, OUTPUT_STAGING_DIR)
+        if staging_dir not in self._staging_dirs:
+            if os.path.isdir(staging_dir):
+                # left by an interrupted run
+                shutil.rmtree(staging_dir)
+            os.makedirs(staging_dir)
+            self._staging_dirs.append(staging_dir)
+        staged_path = os.path.join(staging_dir, name)
+        self._staged[final_path] = staged_path
+        return staged_path
+
+    def remove(self, final_path):
+        """Remove final_path at commit unless it has been written again this run
+        """
+        self._removals.append(final_path)
+
+    def on_commit(self, func):
+        self._on_commit.append(func)
+
+    def add_bouquet_indexes(self, bouquets_tv, provider_filename, bouquet_indexes, top):
+        """Replace the providers entries in bouquets_tv at commit
+        """
+        self._bouquet_indexes.setdefault(bouquets_tv, []).append((provider_filename, bouquet_indexes, top))
+
+    def _write_bouquets_tv(self, bouquets_tv, providers):
+        lines = []
+        if os.path.isfile(bouquets_tv):
+            with open(bouquets_tv, 'r') as f:
+                lines = [line for line in f if not line.startswith('#NAME')]
+        for provider_filename, bouquet_indexes, top in providers:
+            lines = [line for line in lines if '.suls_iptv_{}'.format(provider_filename) not in line]
+            lines = bouquet_indexes + lines if top else lines + bouquet_indexes
+        with open(self.path(bouquets_tv), 'w') as f:
+            f.write('#NAME Bouquets (TV)\n')
+            for line in lines:
+                f.write(line)
+
+    def commit(self):
+        """Move the staged files into place and remove the obsolete ones
+        the bouquets go before bouquets.tv and old bouquets are removed after it, so bouquets.tv
+        never lists a bouquet file that isn't there
+        """
+        for bouquets_tv, providers in self._bouquet_indexes.iteritems():
+            self._write_bouquets_tv(bouquets_tv, providers)
+        staged = sorted(self._staged.iteritems(), key=lambda item: os.path.basename(item[0]) == 'bouquets.tv')
+        for final_path, staged_path in staged:
+            if os.path.isfile(staged_path):
+                # rename is atomic as the staging folder is on the same filesystem
+                os.rename(staged_path, final_path)
+        for final_path in self._removals:
+            if final_path not in self._staged and os.path.isfile(final_path):
+                os.remove(final_path)
+        for staging_dir in self._staging_dirs:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        on_commit = self._on_commit
+        self._reset()
+        for func in on_commit:
+            func()
+
+    def rollback(self):
+        """Drop the staged files, leaving the output of the last commit in place
+        """
+        for staging_dir in self._staging_dirs:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+        self._reset()
+
+    def _reset(self):
+        self._staged.clear()
+        self._removals = []
+        self._bouquet_indexes.clear()
+        self._staging_dirs = []
+        self._on_commit = []
+
+
+RUN_JOURNAL_VERSION = 2
+# an interrupted run is only carried on by a run started within this many seconds of it
+RUN_JOURNAL_MAX_AGE = 6 * 3600
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+
+
+def get_boot_id():
+    """Identifies the current boot of the box ('' if unknown)
+    """
+    try:
+        with open(BOOT_ID_FILE, 'r') as f:
+            return f.read().strip()
+    except IOError:
+        return ''
+
+
+def is_process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    except TypeError:
+        return False
+    return True
+
+
+class RunJournal:
+    """Checkpoints of the stages of a providers run, so a run that is interrupted (box rebooted or the
+    script killed) is carried on from the last checkpoint by the next run rather than started again.
+    A journal is only used with the same config and override file, and a checkpoints file only while it is
+    unchanged. The journal is removed once the runs output has been committed or when the run fails,
+    so a run that ended with an error starts again rather than repeating it from a stale checkpoint
+    """
+    def __init__(self, journal_file, key):
+        self._journal_file = journal_file
+        self._key = key
+        self._lock = threading.Lock()
+        self._completed = False
+        # the run writing the journal, a journal left by a run that is still going isn't carried on
+        self._owner = {'pid': os.getpid(), 'boot_id': get_boot_id()}
+        journal = {}
+        if os.path.isfile(journal_file):
+            try:
+                with open(journal_file, 'r') as f:
+                    journal = json.load(f)
+            except (IOError, ValueError), e:
+                print('Ignoring unreadable run journal', e)
+        owner = journal.get('owner') or {}
+        owner_running = owner.get('boot_id') == self._owner['boot_id'] and owner.get('pid') != self._owner['pid'] \
+            and is_process_running(owner.get('pid'))
+        self.resumed = journal.get('version') == RUN_JOURNAL_VERSION and journal.get('key') == key and \
+            time.time() - journal.get('started', 0) < RUN_JOURNAL_MAX_AGE and not owner_running
+        if self.resumed:
+            self._started = journal['started']
+            self._stages = journal['stages']
+        else:
+            if not owner_running:
+                self._remove_owned_files(journal.get('stages', {}))
+            self._started = time.time()
+            self._stages = {}
+
+    def checkpoint(self, stage, filename=None, owned=False):
+        """Record stage as completed, with the file it left if any (removed with the journal if owned)
+        """
+        with self._lock:
+            if self._completed:
+                return
+            self._stages[stage] = {'file': filename, 'state': get_file_state(filename), 'owned': owned}
+            with open(self._journal_file + '.tmp', 'w') as f:
+                json.dump({'version': RUN_JOURNAL_VERSION, 'key': self._key, 'started': self._started,
+                           'owner': self._owner, 'stages': self._stages}, f)
+            os.rename(self._journal_file + '.tmp', self._journal_file)
+
+    def is_done(self, stage):
+        return stage in self._stages
+
+    def get_file(self, stage):
+        """Return the file of a completed stage if it is still as it was left (else None)
+        """
+        checkpoint = self._stages.get(stage)
+        if checkpoint and checkpoint['state'] and \
+                list(get_file_state(checkpoint['file']) or ()) == checkpoint['state']:
+            return checkpoint['file']
+        return None
+
+    def complete(self):
+        """Remove the journal, once the runs output is in place or when the run failed
+        """
+        with self._lock:
+            self._completed = True
+            self._remove_owned_files(self._stages)
+            if os.path.isfile(self._journal_file):
+                os.remove(self._journal_file)
+
+    def _remove_owned_files(self, stages):
+        for checkpoint in stages.itervalues():
+            if checkpoint.get('owned') and checkpoint.get('file') and os.path.isfile(checkpoint['file']):
+                os.remove(checkpoint['file'])
+
+
+class RunContext:
+    """Work shared between all the providers processed in one run
+    Suppliers often resell the same upstream channels so picons and epg mappings are only worked out once
+    """
+    def __init__(self):
+        # service title -> picon name
+        self.picon_names = {}
+        # picon file paths already handled this run
+        self.picon_files = set()
+        # picon folder -> provider -> picon names it wants / picon names created this run (see PiconIndex)
+        self.picon_claims = {}
+        self.new_picons = {}
+        # size budget in bytes for the picons created by this script (--piconbudget)
+        self.picon_budget = None
+        # picons are also downloaded by background threads
+        self.picon_lock = threading.Lock()
+        self.background_picons = True
+        self.background_threads = []
+        # logo url -> picon file created from it ('' if the logo couldn't be used)
+        self.logo_picons = {}
+        # (tvg-id, epg service ref, service title) -> EPG-Importer channel line
+        self.epg_channel_lines = {}
+        # (tvg-id, service title) -> xml escaped tvg-id and title
+        self.epg_channel_escaped = {}
+        # StageProfiler when running with --profile
+        self.profiler = None
+        # time budgets (--runbudget/--budgets), the run deadline is an absolute time.time()
+        self.deadline = None
+        self.reserve = 0
+        self.stage_budgets = {}
+        # stages selected with --stages (None for all of them)
+        self.stages = None
+        # worker processes for parsing large m3u files (--parseworkers)
+        self.parse_workers = 1
+        # connections to each host when checking streams (--probeconnections)
+        self.probe_connections = PROBE_HOST_CONNECTIONS
+        # epg.dat to write (--epgdat), XMLTV url -> lower case tvg-id -> service keys for it
+        self.epgdat_file = None
+        self.epg_sources = OrderedDict()
+        # XMLTV url -> downloaded file ('' if the download failed)
+        self.xmltv_files = {}
+        # generated files waiting to be moved into place (see OutputTransaction)
+        self.output = OutputTransaction()
+        # RunJournal of each provider processed
+        self.journals = []
+
+    def wait_for_background(self):
+        """Wait for the picon downloads left running in the background
+        """
+        if any(thread.is_alive() for thread in self.background_threads):
+            print('\nWaiting for background picon downloads to finish...')
+        for thread in self.background_threads:
+            thread.join()
+        self.background_threads = []
+
+    def collect_picons(self):
+        """Remove the picons no provider wants any more and keep the ones left within the budget
+        """
+        if not self.picon_claims:
+            return
+        index = PiconIndex(os.path.join(CFGPATH, PICON_INDEX_FILE))
+        for icon_path, claims in self.picon_claims.iteritems():
+            index.update(icon_path, self.new_picons.get(icon_path, ()), claims)
+            in_use = set()
+            for piconnames in claims.itervalues():
+                in_use.update(piconnames)
+            removed, freed, total = index.collect(icon_path, self.picon_budget, in_use)
+            if removed:
+                print('\nPicon clean up - {} files removed from {} ({:.1f}MB freed)'
+                      .format(removed, icon_path, freed / 1048576.0))
+            if self.picon_budget and total > self.picon_budget:
+                print('\nPicon budget of {:.1f}MB is smaller than the {:.1f}MB of picons in use in {}, '
+                      'the budget needs raising to keep them all'
+                      .format(self.picon_budget / 1048576.0, total / 1048576.0, icon_path))
+        index.save()
+        self.picon_claims = {}
+        self.new_picons = {}
+
+    def discard_journals(self):
+        """Remove the providers run journals when the run fails, the next run starts them again
+        """
+        for journal in self.journals:
+            journal.complete()
+        self.journals = []
+
+    def remove_xmltv_files(self):
+        for xmltv_file in self.xmltv_files.itervalues():
+            if xmltv_file and os.path.isfile(xmltv_file) and not DEBUG:
+                os.remove(xmltv_file)
+        self.xmltv_files = {}
+
+    def set_run_budget(self, seconds):
+        self.deadline = time.time() + seconds
+        self.reserve = min(RUN_BUDGET_RESERVE, seconds / 10.0)
+
+    def stage_selected(self, *stages):
+        """True if any of stages is to be run
+        """
+        return self.stages is None or any(stage in self.stages for stage in stages)
+
+    def get_stage_deadline(self, stage):
+        """Time a stage starting now has to finish by (None if unlimited)
+        Stages before the bouquets are written leave the reserve of the run budget for them
+        """
+        deadlines = []
+        if stage in self.stage_budgets:
+            deadlines.append(time.time() + self.stage_budgets[stage])
+        if self.deadline is not None:
+            deadlines.append(self.deadline - self.reserve)
+        return min(deadlines) if deadlines else None
+
+
+SERVICE_REF_DB_FILE = 'service-refs.db'
+# allocated service refs not seen for this many days are dropped
+SERVICE_REF_MAX_AGE_DAYS = 90
+
+
+class ServiceRefStore:
+    """Persistent service ref numbers so refs don't shift when channels are added or removed
+    Numbers are kept per provider, category and stream. The providers rows are loaded into a dict
+    so lookups are cheap, new and re-seen rows are written back in one transaction by save()
+    """
+    def __init__(self, db_file, provider):
+        self._db_file = db_file
+        self._provider = provider
+        self._today = int(time.time() // 86400)
+        # (category, stream) -> [num, last seen day]
+        self._refs = {}
+        # category -> highest num allocated
+        self._max_num = {}
+        self._changed = set()
+
+        conn = self._connect()
+        try:
+            for category, stream, num, last_seen in conn.execute(
+                    'SELECT category, stream, num, last_seen FROM service_refs WHERE provider = ?', (provider,)):
+                self._refs[(category, stream)] = [num, last_seen]
+                if num > self._max_num.get(category, 0):
+                    self._max_num[category] = num
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self._db_file)
+        conn.execute('CREATE TABLE IF NOT EXISTS service_refs (provider TEXT, category TEXT, stream TEXT, '
+                     'num INTEGER, last_seen INTEGER, PRIMARY KEY (provider, category, stream))')
+        return conn
+
+    def get_num(self, category, stream):
+        """Return the services number, allocating the next free one for a stream not seen before
+        """
+        key = (category, stream)
+        ref = self._refs.get(key)
+        if ref is None:
+            ref = self._refs[key] = [self._max_num.get(category, 0) + 1, self._today]
+            self._max_num[category] = ref[0]
+            self._changed.add(key)
+        elif ref[1] != self._today:
+            ref[1] = self._today
+            self._changed.add(key)
+        return ref[0]
+
+    def save(self):
+        """Write back new and re-seen refs and drop the ones that have not been seen for a long time
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO service_refs VALUES (?, ?, ?, ?, ?)',
+                                 ((self._provider, category, stream, self._refs[(category, stream)][0],
+                                   self._refs[(category, stream)][1]) for category, stream in self._changed))
+                conn.execute('DELETE FROM service_refs WHERE provider = ? AND last_seen < ?',
+                             (self._provider, self._today - SERVICE_REF_MAX_AGE_DAYS))
+        finally:
+            conn.close()
+        self._changed = set()
+
+
+def get_stream_key(stream_url, credentials=()):
+    """Identify a stream by its url path without the host and the accounts username / password segments
+    so refs survive username/password or host changes. Returns unicode
+    """
+    if type(stream_url) is unicode:
+        stream_url = stream_url.encode('utf-8')
+    # path without the scheme, host, query and fragment (urlsplit is slow for a whole playlist)
+    path = stream_url
+    pos = path.find('://')
+    if pos != -1:
+        pos = path.find('/', pos + 3)
+        path = path[pos:] if pos != -1 else ''
+    for sep in '?#':
+        pos = path.find(sep)
+        if pos != -1:
+            path = path[:pos]
+    segments = [segment for segment in path.split('/') if segment and segment not in credentials]
+    key = '/'.join(segments) or stream_url
+    return key.decode('utf-8', 'ignore')
+
+
+def get_stream_keys(channels, credentials=()):
+    """Stream keys for the channels of a category
+    Streams whose url path doesn't tell them apart (e.g. all ending .../index.m3u8 behind a token) are keyed
+    by tvg-id and name instead, what is still the same is numbered by position
+    """
+    keys = [get_stream_key(x.get('stream-url', ''), credentials) for x in channels]
+    key_counts = {}
+    for key in keys:
+        key_counts[key] = key_counts.get(key, 0) + 1
+    counts = {}
+    for i, x in enumerate(channels):
+        key = keys[i]
+        if key_counts[key] > 1:
+            key = u'{}\t{}'.format(x.get('tvg-id', u''), x['stream-name'])
+        count = counts[key] = counts.get(key, 0) + 1
+        if count > 1:
+            key = u'{}#{}'.format(key, count)
+        keys[i] = key
+    return keys
+
+
+CHANNEL_INDEX_VERSION = 1
+
+
+def normalise_channel_name(name):
+    """Lower case name without accents, what the channel index matches on
+    """
+    if not isinstance(name, unicode):
+        name = name.decode('utf-8', 'ignore')
+    name = name.lower()
+    try:
+        name.encode('ascii')
+        return name
+    except UnicodeEncodeError:
+        name = unicodedata.normalize('NFKD', name)
+        return u''.join(c for c in name if not unicodedata.combining(c))
+
+
+CHANNEL_NAME_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+class ChannelIndex:
+    """Index of a providers parsed channels so the plugins override editors can find channels
+    without scanning them. Prefix and token lookups on the names (stream-name and nameOverride),
+    exact lookups on tvg-id and serviceRef, all filtered by category and enabled state.
+    Channels are referred to by id (position in bouquet order), get() returns a channels indexed fields
+    """
+    FIELDS = ('category', 'stream-name', 'nameOverride', 'tvg-id', 'serviceRef', 'enabled')
+
+    def __init__(self):
+        # field -> value for each channel id (a list per field rather than a dict per channel keeps it compact)
+        self._fields = dict((field, []) for field in self.FIELDS)
+        # name token -> ids
+        self._tokens = {}
+        # sorted tokens for the prefix matches on words, made when first needed
+        self._sorted_tokens = None
+        # sorted normalised names and the channel id of each for the prefix lookups
+        self._names = []
+        self._name_ids = []
+        self._tvg_ids = {}
+        self._service_refs = {}
+        self._categories = {}
+
+    @classmethod
+    def from_channels(cls, category_order, dictchannels):
+        index = cls()
+        for cat in category_order:
+            for x in dictchannels.get(cat, ()):
+                if not x['stream-name'].startswith('placeholder_'):
+                    for field in cls.FIELDS[1:-1]:
+                        index._fields[field].append(x.get(field))
+                    index._fields['category'].append(cat)
+                    index._fields['enabled'].append(x.get('enabled') is not False)
+                    index._add(len(index) - 1, sort=False)
+        order = sorted(xrange(len(index._names)), key=index._names.__getitem__)
+        index._names = [index._names[i] for i in order]
+        index._name_ids = [index._name_ids[i] for i in order]
+        index._get_sorted_tokens()
+        return index
+
+    @classmethod
+    def load(cls, filename):
+        """Load a saved index (None if missing or from another version)
+        """
+        try:
+            with open(filename, 'rb') as f:
+                saved = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError), e:
+            if DEBUG:
+                print('Unable to read channel index', e)
+            return None
+        if saved.get('version') != CHANNEL_INDEX_VERSION:
+            return None
+        index = cls()
+        index.__dict__.update(saved['index'])
+        return index
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            # plain containers so it loads whether we run as a script or from the plugin
+            pickle.dump({'version': CHANNEL_INDEX_VERSION, 'index': self.__dict__}, f, pickle.HIGHEST_PROTOCOL)
+
+    def _get_names(self, channel_id):
+        """Normalised names of a channel
+        """
+        return set(normalise_channel_name(self._fields[field][channel_id])
+                   for field in ('stream-name', 'nameOverride') if self._fields[field][channel_id])
+
+    def _get_lookups(self, channel_id):
+        return ((self._tvg_ids, self._fields['tvg-id'][channel_id]),
+                (self._service_refs, self._fields['serviceRef'][channel_id]),
+                (self._categories, self._fields['category'][channel_id]))
+
+    def _get_tokens(self, names):
+        tokens = set()
+        for name in names:
+            tokens.update(CHANNEL_NAME_TOKEN_RE.findall(name))
+        return tokens
+
+    def _add(self, channel_id, sort=True):
+        names = self._get_names(channel_id)
+        for token in self._get_tokens(names):
+            if token not in self._tokens:
+                self._tokens[token] = []
+                self._sorted_tokens = None
+            bisect.insort(self._tokens[token], channel_id)
+        for name in names:
+            pos = bisect.bisect_right(self._names, name) if sort else len(self._names)
+            self._names.insert(pos, name)
+            self._name_ids.insert(pos, channel_id)
+        for lookup, key in self._get_lookups(channel_id):
+            if key:
+                bisect.insort(lookup.setdefault(key, []), channel_id)
+
+    def _remove(self, channel_id):
+        names = self._get_names(channel_id)
+        for token in self._get_tokens(names):
+            self._remove_id(self._tokens, token, channel_id)
+            if token not in self._tokens:
+                self._sorted_tokens = None
+        for name in names:
+            for pos in xrange(bisect.bisect_left(self._names, name), bisect.bisect_right(self._names, name)):
+                if self._name_ids[pos] == channel_id:
+                    del self._names[pos]
+                    del self._name_ids[pos]
+                    break
+        for lookup, key in self._get_lookups(channel_id):
+            if key:
+                self._remove_id(lookup, key, channel_id)
+
+    def _remove_id(self, lookup, key, channel_id):
+        ids = lookup.get(key, [])
+        pos = bisect.bisect_left(ids, channel_id)
+        if pos < len(ids) and ids[pos] == channel_id:
+            del ids[pos]
+            if not ids:
+                del lookup[key]
+
+    def update(self, channel_id, changes):
+        """Apply an override edit (e.g. {'nameOverride': 'BBC One', 'enabled': False}) to a channel
+        """
+        self._remove(channel_id)
+        for field, value in changes.iteritems():
+            self._fields[field][channel_id] = value
+        self._add(channel_id)
+
+    def get(self, channel_id):
+        return dict((field, values[channel_id]) for field, values in self._fields.iteritems())
+
+    def __len__(self):
+        return len(self._fields['category'])
+
+    def _filter(self, ids, category, enabled, limit):
+        results = []
+        categories = self._fields['category']
+        enabled_states = self._fields['enabled']
+        for channel_id in ids:
+            if (category is None or categories[channel_id] == category) and \
+                    (enabled is None or enabled_states[channel_id] == enabled):
+                results.append(channel_id)
+                if limit and len(results) >= limit:
+                    break
+        return results
+
+    def prefix(self, text, category=None, enabled=None, limit=None):
+        """Ids of the channels with a name starting with text, in name order
+        """
+        text = normalise_channel_name(text)
+        ids = []
+        seen = set()
+        for pos in xrange(bisect.bisect_left(self._names, text), len(self._names)):
+            if not self._names[pos].startswith(text):
+                break
+            channel_id = self._name_ids[pos]
+            if channel_id not in seen:
+                seen.add(channel_id)
+                ids.append(channel_id)
+        return self._filter(ids, category, enabled, limit)
+
+    def search(self, text, category=None, enabled=None, limit=None):
+        """Ids of the channels with a name containing all the words in text, in bouquet order
+        the last word only has to match the start of a word so it can be used while typing
+        """
+        tokens = CHANNEL_NAME_TOKEN_RE.findall(normalise_channel_name(text))
+        if not tokens:
+            ids = self._categories.get(category, []) if category is not None else xrange(len(self))
+            return self._filter(ids, category, enabled, limit)
+        matches = [set(self._tokens.get(token, ())) for token in tokens[:-1]]
+        last = set()
+        token_keys = self._get_sorted_tokens()
+        for token in token_keys[bisect.bisect_left(token_keys, tokens[-1]):]:
+            if not token.startswith(tokens[-1]):
+                break
+            last.update(self._tokens[token])
+        matches.append(last)
+        ids = set.intersection(*matches)
+        return self._filter(sorted(ids), category, enabled, limit)
+
+    def _get_sorted_tokens(self):
+        if self._sorted_tokens is None:
+            self._sorted_tokens = sorted(self._tokens)
+        return self._sorted_tokens
+
+    def find_tvg_id(self, tvg_id, category=None, enabled=None):
+        return self._filter(self._tvg_ids.get(tvg_id, ()), category, enabled, None)
+
+    def find_service_ref(self, service_ref, category=None, enabled=None):
+        return self._filter(self._service_refs.get(service_ref, ()), category, enabled, None)
+
+
+EPGDAT_MAGIC = 0x98765432
+EPGDAT_VERSION = 'ENIGMA_EPG_V7'
+# event source type Enigma2 stores for schedule data
+EPGDAT_EVENT_TYPE = 1
+EPGDAT_LANGUAGE = 'eng'
+# extended event descriptors have a 4 bit descriptor number
+EPGDAT_MAX_EXTENDED_DESCRIPTORS = 16
+# an events length (10 byte header + 4 bytes per descriptor hash) is stored in a single byte
+EPGDAT_MAX_EVENT_DESCRIPTORS = (255 - 10) // 4
+# MJD of the unix epoch
+MJD_EPOCH = 40587
+
+
+def to_bcd(value):
+    return ((value // 10) << 4) | (value % 10)
+
+
+def from_bcd(value):
+    return (value >> 4) * 10 + (value & 0x0f)
+
+
+def parse_xmltv_time(value):
+    """Convert an XMLTV time e.g. '20200128193000 +0000' to a unix timestamp
+    """
+    value = value.strip()
+    timestamp = calendar.timegm((int(value[0:4]), int(value[4:6]), int(value[6:8]),
+                                 int(value[8:10] or 0), int(value[10:12] or 0), int(value[12:14] or 0)))
+    offset = value[14:].strip()
+    if len(offset) == 5 and offset[0] in '+-':
+        seconds = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+        timestamp += -seconds if offset[0] == '+' else seconds
+    return timestamp
+
+
+def split_dvb_text(text, max_bytes):
+    """Encode text as DVB utf-8 strings (0x15 prefixed) of at most max_bytes, split on character boundaries
+    """
+    parts = []
+    data = text.encode('utf-8')
+    while data:
+        part = data[:max_bytes - 1]
+        if len(part) < len(data):
+            # don't cut a multi byte character in half
+            part = part.decode('utf-8', 'ignore').encode('utf-8')
+        parts.append('\x15' + part)
+        data = data[len(part):]
+    return parts
+
+
+def get_event_descriptors(title, description):
+    """DVB short event descriptor for the title and extended event descriptors for the description
+    """
+    title_parts = split_dvb_text(title, 250)
+    name = title_parts[0] if title_parts else ''
+    descriptors = ['\x4d' + chr(len(name) + 5) + EPGDAT_LANGUAGE + chr(len(name)) + name + '\x00']
+    parts = split_dvb_text(description, 249)[:EPGDAT_MAX_EXTENDED_DESCRIPTORS]
+    for i, part in enumerate(parts):
+        descriptors.append('\x4e' + chr(len(part) + 6) + chr((i << 4) | (len(parts) - 1)) + EPGDAT_LANGUAGE +
+                           '\x00' + chr(len(part)) + part)
+    return descriptors
+
+
+def get_dvb_text(data):
+    if data.startswith('\x15'):
+        data = data[1:]
+    return data.decode('utf-8', 'ignore')
+
+
+class EpgDatWriter:
+    """Build an Enigma2 epg.dat (ENIGMA_EPG_V7) cache file
+    Each service is keyed by (sid, onid, tsid) and its events hold the EIT event header and the hashes of
+    their descriptors, the descriptors themselves are stored once at the end of the file
+    """
+    def __init__(self):
+        # (sid, onid, tsid) -> {start: (event id, duration, descriptor hashes)}
+        self._services = OrderedDict()
+        # descriptor hash -> [descriptor, reference count]
+        self._descriptors = {}
+
+    def add_event(self, service_keys, start, duration, title, description):
+        hashes = []
+        for descriptor in get_event_descriptors(title, description)[:EPGDAT_MAX_EVENT_DESCRIPTORS]:
+            descriptor_hash = zlib.crc32(descriptor) & 0xffffffff
+            # a (very unlikely) hash clash with another descriptor is resolved by probing
+            while descriptor_hash in self._descriptors and self._descriptors[descriptor_hash][0] != descriptor:
+                descriptor_hash = (descriptor_hash + 1) & 0xffffffff
+            self._descriptors.setdefault(descriptor_hash, [descriptor, 0])
+            hashes.append(descriptor_hash)
+
+        for key in service_keys:
+            events = self._services.setdefault(key, {})
+            if start in events:
+                # Enigma2 keeps one event per start time
+                continue
+            events[start] = ((len(events) + 1) & 0xffff, duration, hashes)
+            for descriptor_hash in hashes:
+                self._descriptors[descriptor_hash][1] += 1
+
+    def event_count(self):
+        return sum(len(events) for events in self._services.itervalues())
+
+    def write(self, filename):
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            f.write(struct.pack('<I13si', EPGDAT_MAGIC, EPGDAT_VERSION, len(self._services)))
+            for key, events in self._services.iteritems():
+                f.write(struct.pack('<iiii', key[0], key[1], key[2], len(events)))
+                for start in sorted(events):
+                    event_id, duration, hashes = events[start]
+                    days, seconds = divmod(start, 86400)
+                    duration = min(duration, 99 * 3600 + 3599)
+                    f.write(struct.pack('<BB', EPGDAT_EVENT_TYPE, 10 + 4 * len(hashes)))
+                    f.write(struct.pack('>HH6B', event_id, days + MJD_EPOCH,
+                                        to_bcd(seconds // 3600), to_bcd(seconds // 60 % 60), to_bcd(seconds % 60),
+                                        to_bcd(duration // 3600), to_bcd(duration // 60 % 60), to_bcd(duration % 60)))
+                    f.write(struct.pack('<{}I'.format(len(hashes)), *hashes))
+            # descriptors only used by events dropped as duplicate start times aren't written
+            descriptor_hashes = sorted(descriptor_hash for descriptor_hash, (descriptor, reference_count)
+                                       in self._descriptors.iteritems() if reference_count)
+            f.write(struct.pack('<i', len(descriptor_hashes)))
+            for descriptor_hash in descriptor_hashes:
+                descriptor, reference_count = self._descriptors[descriptor_hash]
+                f.write(struct.pack('<Ii', descriptor_hash, reference_count))
+                f.write(descriptor)
+        os.rename(tmp_filename, filename)
+
+
+def read_epgdat(filename):
+    """Read an epg.dat written by EpgDatWriter (or Enigma2)
+    returns {(sid, onid, tsid): [(start, duration, title, description), ...]}
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, version, service_count = struct.unpack_from('<I13si', data, 0)
+    if magic != EPGDAT_MAGIC or version != EPGDAT_VERSION:
+        raise ValueError('Not an {} epg.dat file'.format(EPGDAT_VERSION))
+    pos = 21
+    services = []
+    for i in xrange(service_count):
+        sid, onid, tsid, event_count = struct.unpack_from('<iiii', data, pos)
+        pos += 16
+        events = []
+        for j in xrange(event_count):
+            event_type, length = struct.unpack_from('<BB', data, pos)
+            pos += 2
+            header = struct.unpack_from('>HH6B', data, pos)
+            hashes = struct.unpack_from('<{}I'.format((length - 10) // 4), data, pos + 10)
+            pos += length
+            start = (header[1] - MJD_EPOCH) * 86400 + from_bcd(header[2]) * 3600 + from_bcd(header[3]) * 60 + \
+                from_bcd(header[4])
+            duration = from_bcd(header[5]) * 3600 + from_bcd(header[6]) * 60 + from_bcd(header[7])
+            events.append((start, duration, hashes))
+        services.append(((sid, onid, tsid), events))
+
+    descriptors = {}
+    descriptor_count = struct.unpack_from('<i', data, pos)[0]
+    pos += 4
+    for i in xrange(descriptor_count):
+        descriptor_hash, reference_count = struct.unpack_from('<Ii', data, pos)
+        pos += 8
+        length = ord(data[pos + 1]) + 2
+        descriptors[descriptor_hash] = data[pos:pos + length]
+        pos += length
+
+    result = OrderedDict()
+    for key, events in services:
+        result[key] = []
+        for start, duration, hashes in events:
+            title = u''
+            description = u''
+            for descriptor_hash in hashes:
+                descriptor = descriptors[descriptor_hash]
+                if descriptor[0] == '\x4d':
+                    title = get_dvb_text(descriptor[6:6 + ord(descriptor[5])])
+                elif descriptor[0] == '\x4e':
+                    description += get_dvb_text(descriptor[8:8 + ord(descriptor[7])])
+            result[key].append((start, duration, title, description))
+    return result
+
+
+def get_epgdat_service_key(service_ref):
+    """(sid, onid, tsid) Enigma2 keys the EPG cache on for a service ref
+    """
+    fields = service_ref.split(':')
+    try:
+        return int(fields[3], 16), int(fields[5], 16), int(fields[4], 16)
+    except (IndexError, ValueError):
+        return None
+
+
+def open_xmltv_file(filename):
+    with open(filename, 'rb') as f:
+        start = f.read(6)
+    if start.startswith('\x1f\x8b'):
+        return gzip.open(filename, 'rb')
+    if start.startswith('\xfd7zXZ'):
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise IOError('xz compressed XMLTV needs the lzma module')
+        return lzma.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def load_xmltv_events(xmltv_file, mappings, writer):
+    """Stream parse an XMLTV file adding the programmes of the mapped channels to an EpgDatWriter
+    mappings is lower case channel id -> set of service keys
+    """
+    now = int(time.time())
+    f = open_xmltv_file(xmltv_file)
+    try:
+        context = ET.iterparse(f, events=('start', 'end'))
+        event, root = next(context)
+        for event, elem in context:
+            if event != 'end' or elem.tag != 'programme':
+                continue
+            service_keys = mappings.get((elem.get('channel') or '').lower())
+            if service_keys:
+                try:
+                    start = parse_xmltv_time(elem.get('start'))
+                    stop = parse_xmltv_time(elem.get('stop')) if elem.get('stop') else start
+                except (AttributeError, ValueError):
+                    start = stop = None
+                if start is not None and stop > now and stop > start:
+                    writer.add_event(service_keys, start, stop - start, elem.findtext('title') or u'',
+                                     elem.findtext('desc') or u'')
+            # programmes are handled one at a time so memory use doesn't grow with the feed
+            root.clear()
+    finally:
+        f.close()
+
+
+def write_epgdat(run_context, filename):
+    """Write the EPG of every provider processed this run straight into Enigma2's epg.dat
+    the XMLTV feeds are downloaded once per run
+    """
+    print('\n----Writing epg.dat----')
+    writer = EpgDatWriter()
+    for url, mappings in run_context.epg_sources.iteritems():
+        xmltv_file = run_context.xmltv_files.get(url)
+        if xmltv_file is None:
+            xmltv_file = os.path.join(tempfile.gettempdir(),
+                                      'e2m3u2bouquet-{}.xmltv'.format(hashlib.md5(url).hexdigest()[:8]))
+            try:
+                download_file(url, xmltv_file)
+            except Exception, e:
+                print('Unable to download XMLTV {} ({})'.format(url, e))
+                xmltv_file = ''
+            run_context.xmltv_files[url] = xmltv_file
+        if xmltv_file:
+            try:
+                load_xmltv_events(xmltv_file, mappings, writer)
+            except Exception, e:
+                print('Unable to read XMLTV {} ({})'.format(url, e))
+    run_context.epg_sources = OrderedDict()
+
+    directory = os.path.dirname(filename)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    writer.write(filename)
+    print('{} events written to {}'.format(writer.event_count(), filename))
+
+    reload_epg()
 
 
 class Provider:
-    def __init__(self, config):
+    def __init__(self, config, run_context=None):
         self._panel_bouquet_file = ''
         self._panel_bouquet = {}
         self._m3u_file = None
         self._category_order = []
         self._category_options = {}
         self._dictchannels = OrderedDict()
+        # stream url -> first service parsed with it
+        self._streams = {}
         self._xmltv_sources_list = None
+        self._override_model = None
+        self._override_model_loaded = False
+        self._channel_rules = None
+        self._pruned_categories = set()
+        self._pruned_keep_channels = set()
+        self._prune_vod = False
+        self._vod_pruned = False
+        self._deadlines = {}
+        self._channel_index = None
+        # RunJournal of a normal run (build server and watch mode runs aren't resumed)
+        self._journal = None
+        # list collecting the parsed services instead of adding them (see fetch_services)
+        self._parsed_services = None
+        # without a run context the provider is a run of its own and commits its output itself
+        self._own_run = run_context is None
+        self._run = run_context if run_context is not None else RunContext()
         self.config = config
 
     def _download_picon_file(self, channel):
@@ -274,9 +2459,16 @@ class Provider:
                 logo_url = 'http://{}'.format(logo_url)
             piconname = self._get_picon_name(channel)
             picon_file_path = os.path.join(self.config.icon_path, piconname)
+            with self._run.picon_lock:
+                if picon_file_path in self._run.picon_files:
+                    # already handled (for this or another provider) during this run
+                    return
+                self._run.picon_files.add(picon_file_path)
             existingpicon = filter(os.path.isfile, glob.glob(picon_file_path + '*'))
 
             if not existingpicon:
+                with self._run.picon_lock:
+                    self._run.new_picons.setdefault(os.path.normpath(self.config.icon_path), set()).add(piconname)
                 if DEBUG:
                     print("Picon file doesn't exist downloading")
                     print('PiconURL: {}'.format(logo_url))
@@ -286,23 +2478,52 @@ class Provider:
                         # don't output when called from the plugin
                         sys.stdout.write('.')
                         sys.stdout.flush()
+                if logo_url in self._run.logo_picons:
+                    # logo already fetched for another picon name this run
+                    self._picon_copy(self._run.logo_picons[logo_url], picon_file_path)
+                    return
                 try:
-                    response = urllib.urlopen(logo_url)
-                    info = response.info()
-                    response.close()
-                    if info.maintype == 'image':
-                        urllib.urlretrieve(logo_url, picon_file_path)
-                    else:
+                    deadline = PICON_DOWNLOAD_DEADLINE
+                    time_left = self._time_left('picons')
+                    if time_left is not None:
+                        deadline = min(deadline, time_left)
+                    info = download_file(logo_url, picon_file_path, retries=1, deadline=deadline,
+                                         content_check=lambda info: info.maintype == 'image')
+                    if info is None:
                         if DEBUG:
                             print('Download Picon - not an image, skipping')
                         self._picon_create_empty(picon_file_path)
+                        self._run.logo_picons[logo_url] = ''
                         return
                 except Exception, e:
                     if DEBUG:
                         print('Download picon urlopen error', e)
                     self._picon_create_empty(picon_file_path)
+                    self._run.logo_picons[logo_url] = ''
                     return
                 self._picon_post_processing(picon_file_path)
+                self._run.logo_picons[logo_url] = self._get_picon_file(picon_file_path)
+            else:
+                self._run.logo_picons.setdefault(logo_url, self._get_picon_file(picon_file_path))
+
+    def _get_picon_file(self, picon_file_path):
+        """Return the picon image for picon_file_path or '' if there is only an empty marker
+        """
+        picon_files = [f for f in glob.glob(picon_file_path + '.*') if not f.endswith('.None')]
+        return picon_files[0] if picon_files else ''
+
+    def _picon_copy(self, source_file, picon_file_path):
+        """Create picon from a logo already downloaded under another picon name
+        """
+        if not source_file:
+            self._picon_create_empty(picon_file_path)
+            return
+        try:
+            shutil.copyfile(source_file, picon_file_path + os.path.splitext(source_file)[1])
+        except Exception, e:
+            if DEBUG:
+                print('Picon copy error', e)
+            self._picon_create_empty(picon_file_path)
 
     def _picon_create_empty(self, picon_file_path):
         """
@@ -353,15 +2574,18 @@ class Provider:
         """Convert the service name to a Picon Service Name
         """
         service_title = get_service_title(channel)
-        name = service_title
-
-        if type(name) is unicode:
-            name = name.encode('utf-8')
-        name = unicodedata.normalize('NFKD', unicode(name, 'utf_8', errors='ignore')).encode('ASCII', 'ignore')
-        name = re.sub('[\W]', '', name.replace('&', 'and')
-                      .replace('+', 'plus')
-                      .replace('*', 'star')
-                      .lower())
+        name = self._run.picon_names.get(service_title)
+
+        if name is None:
+            name = service_title
+            if type(name) is unicode:
+                name = name.encode('utf-8')
+            name = unicodedata.normalize('NFKD', unicode(name, 'utf_8', errors='ignore')).encode('ASCII', 'ignore')
+            name = re.sub('[\W]', '', name.replace('&', 'and')
+                          .replace('+', 'plus')
+                          .replace('*', 'star')
+                          .lower())
+            self._run.picon_names[service_title] = name
         if not name:
             # use SRP instead of SNP if name can't be used
             name = channel['serviceRef'].replace(':', '_').upper()
@@ -392,16 +2616,23 @@ class Provider:
 
     def _set_streamtypes_vodcats(self, service_dict):
         """Set the stream types and VOD categories
+        The type comes from the stream url unless the service came from a panel api endpoint for one type
         """
-        parsed_stream_url = urlparse.urlparse(service_dict['stream-url'])
-        root, ext = os.path.splitext(parsed_stream_url.path)
+        api_category_type = service_dict.pop('api_category_type', None)
+        if api_category_type is not None:
+            is_live = api_category_type == 'live'
+        else:
+            parsed_stream_url = urlparse.urlparse(service_dict['stream-url'])
+            root, ext = os.path.splitext(parsed_stream_url.path)
 
-        # check for vod streams ending .*.m3u8 e.g. 2345.mp4.m3u8
-        is_m3u8_vod = re.search('\.[^/]+\.m3u8$', parsed_stream_url.path)
+            # check for vod streams ending .*.m3u8 e.g. 2345.mp4.m3u8
+            is_m3u8_vod = re.search('\.[^/]+\.m3u8$', parsed_stream_url.path)
 
-        if (parsed_stream_url.path.endswith('ts') or parsed_stream_url.path.endswith('.m3u8')) \
+            is_live = (parsed_stream_url.path.endswith('ts') or parsed_stream_url.path.endswith('.m3u8')) \
                 or not ext \
-                and not is_m3u8_vod:
+                and not is_m3u8_vod
+
+        if is_live:
             service_dict['stream-type'] = '4097' if self.config.iptv_types else '1'
             if self.config.streamtype_tv:
                 # Set custom TV stream type if supplied - this overrides all_iptv_stream_types
@@ -415,42 +2646,23 @@ class Provider:
         """Check for bouquets within mapping override file and applies if found
         """
         category_order = []
-        mapping_file = self._get_mapping_file()
-        if mapping_file:
+        override_model = self._get_override_model()
+        if override_model:
             self._update_status('----Parsing custom bouquet order----')
             print('\n'.format(Status.message))
 
-            try:
-                tree = ET.ElementTree(file=mapping_file)
-                for node in tree.findall(".//category"):
-                    dictoption = {}
-
-                    category = node.attrib.get('name')
-                    if not type(category) is unicode:
-                        category = category.decode("utf-8")
-                    cat_title_override = node.attrib.get('nameOverride', '')
-                    if not type(cat_title_override) is unicode:
-                        cat_title_override = cat_title_override.decode("utf-8")
-                    dictoption['nameOverride'] = cat_title_override
-                    dictoption['enabled'] = node.attrib.get('enabled', True) == 'true'
-                    category_order.append(category)
-
-                    # If this category is marked as custom and doesn't exist in self._dictchannels then add
-                    is_custom_category = node.attrib.get('customCategory', False) == 'true'
-                    if is_custom_category:
-                        dictoption['customCategory'] = True
-                        if category not in self._dictchannels:
-                            self._dictchannels[category] = []
-
-                    self._category_options[category] = dictoption
-
-                self._update_status('custom bouquet order applied...')
-                print(Status.message)
-            except Exception, e:
-                msg = 'Corrupt override.xml file'
-                print(msg)
-                if DEBUG:
-                    raise msg
+            for category in override_model.category_order:
+                dictoption = dict(override_model.category_options[category])
+                category_order.append(category)
+
+                # If this category is marked as custom and doesn't exist in self._dictchannels then add
+                if dictoption.get('customCategory') and category not in self._dictchannels:
+                    self._dictchannels[category] = []
+
+                self._category_options[category] = dictoption
+
+            self._update_status('custom bouquet order applied...')
+            print(Status.message)
 
         return category_order
 
@@ -475,13 +2687,12 @@ class Provider:
     def _parse_map_channels_xml(self):
         """Check for channels within mapping override file and apply if found
         """
-        mapping_file = self._get_mapping_file()
-        if mapping_file:
+        override_model = self._get_override_model()
+        if override_model:
             self._update_status('----Parsing custom channel order, please be patient----')
             print('\n{}'.format(Status.message))
 
             try:
-                tree = ET.ElementTree(file=mapping_file)
                 i = 0
                 for cat in self._dictchannels:
                     if self._category_options[cat].get('type', 'live') == 'live':
@@ -490,9 +2701,9 @@ class Provider:
                         listchannels = []
 
                         # find channels that are to be moved to this category (categoryOverride)
-                        for node in tree.findall(u'.//channel[@categoryOverride="{}"]'.format(cat)):
-                            node_name = node.attrib.get('name')
-                            category = node.attrib.get('category')
+                        for node in override_model.channels_by_category_override.get(cat, []):
+                            node_name = node.get('name')
+                            category = node.get('category')
                             channel_index = None
 
                             # get index of channel in the current category
@@ -509,9 +2720,9 @@ class Provider:
                         for x in self._dictchannels[cat]:
                             listchannels.append(x['stream-name'])
 
-                        for node in tree.findall(u'.//channel[@category="{}"]'.format(cat)):
+                        for node in override_model.channels_by_category.get(cat, []):
                             # Check for placeholders, give unique name, insert into sorted channels and dictchannels[cat]
-                            node_name = node.attrib.get('name')
+                            node_name = node.get('name')
 
                             if node_name == 'placeholder':
                                 node_name = 'placeholder_' + str(i)
@@ -531,11 +2742,10 @@ class Provider:
                 print(Status.message)
 
                 # apply overrides
-                channel_nodes = tree.iter('channel')
-                for override_channel in channel_nodes:
-                    name = override_channel.attrib.get('name')
-                    category = override_channel.attrib.get('category')
-                    category_override = override_channel.attrib.get('categoryOverride')
+                for override_channel in override_model.channels:
+                    name = override_channel.get('name')
+                    category = override_channel.get('category')
+                    category_override = override_channel.get('categoryOverride')
                     channel_index = None
                     channels_list = None
 
@@ -555,18 +2765,18 @@ class Provider:
                     if channels_list is not None and name != 'placeholder':
                         for x in channels_list:
                             if x['stream-name'] == name:
-                                if override_channel.attrib.get('enabled') == 'false':
+                                if override_channel.get('enabled') == 'false':
                                     x['enabled'] = False
-                                x['nameOverride'] = override_channel.attrib.get('nameOverride', '')
-                                x['categoryOverride'] = override_channel.attrib.get('categoryOverride', '')
+                                x['nameOverride'] = override_channel.get('nameOverride', '')
+                                x['categoryOverride'] = override_channel.get('categoryOverride', '')
                                 # default to current values if attribute doesn't exist
-                                x['tvg-id'] = override_channel.attrib.get('tvg-id', x['tvg-id'])
-                                if override_channel.attrib.get('serviceRef', None) and self.config.sref_override:
-                                    x['serviceRef'] = override_channel.attrib.get('serviceRef', x['serviceRef'])
+                                x['tvg-id'] = override_channel.get('tvg-id', x['tvg-id'])
+                                if override_channel.get('serviceRef', None) and self.config.sref_override:
+                                    x['serviceRef'] = override_channel.get('serviceRef', x['serviceRef'])
                                     x['serviceRefOverride'] = True
                                 # streamUrl no longer output to xml file but we still check and process it
-                                x['stream-url'] = override_channel.attrib.get('streamUrl', x['stream-url'])
-                                clear_stream_url = override_channel.attrib.get('clearStreamUrl') == 'true'
+                                x['stream-url'] = override_channel.get('streamUrl', x['stream-url'])
+                                clear_stream_url = override_channel.get('clearStreamUrl') == 'true'
                                 if clear_stream_url:
                                     x['stream-url'] = ''
                                 break
@@ -590,6 +2800,23 @@ class Provider:
                 break;
         return mapping_file
 
+    def _get_override_model(self):
+        """Load the override file once per run (or from the on disk cache if unchanged)
+        """
+        if not self._override_model_loaded:
+            self._override_model_loaded = True
+            mapping_file = self._get_mapping_file()
+            if mapping_file:
+                cache_file = os.path.join(CFGPATH, self._get_safe_provider_filename() + '-sort-override.cache')
+                try:
+                    self._override_model = load_override_model(mapping_file, cache_file)
+                except Exception, e:
+                    msg = 'Corrupt override.xml file'
+                    print(msg)
+                    if DEBUG:
+                        raise Exception(msg)
+        return self._override_model
+
     def _save_bouquet_entry(self, f, channel):
         """Add service to bouquet file
         """
@@ -606,37 +2833,12 @@ class Provider:
 
     def _save_bouquet_index_entries(self, iptv_bouquets):
         """Add to the main bouquets.tv file
+        bouquets.tv is written when the run's output is committed, merged with the other providers entries
         """
-        # get current bouquets indexes
-        current_bouquet_indexes = self._get_current_bouquet_indexes()
-
         if iptv_bouquets:
-            with open(os.path.join(ENIGMAPATH, 'bouquets.tv'), 'w') as f:
-                f.write('#NAME Bouquets (TV)\n')
-                if self.config.bouquet_top:
-                    for bouquet in iptv_bouquets:
-                        f.write(bouquet)
-                    for bouquet in current_bouquet_indexes:
-                        f.write(bouquet)
-                else:
-                    for bouquet in current_bouquet_indexes:
-                        f.write(bouquet)
-                    for bouquet in iptv_bouquets:
-                        f.write(bouquet)
-
-    def _get_current_bouquet_indexes(self):
-        """Get all the bouquet indexes except this provider
-        """
-        current_bouquets_indexes = []
-
-        with open(os.path.join(ENIGMAPATH, 'bouquets.tv'), 'r') as f:
-            for line in f:
-                if line.startswith('#NAME'):
-                    continue
-                else:
-                    if not '.suls_iptv_{}'.format(self._get_safe_provider_filename()) in line:
-                        current_bouquets_indexes.append(line)
-        return current_bouquets_indexes
+            self._run.output.add_bouquet_indexes(os.path.join(ENIGMAPATH, 'bouquets.tv'),
+                                                 self._get_safe_provider_filename(), iptv_bouquets,
+                                                 self.config.bouquet_top)
 
     def _create_all_channels_bouquet(self):
         """Create the Enigma2 all channels bouquet
@@ -655,7 +2857,7 @@ class Provider:
         if DEBUG:
             print("Creating: {}".format(bouquet_filepath))
 
-        with open(bouquet_filepath, 'w+') as f:
+        with open(self._run.output.path(bouquet_filepath), 'w+') as f:
             f.write('#NAME {} - {}\n'.format(self.config.name.encode('utf-8'), bouquet_name.encode('utf-8')))
 
             # write place holder channels (for channel numbering)
@@ -695,17 +2897,17 @@ class Provider:
         provider_safe_filename = self._get_safe_provider_filename()
         source_name = '{} - {}'.format(provider_safe_filename, group) if group else provider_safe_filename
 
-        channels_filename = os.path.join(EPGIMPORTPATH, 'suls_iptv_{}_channels.xml'.format(provider_safe_filename))
+        channels_filename = self._get_epg_channels_filename()
 
         # write providers epg feed
         source_filename = os.path.join(EPGIMPORTPATH, 'suls_iptv_{}.sources.xml'
                                        .format(get_safe_filename(source_name)))
 
-        with open(os.path.join(EPGIMPORTPATH, source_filename), "w+") as f:
+        with open(self._run.output.path(source_filename), "w+") as f:
             f.write('<sources>\n')
             f.write('{}<sourcecat sourcecatname="IPTV Bouquet Maker - E2m3u2bouquet">\n'.format(indent))
             f.write('{}<source type="gen_xmltv" nocheck="1" channels="{}">\n'
-                    .format(2 * indent, channels_filename))
+                    .format(2 * indent, get_box_path(channels_filename)))
             f.write('{}<description>{}</description>\n'.format(3 * indent, xml_escape(source_name.encode('utf-8'))))
             for source in sources:
                 f.write('{}<url><![CDATA[{}]]></url>\n'.format(3 * indent, source))
@@ -713,6 +2915,75 @@ class Provider:
             f.write('{}</sourcecat>\n'.format(indent))
             f.write('</sources>\n')
 
+    def _get_epg_channels_filename(self, gzipped=None):
+        if gzipped is None:
+            gzipped = self.config.epg_gzip
+        return os.path.join(EPGIMPORTPATH, 'suls_iptv_{}_channels.xml{}'.format(
+            self._get_safe_provider_filename(), '.gz' if gzipped else ''))
+
+    def _write_epg_channels_file(self, channels_filename, content):
+        """Write the channels file unless it already has this content
+        a hash of the content is kept alongside it so it doesn't need reading back
+        """
+        md5_filename = channels_filename + '.md5'
+        content_md5 = hashlib.md5(content).hexdigest()
+        if os.path.isfile(channels_filename) and os.path.isfile(md5_filename):
+            with open(md5_filename, 'r') as f:
+                if f.read().strip() == content_md5:
+                    if DEBUG:
+                        print('EPG channels file unchanged')
+                    return
+
+        with open(self._run.output.path(channels_filename), 'wb') as f:
+            if channels_filename.endswith('.gz'):
+                # fixed mtime so the same channels always give the same file
+                with gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0) as gz:
+                    gz.write(content)
+            else:
+                f.write(content)
+        with open(self._run.output.path(md5_filename), 'w') as f:
+            f.write(content_md5)
+
+    def _get_epg_channel_line(self, tvg_id, epg_service_ref, service_title):
+        """Return the EPG-Importer channels.xml line for a tvg-id -> service ref mapping
+        identical mappings (e.g. the same upstream channel from several suppliers) are only rendered once per run
+        """
+        key = (tvg_id, epg_service_ref, service_title)
+        line = self._run.epg_channel_lines.get(key)
+        if line is None:
+            # the copies of a stream listed in several categories only differ by service ref
+            escaped = self._run.epg_channel_escaped.get((tvg_id, service_title))
+            if escaped is None:
+                escaped = self._run.epg_channel_escaped[(tvg_id, service_title)] = \
+                    (xml_escape(tvg_id.encode('utf-8')), xml_safe_comment(xml_escape(service_title.encode('utf-8'))))
+            line = '  <channel id="{}">{}:http%3a//example.m3u8</channel> <!-- {} -->\n'\
+                .format(escaped[0], epg_service_ref, escaped[1])
+            self._run.epg_channel_lines[key] = line
+        return line
+
+    def _get_service_ref_store(self):
+        """Load the persistent service refs for this provider (None if sqlite isn't available)
+        the refs then fall back to numbering the channels in each category in order
+        """
+        try:
+            return ServiceRefStore(os.path.join(CFGPATH, SERVICE_REF_DB_FILE), self.config.name)
+        except Exception, e:
+            if DEBUG:
+                print('Service ref store unavailable', e)
+            return None
+
+    def _get_url_credentials(self):
+        """The accounts username and password as they appear in stream url paths
+        """
+        credentials = set()
+        for value in (self.config.username, self.config.password):
+            if value:
+                if type(value) is unicode:
+                    value = value.encode('utf-8')
+                credentials.add(value)
+                credentials.add(urllib.quote(value))
+        return credentials
+
     def _get_category_id(self, cat):
         """Generate 32 bit category id to help make service refs unique"""
         return hashlib.md5(self.config.name.encode('utf-8') + cat.encode('utf-8')).hexdigest()[:8]
@@ -741,19 +3012,21 @@ class Provider:
 
         path = tempfile.gettempdir()
         filename = os.path.join(path, 'provider-{}-update.txt'.format(self.config.name))
+        self._deadlines['download'] = self._run.get_stage_deadline('download')
         self._update_status('----Downloading providers update file----')
         print('\n{}'.format(Status.message))
         print('provider update url = ', self.config.provider_update_url)
         try:
             context = ssl._create_unverified_context()
-            urllib.urlretrieve(self.config.provider_update_url, filename, context=context)
+            download_file(self.config.provider_update_url, filename, retries=0, context=context,
+                          deadline=self._download_deadline())
             downloaded = True
         except Exception:
             pass  # fallback to no ssl context
 
         if not downloaded:
             try:
-                urllib.urlretrieve(self.config.provider_update_url, filename)
+                download_file(self.config.provider_update_url, filename, deadline=self._download_deadline())
             except Exception, e:
                 print('[e2m3u2b] process_provider_update error. Type:', type(e))
                 print('[e2m3u2b] process_provider_update error: ', e)
@@ -787,7 +3060,150 @@ class Provider:
 
     def process_provider(self):
         Status.is_running = True
+        self._prepare_config()
+        # runs of selected stages don't take part in carrying on interrupted runs
+        self._journal = self._get_run_journal() if self._run.stages is None else None
+        if self._journal:
+            self._run.journals.append(self._journal)
+        try:
+            if not self._load_parsed_cache():
+                if self._run.stages is not None:
+                    self._update_status('No parsed channels saved for the current settings, downloading...')
+                    print('\n{}'.format(Status.message))
+                self._run_download_stages()
+                self._save_parsed_cache()
+            self._process_parsed_channels()
+        except Exception:
+            # only a killed run is carried on, one that failed would fail the same way again
+            if self._journal:
+                self._journal.complete()
+            raise
+        if self._journal:
+            # the run is over for this provider once its output is in place
+            self._run.output.on_commit(self._journal.complete)
+        if self._own_run:
+            self._run.output.commit()
+
+        if self._run.profiler is not None:
+            self._run.profiler.report(self)
 
+        Status.is_running = False
+
+    def fetch_services(self):
+        """Download and parse the playlist without applying the override file
+        returns the parsed services for render_services (build server mode)
+        """
+        Status.is_running = True
+        self._prepare_config()
+        self._parsed_services = []
+        self._run_download_stages()
+        services, self._parsed_services = self._parsed_services, None
+        Status.is_running = False
+        return services
+
+    def render_services(self, services, panel_bouquet=None):
+        """Create the bouquets and EPG config from services already fetched by another Provider
+        """
+        Status.is_running = True
+        self._panel_bouquet = panel_bouquet or {}
+        self._set_parse_filters()
+        for service_dict in services:
+            # shallow copy as parse_data adds its own keys to each service
+            self._add_service(dict(service_dict))
+        self._streams = {}
+        self._process_parsed_channels()
+        Status.is_running = False
+
+    def get_panel_bouquet(self):
+        return self._panel_bouquet
+
+    def get_mapping_file(self):
+        return self._get_mapping_file()
+
+    def get_channel_index_file(self):
+        return os.path.join(CFGPATH, self._get_safe_provider_filename() + '-channels.index')
+
+    def get_channel_index(self):
+        """Return the ChannelIndex of this providers channels, loading the one saved by the last run
+        if the channels haven't been processed here (None if there isn't one)
+        """
+        if self._channel_index is None:
+            self._channel_index = ChannelIndex.load(self.get_channel_index_file())
+        return self._channel_index
+
+    def index_channels(self):
+        """Build the channel index and save it with the mapping file
+        """
+        self._channel_index = ChannelIndex.from_channels(self._category_order, self._dictchannels)
+        try:
+            self._channel_index.save(self._run.output.path(self.get_channel_index_file()))
+        except Exception, e:
+            print('Unable to save channel index', e)
+
+    def _get_parse_key(self):
+        """Identifies the settings the parsed channels depend on
+        """
+        return hashlib.md5(repr((self.config.m3u_url, self.config.bouquet_url, self.config.xtream_api,
+                                 self.config.iptv_types, self.config.streamtype_tv, self.config.streamtype_vod,
+                                 self.config.rules, get_file_state(self._get_mapping_file())))).hexdigest()
+
+    def _get_run_journal(self):
+        """The journal of this providers run, carrying on from an interrupted run with the same settings
+        """
+        journal = RunJournal(os.path.join(CFGPATH, self._get_safe_provider_filename() + '-run.journal'),
+                             self._get_parse_key())
+        if journal.resumed:
+            self._update_status('Carrying on from the interrupted last run')
+            print('\n{}'.format(Status.message))
+        return journal
+
+    def _get_parsed_cache_file(self):
+        return os.path.join(CFGPATH, self._get_safe_provider_filename() + '-parsed.cache')
+
+    def _save_parsed_cache(self):
+        """Save the parsed channels (before the overrides are applied) for an interrupted run to carry on
+        from and for --stages runs, so they don't need to download and parse them again
+        """
+        if not self._dictchannels:
+            return
+        cache_file = self._get_parsed_cache_file()
+        try:
+            with open(cache_file + '.tmp', 'wb') as f:
+                pickle.dump({'key': self._get_parse_key(), 'dictchannels': self._dictchannels,
+                             'panel_bouquet': self._panel_bouquet, 'vod_pruned': self._vod_pruned},
+                            f, pickle.HIGHEST_PROTOCOL)
+            os.rename(cache_file + '.tmp', cache_file)
+            if self._journal:
+                self._journal.checkpoint('parse', cache_file)
+        except Exception, e:
+            print('Unable to save parsed channels', e)
+
+    def _load_parsed_cache(self):
+        """Load the parsed channels saved by the last run, a normal run only uses them to carry on from an
+        interrupted run. Returns False if there are none for the current settings
+        """
+        if self._journal:
+            cache_file = self._journal.get_file('parse')
+        else:
+            cache_file = self._get_parsed_cache_file()
+        if cache_file is None or not os.path.isfile(cache_file):
+            return False
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+        except Exception, e:
+            print('Unable to load parsed channels', e)
+            return False
+        if cached.get('key') != self._get_parse_key():
+            return False
+        self._dictchannels = cached['dictchannels']
+        self._panel_bouquet = cached['panel_bouquet']
+        self._vod_pruned = cached['vod_pruned']
+        self._update_status('Parsed channels loaded from the last run, download & parse skipped...')
+        print(Status.message)
+        return True
+
+    def _prepare_config(self):
         # Set epg to rytec if nothing else provided
         if self.config.epg_url is None:
             self.config.epg_url = "http://www.vuplus-community.net/rytec/rytecxmltv-UK.gz"
@@ -815,37 +3231,169 @@ class Provider:
                 self.config.bouquet_url = self.config.m3u_url[0:pos + 7] + '?username={}&password={}&type=dreambox&output=ts'.format(
                     urllib.quote_plus(self.config.username), urllib.quote_plus(self.config.password))
 
-        # Download panel bouquet
+    def _run_download_stages(self):
+        # The downloads don't depend on each other so run them concurrently, the panel bouquet
+        # and m3u are each parsed as soon as they have arrived
+        # (when profiling stages run one at a time so their memory use can be told apart)
+        stages = StageGraph(concurrent=self._run.profiler is None)
+        self._deadlines['download'] = self._run.get_stage_deadline('download')
         if self.config.bouquet_url:
-            self.download_panel_bouquet()
-
-        # Download m3u
-        self.download_m3u()
-
-        if self._has_m3u_file():
-            # parse m3u file
-            self.parse_m3u()
-
+            # Download (and parse) panel bouquet for the service refs, also when only some stages are run
+            # as the parsed channels are saved for the next runs and new refs are kept for good
+            stages.add('panel_bouquet', self._stage_func('panel_bouquet', self.download_panel_bouquet))
+        # Load override file while downloading
+        stages.add('override', self._stage_func('override', self._get_override_model))
+        # Download m3u (or load the channels from the panel api, which uses the override file)
+        stages.add('download_m3u', self._stage_func('download_m3u', self._download_playlist),
+                   requires=('override',) if self.config.xtream_api else ())
+        stages.add('parse_m3u', self._stage_func('parse_m3u', self._parse_downloaded_m3u),
+                   requires=('download_m3u', 'override'))
+        stages.run()
+
+    def _process_parsed_channels(self):
         if self._dictchannels:
-            self.parse_data()
+            self._run_stage('parse_data', self.parse_data)
 
-            self.parse_map_xmltvsources_xml()
+            self._run_stage('parse_map_xmltvsources_xml', self.parse_map_xmltvsources_xml)
             # save xml mapping - should be after m3u parsing
-            self.save_map_xml()
+            if self._run.stage_selected('mapxml'):
+                self._run_stage('save_map_xml', self.save_map_xml)
+
+            # Disable dead streams (after the mapping file so they aren't saved as disabled by the user)
+            # when the probe stage isn't selected the last results are still applied
+            if self.config.probe_streams:
+                self._run_stage('probe_streams', self.probe_streams, self._run.stage_selected('probe'))
+
+            # index for the plugins override editors, rebuilt whenever the channels are so it's never stale
+            self._run_stage('index_channels', self.index_channels)
 
             # Download picons
-            if self.config.picons:
-                self.download_picons()
+            if self.config.picons and self._run.stage_selected('picons') and \
+                    not (self._journal and self._journal.is_done('picons')):
+                self._run_stage('download_picons', self.download_picons)
             # Create bouquet files
-            self.create_bouquets()
+            if self._run.stage_selected('bouquets'):
+                self._run_stage('create_bouquets', self.create_bouquets)
             # Now create custom channels for each bouquet
-            self._update_status('----Creating EPG-Importer config ----')
+            if self._run.stage_selected('epg'):
+                self._update_status('----Creating EPG-Importer config ----')
+                print('\n{}'.format(Status.message))
+                self._run_stage('create_epgimporter_config', self.create_epgimporter_config)
+                self._update_status('EPG-Importer config created...')
+                print(Status.message)
+
+    def _time_left(self, stage):
+        """Seconds left of a stages budget (None if unlimited)
+        """
+        deadline = self._deadlines.get(stage)
+        return None if deadline is None else deadline - time.time()
+
+    def _download_deadline(self, deadline=DOWNLOAD_DEADLINE):
+        """Per request download deadline cut down to what is left of the download budget
+        """
+        time_left = self._time_left('download')
+        if time_left is None:
+            return deadline
+        if time_left <= 0:
+            raise DownloadError('download time budget used up', retry=False)
+        return min(deadline, time_left)
+
+    def _run_stage(self, stage, func, *args):
+        """Run a process_provider stage, recording its resource use in profile mode
+        """
+        if self._run.profiler is None:
+            return func(*args)
+        return self._run.profiler.run(self, stage, func, *args)
+
+    def _stage_func(self, stage, func):
+        return lambda: self._run_stage(stage, func)
+
+    def _download_playlist(self):
+        """Fetch the channel list from the panels JSON api if enabled, falling back to the m3u
+        """
+        if self.config.xtream_api and self.load_xtream_api():
+            return
+        m3u_file = self._journal.get_file('download') if self._journal else None
+        if m3u_file:
+            self._update_status('m3u file downloaded by the last run, download skipped...')
             print('\n{}'.format(Status.message))
-            self.create_epgimporter_config()
-            self._update_status('EPG-Importer config created...')
+            self._m3u_file = m3u_file
+            return
+        self.download_m3u()
+        if self._journal and self._m3u_file:
+            self._journal.checkpoint('download', self._m3u_file)
+
+    def load_xtream_api(self):
+        """Build the channel list from the Xtream Codes player_api.php instead of the m3u_plus playlist
+        VOD endpoints are skipped when VOD is disabled in the override file or excluded by the rules
+        """
+        api = XtreamApi.from_m3u_url(self.config.m3u_url, self.config.username, self.config.password)
+        if api is None:
+            return False
+        self._update_status('----Downloading channels from panel api----')
+        print('\n{}'.format(Status.message))
+
+        self._set_parse_filters()
+        rules = self._channel_rules
+        want_vod = not self._prune_vod and rules.allows_category_type('vod')
+        want_live = rules.allows_category_type('live')
+
+        results = {}
+        stages = StageGraph()
+        actions = ['get_live_categories', 'get_live_streams'] if want_live else []
+        if want_vod:
+            actions.extend(['get_vod_categories', 'get_vod_streams'])
+        for action in actions:
+            stages.add(action, lambda action=action: results.__setitem__(action, api.get(action)))
+        try:
+            account = api.get()
+            if not isinstance(account, dict) or str(account.get('user_info', {}).get('auth', 0)) != '1':
+                raise IOError('panel api login failed')
+            stages.run()
+        except Exception, e:
+            self._update_status('Unable to use panel api ({}), downloading m3u instead'.format(e))
             print(Status.message)
+            return False
+
+        for category_type in ('live', 'vod'):
+            categories = dict((str(cat.get('category_id')), cat.get('category_name') or u'')
+                              for cat in results.get('get_{}_categories'.format(category_type)) or [])
+            for stream in results.get('get_{}_streams'.format(category_type)) or []:
+                name = stream.get('name') or u''
+                attributes = {'tvg-id': stream.get('epg_channel_id') or u'',
+                              'tvg-name': name,
+                              'tvg-logo': stream.get('stream_icon') or u'',
+                              'group-title': categories.get(str(stream.get('category_id')), u'')}
+                if rules and not rules.allows_info(attributes, name):
+                    continue
+                service_dict = new_service_dict(attributes, name)
+                service_dict['stream-url'] = api.get_stream_url(stream, category_type).encode('utf-8')
+                # the url doesn't tell a VOD .ts movie from a live stream
+                service_dict['api_category_type'] = category_type
+                self._add_service(service_dict)
+        # only needed while the channels are added
+        self._streams = {}
+
+        self._update_status('panel api channels loaded...')
+        print(Status.message)
+        return True
 
-        Status.is_running = False
+    def _parse_downloaded_m3u(self):
+        if self._has_m3u_file():
+            # parse m3u file
+            self._deadlines['parse'] = self._run.get_stage_deadline('parse')
+            try:
+                self.parse_m3u()
+            except StageTimeout:
+                # abort this provider, the bouquets from the last run are left as they are
+                self._dictchannels = OrderedDict()
+                self._streams = {}
+                if self._parsed_services is not None:
+                    del self._parsed_services[:]
+                self._update_status('Parsing m3u ran out of time, skipping provider')
+                print(Status.message)
+                if os.path.isfile(self._m3u_file):
+                    os.remove(self._m3u_file)
 
     def provider_update(self):
         if self.config.provider_update_url and self.config.username and self.config.password:
@@ -862,9 +3410,9 @@ class Provider:
         if DEBUG:
             print("m3uurl = {}".format(self.config.m3u_url))
         try:
-            urllib.urlretrieve(self.config.m3u_url, filename)
+            download_file(self.config.m3u_url, filename, deadline=self._download_deadline())
         except Exception, e:
-            self._update_status('Unable to download m3u file from url')
+            self._update_status('Unable to download m3u file from url ({})'.format(e))
             print(Status.message)
             filename = None
         self._m3u_file = filename
@@ -892,74 +3440,94 @@ class Provider:
             if DEBUG:
                 raise
 
-        service_dict = {}
-        valid_services_found = False
-        service_valid = False
-
-        with open(self._m3u_file, "r") as f:
-            for line in f:
-                try:
-                    line.decode('utf-8')
-                except UnicodeDecodeError:
-                    # if can't parse as utf-8 encode back to ascii removing illegal chars
-                    line = line.decode('ascii', 'ignore').encode('ascii')
-                    # line = unicodedata.normalize('NFKD', unicode(line, 'utf_8', errors='ignore')).encode('ASCII', 'ignore')
-
-                if 'EXTM3U' in line or (line.startswith('#') and not line.startswith('#EXTINF')):  # First line or comments we are not interested
-                    continue
-                elif 'EXTINF:' in line:  # Info line - work out group and output the line
-                    service_valid = False
-                    service_dict = {'tvg-id': '', 'tvg-name': '', 'tvg-logo': '', 'group-title': '', 'stream-name': '',
-                                    'category_type': 'live', 'has_archive': False,
-                                    'stream-url': '', 'enabled': True, 'nameOverride': '', 'categoryOverride': '',
-                                    'serviceRef': '', 'serviceRefOverride': False
-                                    }
-                    if line.find('tvg-') == -1 and line.find('group-') == -1:
-                        if DEBUG:
-                            msg = "No extended playlist info found for this service'"
-                            print(msg)
-                        continue
-                    elif not valid_services_found:
-                        valid_services_found = True
-
-                    channel = line.split('"')
-                    # strip unwanted info at start of line
-                    pos = channel[0].find(' ')
-                    channel[0] = channel[0][pos:]
-
-                    # loop through params and build dict
-                    for i in xrange(0, len(channel) - 2, 2):
-                        service_dict[channel[i].lower().strip(' =')] = channel[i + 1].decode('utf-8')
-
-                    # Get the stream name from end of line (after comma)
-                    stream_name_pos = line.rfind('",')
-                    if stream_name_pos != -1:
-                        service_dict['stream-name'] = line[stream_name_pos + 2:].strip().decode('utf-8')
-
-                    # Set default name for any blank groups
-                    if service_dict['group-title'] == '':
-                        service_dict['group-title'] = u'None'
-                    service_valid = True
-                elif ('http:' in line or 'https:' in line or 'rtmp:' in line or 'rtsp:' in line) and service_valid is True:
-                    service_dict['stream-url'] = line.strip()
-                    self._set_streamtypes_vodcats(service_dict)
-
-                    if service_dict['group-title'] not in self._dictchannels:
-                        self._dictchannels[service_dict['group-title']] = [service_dict]
-                    else:
-                        self._dictchannels[service_dict['group-title']].append(service_dict)
-
-            if not valid_services_found:
-                msg = "No extended playlist info found. Check m3u url should be 'type=m3u_plus'"
-                print(msg)
-                if DEBUG:
-                    raise Exception(msg)
+        self._set_parse_filters()
+        encoding = detect_m3u_encoding(self._m3u_file)
+        if self._run.parse_workers > 1 and encoding != 'utf-16' and \
+                os.path.getsize(self._m3u_file) >= PARALLEL_PARSE_MIN_SIZE:
+            tokenizer = ParallelM3uTokenizer(self.config.rules, self._run.parse_workers)
+            self._add_services(tokenizer.services(self._m3u_file, encoding))
+        else:
+            tokenizer = M3uTokenizer(self._channel_rules)
+            # undecodable bytes are dropped rather than losing the whole line
+            with io.open(self._m3u_file, 'r', encoding=encoding, errors='ignore') as f:
+                self._add_services(tokenizer.services(f))
+        # only needed while the channels are added
+        self._streams = {}
+
+        if not tokenizer.valid_services_found:
+            msg = "No extended playlist info found. Check m3u url should be 'type=m3u_plus'"
+            print(msg)
+            if DEBUG:
+                raise Exception(msg)
 
         if not DEBUG:
             # remove m3u file
             if os.path.isfile(self._m3u_file):
                 os.remove(self._m3u_file)
 
+    def _set_parse_filters(self):
+        """Compile the providers rules and find the disabled override categories to prune while parsing
+        """
+        self._channel_rules = ChannelRules(self.config.rules)
+        self._pruned_categories = set()
+        self._pruned_keep_channels = set()
+        self._prune_vod = False
+
+        override_model = self._get_override_model()
+        if override_model:
+            for cat in override_model.category_order:
+                options = override_model.category_options[cat]
+                if not options.get('enabled') and not options.get('customCategory'):
+                    if cat == 'VOD':
+                        self._prune_vod = True
+                    else:
+                        self._pruned_categories.add(cat)
+            # keep channels that are moved out of a disabled category
+            for node in override_model.channels:
+                if node.get('categoryOverride'):
+                    self._pruned_keep_channels.add((node.get('category'), node.get('name')))
+
+    def _add_services(self, services):
+        deadline = self._deadlines.get('parse')
+        for i, service_dict in enumerate(services):
+            if deadline is not None and not i % 1000 and time.time() > deadline:
+                raise StageTimeout('parse')
+            self._add_service(service_dict)
+
+    def _add_service(self, service_dict):
+        """Add a parsed service to its category
+        """
+        if self._parsed_services is not None:
+            self._parsed_services.append(service_dict)
+            return
+        self._set_streamtypes_vodcats(service_dict)
+
+        if self._channel_rules and not self._channel_rules.allows_type(service_dict):
+            return
+        if service_dict['category_type'] == 'vod':
+            if self._prune_vod:
+                self._vod_pruned = True
+                return
+        elif service_dict['group-title'] in self._pruned_categories and \
+                (service_dict['group-title'], service_dict['stream-name']) not in self._pruned_keep_channels:
+            # disabled category - keep the (empty) category so it stays in the mapping file
+            self._dictchannels.setdefault(service_dict['group-title'], [])
+            return
+
+        first = self._streams.setdefault(service_dict['stream-url'], service_dict)
+        if first is not service_dict:
+            # the same stream listed again (e.g. in its country group and in "HD"), each copy keeps its own
+            # dict for its category but strings the same as the first copies are shared rather than held twice
+            for key in SHARED_SERVICE_FIELDS:
+                value = service_dict[key]
+                if value == first[key] and type(value) is type(first[key]):
+                    service_dict[key] = first[key]
+
+        if service_dict['group-title'] not in self._dictchannels:
+            self._dictchannels[service_dict['group-title']] = [service_dict]
+        else:
+            self._dictchannels[service_dict['group-title']].append(service_dict)
+
     def parse_data(self):
         # sort categories by custom order (if exists)
         sorted_categories = self._parse_map_bouquet_xml()
@@ -973,13 +3541,16 @@ class Provider:
         self._parse_map_channels_xml()
 
         # Add Service references
+        service_ref_store = self._get_service_ref_store()
 
+        credentials = self._get_url_credentials()
         for cat in self._category_order:
             num = 1
             if cat in self._dictchannels:
-                for x in self._dictchannels[cat]:
+                if service_ref_store is not None:
+                    stream_keys = get_stream_keys(self._dictchannels[cat], credentials)
+                for i, x in enumerate(self._dictchannels[cat]):
                     cat_id = self._get_category_id(cat)
-                    service_ref = "{:x}:{}:{}:0".format(num, cat_id[:4], cat_id[4:])
                     if not x['stream-name'].startswith('placeholder_'):
                         if self._panel_bouquet and not x.get('serviceRefOverride'):
                             # check if we have the panels custom service ref
@@ -991,13 +3562,22 @@ class Provider:
                                     x['serviceRef'] = "{}:{}".format(x['stream-type'],
                                                                      self._panel_bouquet[m3u_stream_file])
                                     continue
+                        if service_ref_store is not None:
+                            num = service_ref_store.get_num(cat, stream_keys[i])
                         if not x.get('serviceRefOverride'):
                             # if service ref is not overridden in xml update
+                            service_ref = "{:x}:{}:{}:0".format(num, cat_id[:4], cat_id[4:])
                             x['serviceRef'] = "{}:0:1:{}:0:0:0".format(x['stream-type'], service_ref)
                         num += 1
                     else:
                         x['serviceRef'] = PLACEHOLDER_SERVICE
 
+        if service_ref_store is not None:
+            try:
+                service_ref_store.save()
+            except Exception, e:
+                print('Unable to save service refs', e)
+
         vod_index = None
         if "VOD" in self._category_order:
             # if we have the vod category placeholder from the override use it otherwise
@@ -1047,15 +3627,43 @@ class Provider:
         if DEBUG:
             print("bouqueturl = {}".format(self.config.bouquet_url))
         try:
-            urllib.urlretrieve(self.config.bouquet_url, filename)
+            download_file(self.config.bouquet_url, filename, deadline=self._download_deadline())
         except Exception, e:
-            msg = 'Unable to download providers panel bouquet file'
+            msg = 'Unable to download providers panel bouquet file ({})'.format(e)
             print(msg)
             if DEBUG:
                 raise msg
         self._panel_bouquet_file = filename
         self._parse_panel_bouquet()
 
+    def probe_streams(self, check=True):
+        """Check the enabled live streams and disable the channels whose stream keeps failing
+        without check only the results of earlier checks are applied
+        """
+        self._update_status('----Checking streams, please be patient----')
+        print('\n{}'.format(Status.message))
+        channels = []
+        for cat in self._category_order:
+            if cat in self._dictchannels and self._category_options[cat].get('enabled', True) and \
+                    self._category_options[cat].get('type', 'live') == 'live':
+                for x in self._dictchannels[cat]:
+                    if x.get('enabled', True) and not x['stream-name'].startswith('placeholder_'):
+                        channels.append(x)
+
+        urls = [x['stream-url'] for x in channels]
+        prober = StreamProber(os.path.join(CFGPATH, self._get_safe_provider_filename() + '-probe.cache'),
+                              host_connections=self._run.probe_connections)
+        checked = prober.probe(urls, self._run.get_stage_deadline('probe')) if check else 0
+        disabled = 0
+        for x in channels:
+            if prober.is_dead(x['stream-url']):
+                x['enabled'] = False
+                disabled += 1
+        if check:
+            prober.save(urls)
+        self._update_status('Streams checked ({} new checks), {} dead channels disabled...'.format(checked, disabled))
+        print(Status.message)
+
     def download_picons(self):
         self._update_status('----Downloading Picon files, please be patient----')
         print('\n{}'.format(Status.message))
@@ -1066,13 +3674,108 @@ class Provider:
             if e.errno != errno.EEXIST:
                 raise
 
-        for cat in self._dictchannels:
-            if self._category_options[cat].get('type', 'live') == 'live':
-                # Download Picon if not VOD
+        # picons for the first enabled categories first, disabled channels get none
+        channels = []
+        streams = set()
+        # what this provider wants kept when the picon folder is cleaned up, the picons of every live channel
+        # so disabled channels (by hand or as dead streams) still have theirs when enabled again
+        claimed = set()
+        for cat in self._category_order:
+            if cat in self._dictchannels and self._category_options[cat].get('type', 'live') == 'live':
+                cat_enabled = self._category_options[cat].get('enabled', True)
+                # Download Picon if not VOD, once for a stream listed in several categories
                 for x in self._dictchannels[cat]:
-                    if not x['stream-name'].startswith('placeholder_'):
-                        self._download_picon_file(x)
-        self._update_status('Picons download completed...')
+                    if x['stream-name'].startswith('placeholder_'):
+                        continue
+                    if x['tvg-logo']:
+                        claimed.add(self._get_picon_name(x))
+                    if cat_enabled and x.get('enabled', True):
+                        stream = (x['stream-url'], get_service_title(x))
+                        if stream not in streams:
+                            streams.add(stream)
+                            channels.append(x)
+        self._run.picon_claims.setdefault(os.path.normpath(self.config.icon_path), {})[self.config.name] = claimed
+
+        # picons deferred or left unfinished by the last run go first
+        pending_file = os.path.join(CFGPATH, self._get_safe_provider_filename() + '-picons.pending')
+        pending = set()
+        if os.path.isfile(pending_file):
+            with open(pending_file, 'r') as f:
+                pending = set(line.rstrip('\n') for line in f)
+            if pending:
+                channels.sort(key=lambda x: self._get_picon_name(x) not in pending)
+
+        self._deadlines['picons'] = self._run.get_stage_deadline('picons')
+        background = []
+        if self._run.background_picons and len(channels) > PICON_PRIORITY_COUNT:
+            channels, background = channels[:PICON_PRIORITY_COUNT], channels[PICON_PRIORITY_COUNT:]
+
+        deferred = self._fetch_picons(channels)
+        if background and not deferred:
+            # listed as pending first so they are picked up first if the run is cut short
+            self._save_pending_picons(pending_file, self._get_missing_picon_names(background))
+            thread = threading.Thread(target=self._fetch_background_picons, args=(background, pending_file))
+            thread.daemon = True
+            thread.start()
+            self._run.background_threads.append(thread)
+            self._update_status('Priority picons downloaded, {} more downloading in the background...'
+                                .format(len(background)))
+            print('\n{}'.format(Status.message))
+            return
+        if background:
+            deferred.extend(self._get_missing_picon_names(background))
+        self._finish_picons(pending_file, deferred)
+
+    def _fetch_picons(self, channels, pending_file=None):
+        """Download the picons for channels in order until the picons time budget runs out
+        returns the names of the picons left to do. With pending_file the picons still to do are saved to it
+        every so often so an interrupted run carries on where it was
+        """
+        for i, x in enumerate(channels):
+            time_left = self._time_left('picons')
+            if time_left is not None and time_left <= 0:
+                return self._get_missing_picon_names(channels[i:])
+            if pending_file and i and not i % PICON_PENDING_SAVE_INTERVAL:
+                self._save_pending_picons(pending_file, self._get_missing_picon_names(channels[i:]))
+            self._download_picon_file(x)
+        return []
+
+    def _fetch_background_picons(self, channels, pending_file):
+        try:
+            self._finish_picons(pending_file, self._fetch_picons(channels, pending_file))
+        except Exception, e:
+            print('Background picon download error', e)
+
+    def _get_missing_picon_names(self, channels):
+        """Picon names for the channels with a logo that don't have a picon file yet
+        """
+        existing = set()
+        if os.path.isdir(self.config.icon_path):
+            existing = set(os.path.splitext(f)[0] for f in os.listdir(self.config.icon_path))
+        names = []
+        for x in channels:
+            piconname = self._get_picon_name(x)
+            if x['tvg-logo'] and piconname not in existing:
+                existing.add(piconname)
+                names.append(piconname)
+        return names
+
+    def _save_pending_picons(self, pending_file, piconnames):
+        with open(pending_file + '.tmp', 'w') as f:
+            for piconname in piconnames:
+                f.write('{}\n'.format(piconname))
+        os.rename(pending_file + '.tmp', pending_file)
+
+    def _finish_picons(self, pending_file, deferred):
+        if deferred:
+            self._save_pending_picons(pending_file, deferred)
+            self._update_status('Picons download ran out of time, {} deferred to next run...'.format(len(deferred)))
+        else:
+            if os.path.isfile(pending_file):
+                os.remove(pending_file)
+            if self._journal:
+                self._journal.checkpoint('picons')
+            self._update_status('Picons download completed...')
         print('\n{}'.format(Status.message))
         print('Box will need restarted for Picons to show...')
 
@@ -1080,21 +3783,10 @@ class Provider:
         """Check for a mapping override file and parses it if found
         """
         self._xmltv_sources_list = {}
-        mapping_file = self._get_mapping_file()
-        if mapping_file:
-            try:
-                tree = ET.ElementTree(file=mapping_file)
-                for group in tree.findall('.//xmltvextrasources/group'):
-                    group_name = group.attrib.get('id')
-                    urllist = []
-                    for url in group:
-                        urllist.append(url.text)
-                    self._xmltv_sources_list[group_name] = urllist
-            except Exception, e:
-                msg = 'Corrupt override.xml file'
-                print(msg)
-                if DEBUG:
-                    raise msg
+        override_model = self._get_override_model()
+        if override_model:
+            for group_name, urllist in override_model.xmltv_sources.iteritems():
+                self._xmltv_sources_list[group_name] = list(urllist)
 
     def save_map_xml(self):
         """Create mapping file"""
@@ -1103,7 +3795,7 @@ class Provider:
         vod_category_output = False
 
         if self._dictchannels:
-            with open(mappingfile, "wb") as f:
+            with open(self._run.output.path(mappingfile), "wb") as f:
                 f.write('<!--\r\n')
                 f.write('{} E2m3u2bouquet Custom mapping file\r\n'.format(indent))
                 f.write('{} Rearrange bouquets or channels in the order you wish\r\n'.format(indent))
@@ -1203,18 +3895,12 @@ class Provider:
                                             ))
                         elif not vod_category_output:
                             # Replace multivod categories with single VOD placeholder
-                            cat_title_override = ''
-                            cat_enabled = True
-                            if 'VOD' in self._category_options:
-                                cat_title_override = self._category_options['VOD'].get('nameOverride', '')
-                                cat_enabled = self._category_options['VOD'].get('enabled', True)
-                            f.write('{}<category name="{}" nameOverride="{}" enabled="{}" />\r\n'
-                                    .format(2 * indent,
-                                            'VOD',
-                                            xml_escape(cat_title_override).encode('utf-8'),
-                                            str(cat_enabled).lower()
-                                            ))
+                            self._save_vod_category_mapping(f, indent)
                             vod_category_output = True
+                    elif cat == 'VOD' and self._vod_pruned and not vod_category_output:
+                        # VOD was disabled in the override so no VOD categories were parsed
+                        self._save_vod_category_mapping(f, indent)
+                        vod_category_output = True
 
                 f.write('{}</categories>\r\n'.format(indent))
 
@@ -1248,16 +3934,31 @@ class Provider:
                 f.write('{}</channels>\r\n'.format(indent))
                 f.write('</mapping>')
 
+    def _save_vod_category_mapping(self, f, indent):
+        """Write the single VOD placeholder category to the mapping file
+        """
+        cat_title_override = ''
+        cat_enabled = True
+        if 'VOD' in self._category_options:
+            cat_title_override = self._category_options['VOD'].get('nameOverride', '')
+            cat_enabled = self._category_options['VOD'].get('enabled', True)
+        f.write('{}<category name="{}" nameOverride="{}" enabled="{}" />\r\n'
+                .format(2 * indent,
+                        'VOD',
+                        xml_escape(cat_title_override).encode('utf-8'),
+                        str(cat_enabled).lower()
+                        ))
+
     def create_bouquets(self):
         """Create the Enigma2 bouquets
         """
         self._update_status('----Creating bouquets----')
         print('\n{}'.format(Status.message))
-        # clean old bouquets before writing new
+        # old bouquets are removed when the new ones are committed
         if self._dictchannels:
             for fname in os.listdir(ENIGMAPATH):
                 if 'userbouquet.suls_iptv_{}'.format(self._get_safe_provider_filename()) in fname:
-                    os.remove(os.path.join(ENIGMAPATH, fname))
+                    self._run.output.remove(os.path.join(ENIGMAPATH, fname))
         iptv_bouquet_list = []
 
         if self.config.all_bouquet:
@@ -1290,7 +3991,7 @@ class Provider:
                     print("Creating: {}".format(bouquet_filepath))
 
                 if cat not in vod_categories or self.config.multi_vod:
-                    with open(bouquet_filepath, "w+") as f:
+                    with open(self._run.output.path(bouquet_filepath), "w+") as f:
                         bouquet_name = '{} - {}'.format(self.config.name.encode('utf-8'), cat_title.encode('utf-8')).decode("utf-8")
                         if self._category_options[cat].get('type', 'live') == 'live':
                             if cat in self._category_options and self._category_options[cat].get('nameOverride', False):
@@ -1318,34 +4019,47 @@ class Provider:
                             f.write('{}\n'.format(PLACEHOLDER_SERVICE))
                             channel_num += 1
                 elif not vod_category_output and not self.config.multi_vod:
-                    # not multivod - output all the vod services in one file
-                    with open(bouquet_filepath, "w+") as f:
-                        bouquet_name = '{} - VOD'.format(self.config.name).decode("utf-8")
-                        if 'VOD' in self._category_options and self._category_options['VOD'].get('nameOverride', False):
-                            bouquet_name = self._category_options['VOD']['nameOverride'].decode('utf-8')
-
-                        channel_num = 0
-                        f.write("#NAME {}\n".format(bouquet_name.encode("utf-8")))
-                        if not channel_number_start_offset_output and not self.config.all_bouquet:
-                            # write place holder services (for channel numbering)
-                            for i in xrange(100):
-                                f.write('{}\n'.format(PLACEHOLDER_SERVICE))
-                            channel_number_start_offset_output = True
-                            channel_num += 1
+                    # not multivod - output all the vod services in one file (or size capped shards)
+                    vod_shards = self._get_vod_shards(vod_categories)
+                    for shard_num, (shard_title, shard) in enumerate(vod_shards):
+                        shard_filename = cat_filename
+                        if len(vod_shards) > 1:
+                            shard_filename = '{}_{}'.format(cat_filename, shard_num + 1)
+                            bouquet_filepath = os.path.join(ENIGMAPATH, 'userbouquet.suls_iptv_{}_{}.tv'
+                                                            .format(provider_filename, shard_filename))
+                        with open(self._run.output.path(bouquet_filepath), "w+") as f:
+                            bouquet_name = '{} - VOD'.format(self.config.name).decode("utf-8")
+                            if 'VOD' in self._category_options and self._category_options['VOD'].get('nameOverride', False):
+                                bouquet_name = self._category_options['VOD']['nameOverride'].decode('utf-8')
+                            if shard_title:
+                                bouquet_name = u'{} {}/{} ({})'.format(bouquet_name, shard_num + 1, len(vod_shards),
+                                                                     shard_title)
+
+                            channel_num = 0
+                            f.write("#NAME {}\n".format(bouquet_name.encode("utf-8")))
+                            if not channel_number_start_offset_output and not self.config.all_bouquet:
+                                # write place holder services (for channel numbering)
+                                for i in xrange(100):
+                                    f.write('{}\n'.format(PLACEHOLDER_SERVICE))
+                                channel_number_start_offset_output = True
+                                channel_num += 1
 
-                        for vodcat in vod_categories:
-                            if vodcat in self._dictchannels:
+                            for vodcat, channels in shard:
                                 # Insert group description placeholder in bouquet
                                 f.write("#SERVICE 1:64:0:0:0:0:0:0:0:0:\n")
                                 f.write("#DESCRIPTION {}\n". format(vodcat.encode("utf-8")))
-                                for x in self._dictchannels[vodcat]:
+                                for x in channels:
                                     self._save_bouquet_entry(f, x)
                                     channel_num += 1
 
                                 while (channel_num % 100) is not 0:
                                     f.write('{}\n'.format(PLACEHOLDER_SERVICE))
                                     channel_num += 1
-                        vod_category_output = True
+                        if len(vod_shards) > 1:
+                            # one index entry per shard
+                            iptv_bouquet_list.append(self._get_bouquet_index_name(shard_filename, provider_filename))
+                            vod_bouquet_entry_output = True
+                    vod_category_output = True
 
                 # Add to bouquet index list
                 if cat not in vod_categories or (cat in vod_categories and not vod_bouquet_entry_output):
@@ -1360,6 +4074,62 @@ class Provider:
         self._update_status('bouquets created ...')
         print(Status.message)
 
+    def _get_vod_shards(self, vod_categories):
+        """Split the VOD categories into bouquets of at most vod_shard_size services
+        Small categories are packed together, categories bigger than a shard are split
+        Returns a list of (shard title, [(category, channels)])
+        """
+        entries = [(cat, self._dictchannels[cat]) for cat in vod_categories if cat in self._dictchannels]
+        shard_size = int(self.config.vod_shard_size or 0)
+        if shard_size <= 0 or sum(len(channels) for cat, channels in entries) <= shard_size:
+            return [('', entries)]
+
+        shards = []
+        shard = []
+        shard_count = 0
+        for cat, channels in entries:
+            parts = int(math.ceil(len(channels) / float(shard_size))) or 1
+            for part in xrange(parts):
+                part_channels = channels[part * shard_size:(part + 1) * shard_size]
+                if shard and shard_count + len(part_channels) > shard_size:
+                    shards.append(shard)
+                    shard = []
+                    shard_count = 0
+                label = cat[len('VOD - '):] if cat.startswith('VOD - ') else cat
+                if parts > 1:
+                    label = u'{} {}/{}'.format(label, part + 1, parts)
+                shard.append((cat, part_channels, label))
+                shard_count += len(part_channels)
+        if shard:
+            shards.append(shard)
+
+        result = []
+        for shard in shards:
+            title = shard[0][2] if len(shard) == 1 else u'{} - {}'.format(shard[0][2], shard[-1][2])
+            result.append((title, [(cat, part_channels) for cat, part_channels, label in shard]))
+        return result
+
+    def _get_epg_service_ref(self, channel):
+        # force the epg channels to stream type '1'
+        epg_service_ref = channel['serviceRef']
+        pos = epg_service_ref.find(':')
+        if pos != -1:
+            epg_service_ref = '1{}'.format(epg_service_ref[pos:])
+        return epg_service_ref
+
+    def _add_epgdat_mappings(self, mappings):
+        """Queue this providers tvg-id -> service mappings for the epg.dat written at the end of the run
+        """
+        sources = [self.config.epg_url]
+        for group in self._xmltv_sources_list or {}:
+            sources.extend(self._xmltv_sources_list[group])
+        for url in sources:
+            source_mappings = self._run.epg_sources.setdefault(url, {})
+            for tvg_id, epg_service_ref in mappings:
+                service_key = get_epgdat_service_key(epg_service_ref)
+                if service_key is not None:
+                    source_mappings.setdefault(tvg_id.lower(), set()).add(service_key)
+
     def create_epgimporter_config(self):
         indent = "  "
         if DEBUG:
@@ -1370,30 +4140,38 @@ class Provider:
         except OSError, e:  # race condition guard
             if e.errno != errno.EEXIST:
                 raise
-        channels_filename = os.path.join(EPGIMPORTPATH, 'suls_iptv_{}_channels.xml'.format(self._get_safe_provider_filename()))
+        channels_filename = self._get_epg_channels_filename()
 
         if self._dictchannels:
-            with open(channels_filename, "w+") as f:
-                f.write('<channels>\n')
-                for cat in self._category_order:
-                    if cat in self._dictchannels and self._category_options.get(cat, {}).get('enabled', True):
-                        if self._category_options[cat].get('type', 'live') == 'live':
-                            cat_title = get_category_title(cat, self._category_options)
+            lines = ['<channels>\n']
+            # the same tvg-id -> service ref mapping is only listed once
+            mappings = set()
+            for cat in self._category_order:
+                if cat in self._dictchannels and self._category_options.get(cat, {}).get('enabled', True):
+                    if self._category_options[cat].get('type', 'live') == 'live':
+                        cat_title = get_category_title(cat, self._category_options)
 
-                            f.write('{}<!-- {} -->\n'.format(indent, xml_safe_comment(xml_escape(cat_title.encode('utf-8')))))
-                            for x in self._dictchannels[cat]:
-                                if not x['stream-name'].startswith('placeholder_'):
-                                    tvg_id = x['tvg-id'] if x['tvg-id'] else get_service_title(x)
-                                    if x['enabled']:
-                                        # force the epg channels to stream type '1'
-                                        epg_service_ref = x['serviceRef']
-                                        pos = epg_service_ref.find(':')
-                                        if pos != -1:
-                                            epg_service_ref = '1{}'.format(epg_service_ref[pos:])
-                                        f.write('{}<channel id="{}">{}:http%3a//example.m3u8</channel> <!-- {} -->\n'
-                                                .format(indent, xml_escape(tvg_id.encode('utf-8')), epg_service_ref,
-                                                        xml_safe_comment(xml_escape(get_service_title(x).encode('utf-8')))))
-                f.write('</channels>\n')
+                        lines.append('{}<!-- {} -->\n'.format(indent, xml_safe_comment(xml_escape(cat_title.encode('utf-8')))))
+                        for x in self._dictchannels[cat]:
+                            if not x['stream-name'].startswith('placeholder_'):
+                                tvg_id = x['tvg-id'] if x['tvg-id'] else get_service_title(x)
+                                if x['enabled']:
+                                    epg_service_ref = self._get_epg_service_ref(x)
+                                    if (tvg_id, epg_service_ref) in mappings:
+                                        continue
+                                    mappings.add((tvg_id, epg_service_ref))
+                                    lines.append(self._get_epg_channel_line(tvg_id, epg_service_ref, get_service_title(x)))
+            lines.append('</channels>\n')
+            self._write_epg_channels_file(channels_filename, ''.join(lines))
+
+            if self._run.epgdat_file:
+                self._add_epgdat_mappings(mappings)
+
+            # remove the channels file in the other format if the option has been changed
+            other_filename = self._get_epg_channels_filename(not self.config.epg_gzip)
+            for filename in (other_filename, other_filename + '.md5'):
+                if os.path.isfile(filename):
+                    self._run.output.remove(filename)
 
             # create epg-importer sources file for providers feed
             self._create_epgimport_source([self.config.epg_url])
@@ -1431,6 +4209,10 @@ class Config:
         <streamtypetv></streamtypetv><!-- (Optional) Custom TV stream type (e.g. 1, 4097, 5001 or 5002) -->\r
         <streamtypevod></streamtypevod><!-- (Optional) Custom VOD stream type (e.g. 4097, 5001 or 5002) -->\r
         <multivod>0</multivod><!-- Split VOD into seperate categories (0 or 1) -->\r
+        <vodshardsize>0</vodshardsize><!-- (Optional) Split single VOD bouquet into bouquets of at most this many services (0 = off) -->\r
+        <xtreamapi>0</xtreamapi><!-- Load channels from the Xtream Codes panel api rather than the m3u (0 or 1) -->\r
+        <epggzip>0</epggzip><!-- Write the EPG-Importer channels file gzipped (0 or 1) -->\r
+        <probestreams>0</probestreams><!-- Check the live streams and disable channels whose stream keeps failing (0 or 1) -->\r
         <allbouquet>1</allbouquet><!-- Create all channels bouquet -->\r
         <picons>0</picons><!-- Automatically download Picons (0 or 1) -->\r
         <iconpath>/usr/share/enigma2/picon/</iconpath><!-- Location to store picons -->\r
@@ -1438,6 +4220,13 @@ class Config:
         <bouqueturl><![CDATA[]]></bouqueturl><!-- (Optional) url to download providers bouquet - to map custom service references -->\r
         <bouquetdownload>0</bouquetdownload><!-- Download providers bouquet (use default url) must have username and password set above - to map custom service references -->\r
         <bouquettop>0</bouquettop><!-- Place IPTV bouquets at top (0 or 1)-->\r
+        <!-- (Optional) include / exclude channels while parsing, field is group, name, tvg-id or type (live / vod)\r
+             and pattern a regular expression e.g.\r
+        <rules>\r
+            <exclude field="group" pattern="^Adult" />\r
+            <exclude field="type" pattern="vod" />\r
+        </rules>\r
+        -->\r
     </supplier>\r
     <supplier>\r
         <name>Supplier Name</name><!-- Supplier Name -->\r
@@ -1450,6 +4239,10 @@ class Config:
         <streamtypetv></streamtypetv><!-- (Optional) Custom TV service type (e.g. 1, 4097, 5001 or 5002) -->\r
         <streamtypevod></streamtypevod><!-- (Optional) Custom VOD service type (e.g. 4097, 5001 or 5002) -->\r
         <multivod>0</multivod><!-- Split VOD into seperate categories (0 or 1) -->\r
+        <vodshardsize>0</vodshardsize><!-- (Optional) Split single VOD bouquet into bouquets of at most this many services (0 = off) -->\r
+        <xtreamapi>0</xtreamapi><!-- Load channels from the Xtream Codes panel api rather than the m3u (0 or 1) -->\r
+        <epggzip>0</epggzip><!-- Write the EPG-Importer channels file gzipped (0 or 1) -->\r
+        <probestreams>0</probestreams><!-- Check the live streams and disable channels whose stream keeps failing (0 or 1) -->\r
         <allbouquet>1</allbouquet><!-- Create all channels bouquet -->\r
         <picons>0</picons><!-- Automatically download Picons (0 or 1) -->\r
         <iconpath>/usr/share/enigma2/picon/</iconpath><!-- Location to store picons -->\r
@@ -1498,6 +4291,14 @@ class Config:
                             provider.streamtype_vod = '' if child.text is None else child.text.strip()
                         if child.tag == 'multivod':
                             provider.multi_vod = True if child.text == '1' else False
+                        if child.tag == 'probestreams':
+                            provider.probe_streams = True if child.text == '1' else False
+                        if child.tag == 'epggzip':
+                            provider.epg_gzip = True if child.text == '1' else False
+                        if child.tag == 'xtreamapi':
+                            provider.xtream_api = True if child.text == '1' else False
+                        if child.tag == 'vodshardsize':
+                            provider.vod_shard_size = get_config_int(child.text)
                         if child.tag == 'allbouquet':
                             provider.all_bouquet = True if child.text == '1' else False
                         if child.tag == 'picons':
@@ -1512,6 +4313,9 @@ class Config:
                             provider.bouquet_download = True if child.text == '1' else False
                         if child.tag == 'bouquettop':
                             provider.bouquet_top = True if child.text == '1' else False
+                        if child.tag == 'rules':
+                            provider.rules = [(rule.tag, rule.attrib.get('field', 'group'), rule.attrib.get('pattern', ''))
+                                              for rule in child if rule.tag in ('include', 'exclude')]
                         if child.tag == 'lastproviderupdate':
                             provider.last_provider_update = 0 if child.text is None else child.text.strip()
                         provider.num = provider_num
@@ -1535,7 +4339,8 @@ class Config:
         indent = "  "
 
         if self.providers:
-            with open(config_file, 'wb') as f:
+            # written to a temp file first so a failure can't leave a truncated config
+            with open(config_file + '.tmp', 'wb') as f:
                 f.write('<!--\r\n')
                 f.write('{}E2m3u2bouquet supplier config file\r\n'.format(indent))
                 f.write('{}Add as many suppliers as required\r\n'.format(indent))
@@ -1561,6 +4366,10 @@ class Config:
                     f.write('{}<streamtypetv>{}</streamtypetv><!-- (Optional) Custom TV stream type (e.g. 1, 4097, 5001 or 5002 -->\r\n'.format(2 * indent, provider.streamtype_tv))
                     f.write('{}<streamtypevod>{}</streamtypevod><!-- (Optional) Custom VOD stream type (e.g. 4097, 5001 or 5002 -->\r\n'.format(2 * indent, provider.streamtype_vod))
                     f.write('{}<multivod>{}</multivod><!-- Split VOD into seperate categories (0 or 1) -->\r\n'.format(2 * indent, '1' if provider.multi_vod else '0'))
+                    f.write('{}<probestreams>{}</probestreams><!-- Check the live streams and disable channels whose stream keeps failing (0 or 1) -->\r\n'.format(2 * indent, '1' if provider.probe_streams else '0'))
+                    f.write('{}<epggzip>{}</epggzip><!-- Write the EPG-Importer channels file gzipped (0 or 1) -->\r\n'.format(2 * indent, '1' if provider.epg_gzip else '0'))
+                    f.write('{}<xtreamapi>{}</xtreamapi><!-- Load channels from the Xtream Codes panel api rather than the m3u (0 or 1) -->\r\n'.format(2 * indent, '1' if provider.xtream_api else '0'))
+                    f.write('{}<vodshardsize>{}</vodshardsize><!-- (Optional) Split single VOD bouquet into bouquets of at most this many services (0 = off) -->\r\n'.format(2 * indent, provider.vod_shard_size or 0))
                     f.write('{}<allbouquet>{}</allbouquet><!-- Create all channels bouquet (0 or 1) -->\r\n'.format(2 * indent, '1' if provider.all_bouquet else '0'))
                     f.write('{}<picons>{}</picons><!-- Automatically download Picons (0 or 1) -->\r\n'.format(2 * indent, '1' if provider.picons else '0'))
                     f.write('{}<iconpath>{}</iconpath><!-- Location to store picons) -->\r\n'.format(2 * indent, provider.icon_path if provider.icon_path else ''))
@@ -1568,9 +4377,18 @@ class Config:
                     f.write('{}<bouqueturl><![CDATA[{}]]></bouqueturl><!-- (Optional) url to download providers bouquet - to map custom service references -->\r\n'.format(2 * indent, provider.bouquet_url))
                     f.write('{}<bouquetdownload>{}</bouquetdownload><!-- Download providers bouquet (uses default url) must have username and password set above - to map custom service references -->\r\n'.format(2 * indent, '1' if provider.bouquet_download else '0'))
                     f.write('{}<bouquettop>{}</bouquettop><!-- Place IPTV bouquets at top (0 or 1) -->\r\n'.format(2 * indent, '1' if provider.bouquet_top else '0'))
+                    if provider.rules:
+                        f.write('{}<rules><!-- (Optional) include / exclude channels by group, name, tvg-id or type (live / vod) -->\r\n'.format(2 * indent))
+                        for action, field, pattern in provider.rules:
+                            # ElementTree returns non ascii values as unicode
+                            field, pattern = [xml_escape(value).encode('utf-8') if type(value) is unicode else xml_escape(value)
+                                              for value in (field, pattern)]
+                            f.write('{}<{} field="{}" pattern="{}" />\r\n'.format(3 * indent, action, field, pattern))
+                        f.write('{}</rules>\r\n'.format(2 * indent))
                     f.write('{}<lastproviderupdate>{}</lastproviderupdate><!-- Internal use -->\r\n'.format(2 * indent, provider.last_provider_update))
                     f.write('{}</supplier>\r\n'.format(indent))
                 f.write('</config>\r\n')
+            os.rename(config_file + '.tmp', config_file)
         else:
             # no providers delete config file
             if os.path.isfile(os.path.join(CFGPATH, 'config.xml')):
@@ -1600,17 +4418,27 @@ def main(argv=None):  # IGNORE:C0111
 USAGE
 """.format(program_shortdesc, str(__date__))
 
+    run_context = None
     try:
         # Setup argument parser
         parser = get_parser_args(program_license, program_version_message)
         args = parser.parse_args()
         uninstall = args.uninstall
 
+        if args.startupbench:
+            benchmark_startup(args.m3uurl)
+            return 0
+
         # Core program logic starts here
         urllib._urlopener = AppUrlOpener()
         socket.setdefaulttimeout(30)
         display_welcome()
 
+        if args.boxes and not args.outputroot:
+            parser.error('--boxes needs --outputroot')
+        if args.outputroot:
+            set_output_root(args.outputroot)
+
         if uninstall:
             # Clean up any existing files
             uninstaller()
@@ -1627,6 +4455,10 @@ USAGE
         args_config.epg_url = args.epgurl
         args_config.iptv_types = args.iptvtypes
         args_config.multi_vod = args.multivod
+        args_config.vod_shard_size = args.vodshardsize
+        args_config.xtream_api = args.xtreamapi
+        args_config.epg_gzip = args.epggzip
+        args_config.probe_streams = args.probestreams
         args_config.all_bouquet = args.allbouquet
         args_config.bouquet_url = args.bouqueturl
         args_config.bouquet_download = args.bouquetdownload
@@ -1640,13 +4472,49 @@ USAGE
         args_config.streamtype_tv = args.sttv
         args_config.streamtype_vod = args.stvod
 
+        run_context = RunContext()
+        run_context.parse_workers = args.parseworkers
+        run_context.probe_connections = args.probeconnections
+        run_context.epgdat_file = args.epgdat
+        if args.piconbudget:
+            run_context.picon_budget = int(args.piconbudget * 1048576)
+        if args.runbudget:
+            run_context.set_run_budget(args.runbudget)
+        if args.budgets:
+            try:
+                run_context.stage_budgets = parse_budgets(args.budgets)
+            except ValueError, e:
+                parser.error(str(e))
+        if args.stages:
+            if args.boxes or args.watch:
+                parser.error('--stages cannot be used with --boxes or --watch')
+            try:
+                run_context.stages = parse_stages(args.stages)
+            except ValueError, e:
+                parser.error(str(e))
+        if args.profile or args.profilestats:
+            if args.profilestats and not os.path.isdir(args.profilestats):
+                os.makedirs(args.profilestats)
+            run_context.profiler = StageProfiler(args.profilestats)
+
         if args_config.m3u_url:
             print('\n**************************************')
             print('E2m3u2bouquet - Command line based setup')
             print('**************************************\n')
-            args_provider = Provider(args_config)
-            args_provider.process_provider()
+            if args.boxes:
+                build_boxes([args_config], args.boxes, OUTPUT_ROOT, run_context)
+            elif args.watch:
+                watch_overrides([args_config], run_context)
+            else:
+                args_provider = Provider(args_config, run_context)
+                args_provider.process_provider()
+                if run_context.epgdat_file and run_context.stage_selected('epg'):
+                    write_epgdat(run_context, get_output_path(run_context.epgdat_file))
+            run_context.output.commit()
+            run_context.remove_xmltv_files()
             reload_bouquets()
+            run_context.wait_for_background()
+            run_context.collect_picons()
             display_end_msg()
         else:
             print('\n********************************')
@@ -1656,6 +4524,10 @@ USAGE
             if os.path.isfile(os.path.join(CFGPATH, 'config.xml')):
                 e2m3u2b_config.read_config(os.path.join(CFGPATH, 'config.xml'))
                 providers_updated = False
+                build_configs = []
+                early_reload = False
+                providers_left = sum(1 for provider_config in e2m3u2b_config.providers.itervalues()
+                                     if provider_config.enabled)
 
                 for key, provider_config in e2m3u2b_config.providers.iteritems():
                     if provider_config.enabled:
@@ -1666,19 +4538,40 @@ USAGE
                             print('\n********************************')
                             print('Config based setup - {}'.format(provider_config.name.encode('utf-8')))
                             print('********************************\n')
-                            provider = Provider(provider_config)
+                            provider = Provider(provider_config, run_context)
 
                             if int(time.time()) - int(provider.config.last_provider_update) > 21600:
                                 # wait at least 6 hours (21600s) between update checks
                                 providers_updated = provider.provider_update()
-                            provider.process_provider()
+                            if args.boxes or args.watch:
+                                build_configs.append(provider_config)
+                            else:
+                                provider.process_provider()
+                                providers_left -= 1
+                                if providers_left and not early_reload:
+                                    # show the first providers bouquets (and priority picons) while
+                                    # the others are processed
+                                    run_context.output.commit()
+                                    reload_bouquets()
+                                    early_reload = True
                     else:
                         print('\nProvider: {} is disabled - skipping.........\n'.format(provider_config.name))
 
+                if args.boxes:
+                    build_boxes(build_configs, args.boxes, OUTPUT_ROOT, run_context)
+                elif args.watch:
+                    watch_overrides(build_configs, run_context)
+                elif run_context.epgdat_file and run_context.stage_selected('epg'):
+                    write_epgdat(run_context, get_output_path(run_context.epgdat_file))
+                run_context.output.commit()
+                run_context.remove_xmltv_files()
+
                 if providers_updated:
                     e2m3u2b_config.write_config()
 
                 reload_bouquets()
+                run_context.wait_for_background()
+                run_context.collect_picons()
                 display_end_msg()
             else:
                 e2m3u2b_config.make_default_config(os.path.join(CFGPATH, 'config.xml'))
@@ -1693,6 +4586,8 @@ USAGE
         return 0
 
     except Exception, e:
+        if run_context is not None:
+            run_context.discard_journals()
         if DEBUG:
             raise e
         indent = len(program_name) * " "
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Benchmark of the m3u tokenizer and parse_m3u on a generated playlist
+
+    python tests/bench_parse.py [entries]
+
+Prints the best of 3 runs of each (defaults to 250000 entries, a 500k line playlist)
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import io
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+
+GROUPS = ['UK Entertainment', 'UK Sport', 'US News', 'FR Cin\xc3\xa9ma', 'Kids', 'VOD Action', 'VOD Comedy']
+
+
+def write_playlist(filename, entries):
+    with io.open(filename, 'w', encoding='utf-8') as f:
+        f.write(u'#EXTM3U\n')
+        for i in xrange(entries):
+            group = GROUPS[i % len(GROUPS)].decode('utf-8')
+            ext = u'mp4' if group.startswith(u'VOD') else u'ts'
+            f.write(u'#EXTINF:-1 tvg-id="chan{0}.uk" tvg-name="Channel {0}" tvg-logo="http://logo/{0}.png" '
+                    u'group-title="{1}",Channel {0}\n'.format(i, group))
+            f.write(u'http://panel:8080/user/pass/{}.{}\n'.format(i, ext))
+
+
+def best_of(runs, func, setup=None):
+    best = None
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 250000
+    work_dir = tempfile.mkdtemp()
+    e2m3u2b.CFGPATH = work_dir + '/'
+    try:
+        m3u_file = os.path.join(work_dir, 'bench.m3u')
+        write_playlist(m3u_file, entries)
+        encoding = e2m3u2b.detect_m3u_encoding(m3u_file)
+
+        def tokenize():
+            with io.open(m3u_file, 'r', encoding=encoding, errors='ignore') as f:
+                for _ in e2m3u2b.M3uTokenizer().services(f):
+                    pass
+
+        parse_file = os.path.join(work_dir, 'parse.m3u')
+
+        def copy_playlist():
+            # parse_m3u removes the file once it's parsed
+            shutil.copy(m3u_file, parse_file)
+
+        def parse():
+            provider = e2m3u2b.Provider(e2m3u2b.ProviderConfig(), e2m3u2b.RunContext())
+            provider._m3u_file = parse_file
+            provider.parse_m3u()
+
+        print('{} entries ({})'.format(entries, encoding))
+        print('tokenizer only          {:.2f}s'.format(best_of(3, tokenize)))
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            parse_time = best_of(3, parse, copy_playlist)
+        finally:
+            sys.stdout = stdout
+        print('parse_m3u incl. types   {:.2f}s'.format(parse_time))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Local HTTP stand-in for the panels and logo hosts the script downloads from
+
+Routes are scripted per path with a Response, or a function of the query string returning one,
+so tests can inject latency, bandwidth caps, truncated bodies, stalls, resets and error statuses.
+
+Run the tests (python 2) from the repository root with
+
+    python -m unittest discover -s tests
+"""
+import BaseHTTPServer
+import SocketServer
+import socket
+import threading
+import time
+import urlparse
+
+
+class Response:
+    """Scripted reply for a route
+
+    fail -- statuses returned by the first requests to the route before the real reply e.g. [503, 503]
+    resets -- number of first requests to the route whose connection is closed without a reply
+    latency -- seconds before the reply is sent
+    rate -- bandwidth cap of the body in bytes per second
+    truncate -- only send this many bytes of the body (Content-Length still gives the whole body)
+    stall -- seconds to stop sending after the first chunk of the body
+    head_status -- status for HEAD requests if it differs e.g. 405 from servers that only take GET
+    """
+    CHUNK_SIZE = 1024
+
+    def __init__(self, body='', status=200, content_type='application/octet-stream', headers=None,
+                 fail=None, resets=0, latency=0, rate=None, truncate=None, stall=0, head_status=None):
+        self.body = body
+        self.status = status
+        self.headers = {'Content-Type': content_type}
+        self.headers.update(headers or {})
+        self.fail = list(fail or [])
+        self.resets = resets
+        self.latency = latency
+        self.rate = rate
+        self.truncate = truncate
+        self.stall = stall
+        self.head_status = head_status
+
+    def serve(self, handler, method, hit, finishing):
+        """Send the reply for the hit'th (from 1) request to the route
+        finishing() is called just before the end of the reply is sent, the client can't start another
+        request before that
+        """
+        if hit <= self.resets:
+            finishing()
+            handler.close_connection = True
+            return
+        if self.latency:
+            time.sleep(self.latency)
+        status = self.status
+        if hit - self.resets <= len(self.fail):
+            status = self.fail[hit - self.resets - 1]
+        elif method == 'HEAD' and self.head_status is not None:
+            status = self.head_status
+        handler.send_response(status)
+        for name, value in self.headers.items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(self.body)))
+        body = '' if method == 'HEAD' else self.body if self.truncate is None else self.body[:self.truncate]
+        if not body:
+            finishing()
+        handler.end_headers()
+        for pos in xrange(0, len(body), self.CHUNK_SIZE):
+            chunk = body[pos:pos + self.CHUNK_SIZE]
+            if pos + self.CHUNK_SIZE >= len(body):
+                finishing()
+            handler.wfile.write(chunk)
+            handler.wfile.flush()
+            if self.stall and not pos:
+                time.sleep(self.stall)
+            if self.rate:
+                time.sleep(len(chunk) / float(self.rate))
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.standin.handle(self, 'GET')
+
+    def do_HEAD(self):
+        self.server.standin.handle(self, 'HEAD')
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # clients giving up on stalled replies are expected
+        pass
+
+
+class StandinServer:
+    """Threaded HTTP server on a free localhost port answering from the scripted routes
+    """
+    def __init__(self):
+        # path -> Response or function(query dict) returning a Response
+        self.routes = {}
+        # (method, path, query dict, headers dict) of each request
+        self.requests = []
+        # most requests being answered at the same time (a request counts until the end of its reply is sent)
+        self.peak_connections = 0
+        self._connections = 0
+        self._hits = {}
+        self._lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.standin = self
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+
+    def url(self, path='/'):
+        return 'http://127.0.0.1:{}{}'.format(self._server.server_address[1], path)
+
+    def add(self, path, response):
+        self.routes[path] = response
+
+    def hits(self, path):
+        return self._hits.get(path, 0)
+
+    def handle(self, handler, method):
+        path, _, query = handler.path.partition('?')
+        query = dict((key, values[0]) for key, values in urlparse.parse_qs(query).items())
+        with self._lock:
+            self.requests.append((method, path, query, dict(handler.headers)))
+            self._hits[path] = hit = self._hits.get(path, 0) + 1
+            self._connections += 1
+            self.peak_connections = max(self.peak_connections, self._connections)
+        finished = []
+
+        def finishing():
+            if not finished:
+                finished.append(True)
+                with self._lock:
+                    self._connections -= 1
+        try:
+            route = self.routes.get(path)
+            if route is None:
+                response = Response('not found', status=404, content_type='text/plain')
+            elif callable(route):
+                response = route(query)
+            else:
+                response = route
+            try:
+                response.serve(handler, method, hit, finishing)
+            except socket.error:
+                # the client hung up
+                pass
+        finally:
+            finishing()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
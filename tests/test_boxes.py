@@ -0,0 +1,93 @@
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+from standin import Response, StandinServer
+
+PLAYLIST = ('#EXTM3U\n'
+            '#EXTINF:-1 tvg-id="one.uk" group-title="UK",One\nhttp://panel/user/pass/1.ts\n'
+            '#EXTINF:-1 tvg-id="two.fr" group-title="FR",Two\nhttp://panel/user/pass/2.ts\n')
+BOX_BOUQUETS_TV = ('#NAME Bouquets (TV)\n'
+                   '#SERVICE 1:7:1:0:0:0:0:0:0:0:FROM BOUQUET "userbouquet.favourites.tv" ORDER BY bouquet\n')
+OVERRIDE = '<mapping><categories><category name="FR" enabled="false" /></categories></mapping>'
+OUTPUT_GLOBALS = ('ENIGMAPATH', 'EPGIMPORTPATH', 'CFGPATH', 'PICONSPATH', 'OUTPUT_ROOT')
+
+
+class BuildBoxesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = StandinServer()
+        self.server.add('/get.php', Response(PLAYLIST))
+        self._globals = dict((name, getattr(e2m3u2b, name)) for name in OUTPUT_GLOBALS)
+        self._tempdir = tempfile.tempdir
+        tempfile.tempdir = self.tmp
+        self.boxes_dir = os.path.join(self.tmp, 'boxes')
+        self.output_root = os.path.join(self.tmp, 'output')
+        for box in ('lounge', 'kitchen'):
+            os.makedirs(os.path.join(self.boxes_dir, box))
+        self.write_box_file('lounge', 'bouquets.tv', BOX_BOUQUETS_TV)
+        self.write_box_file('lounge', 'test-sort-override.xml', OVERRIDE)
+
+    def tearDown(self):
+        self.server.close()
+        for name, value in self._globals.iteritems():
+            setattr(e2m3u2b, name, value)
+        tempfile.tempdir = self._tempdir
+        shutil.rmtree(self.tmp)
+
+    def write_box_file(self, box, fname, data):
+        with open(os.path.join(self.boxes_dir, box, fname), 'w') as f:
+            f.write(data)
+
+    def build(self):
+        config = e2m3u2b.ProviderConfig()
+        config.name = 'Test'
+        config.m3u_url = self.server.url('/get.php')
+        e2m3u2b.build_boxes([config], self.boxes_dir, self.output_root, e2m3u2b.RunContext())
+
+    def archive(self, box):
+        with tarfile.open(os.path.join(self.output_root, '{}.tar.gz'.format(box))) as tar:
+            return dict((member.name, tar.extractfile(member).read()) for member in tar.getmembers())
+
+    def test_archive_only_has_the_box_output(self):
+        self.build()
+        files = self.archive('lounge')
+        # not the config folder, override files, service refs or caches
+        self.assertEqual(sorted(files), ['etc/enigma2/bouquets.tv',
+                                         'etc/enigma2/userbouquet.suls_iptv_test_uk.tv',
+                                         'etc/epgimport/suls_iptv_test.sources.xml',
+                                         'etc/epgimport/suls_iptv_test_channels.xml'])
+
+    def test_iptv_bouquets_merged_into_the_box_bouquets_tv(self):
+        self.build()
+        lines = self.archive('lounge')['etc/enigma2/bouquets.tv'].splitlines()
+        self.assertEqual(lines[:2], BOX_BOUQUETS_TV.splitlines())
+        self.assertTrue(any('userbouquet.suls_iptv_test_uk.tv' in line for line in lines[2:]))
+
+    def test_bouquets_tv_left_out_without_the_box_one(self):
+        self.build()
+        files = self.archive('kitchen')
+        self.assertNotIn('etc/enigma2/bouquets.tv', files)
+        self.assertIn('etc/enigma2/userbouquet.suls_iptv_test_uk.tv', files)
+
+    def test_box_override_files_applied(self):
+        self.build()
+        self.assertNotIn('suls_iptv_test_fr', ''.join(self.archive('lounge')))
+        self.assertIn('etc/enigma2/userbouquet.suls_iptv_test_fr.tv', self.archive('kitchen'))
+
+    def test_deleted_override_file_no_longer_applied(self):
+        self.build()
+        os.remove(os.path.join(self.boxes_dir, 'lounge', 'test-sort-override.xml'))
+        self.build()
+        self.assertIn('etc/enigma2/userbouquet.suls_iptv_test_fr.tv', self.archive('lounge'))
+        self.assertFalse(os.path.exists(os.path.join(self.output_root, 'boxes', 'lounge', 'etc', 'enigma2',
+                                                     'e2m3u2bouquet', 'test-sort-override.xml')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+
+
+def channel(name, tvg_id=u'', service_ref='', enabled=True):
+    x = e2m3u2b.new_service_dict({'tvg-id': tvg_id}, name)
+    x['serviceRef'] = service_ref
+    x['enabled'] = enabled
+    return x
+
+
+CHANNELS = e2m3u2b.OrderedDict([
+    (u'UK', [channel(u'BBC One', u'bbc1.uk', '1:0:1:1:0:0:0:0:0:0'), channel(u'BBC Two', u'bbc2.uk'),
+             channel(u'placeholder_1'), channel(u'ITV', u'itv.uk', enabled=False)]),
+    (u'FR', [channel(u'T\xe9l\xe9 Premi\xe8re', u'tele.fr'), channel(u'Canal+ Sport', u'canal.fr')])])
+CATEGORY_ORDER = [u'UK', u'FR', u'Empty']
+# ids in bouquet order, placeholders aren't indexed
+BBC_ONE, BBC_TWO, ITV, TELE, CANAL = range(5)
+
+
+class ChannelIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = e2m3u2b.ChannelIndex.from_channels(CATEGORY_ORDER, CHANNELS)
+
+    def names(self, ids):
+        return [self.index.get(channel_id)['stream-name'] for channel_id in ids]
+
+    def test_channels_in_bouquet_order(self):
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.index.get(TELE), {'category': u'FR', 'stream-name': u'T\xe9l\xe9 Premi\xe8re',
+                                                'nameOverride': '', 'tvg-id': u'tele.fr', 'serviceRef': '',
+                                                'enabled': True})
+        self.assertFalse(self.index.get(ITV)['enabled'])
+
+    def test_prefix(self):
+        self.assertEqual(self.index.prefix(u'bbc'), [BBC_ONE, BBC_TWO])
+        self.assertEqual(self.index.prefix(u'BBC T'), [BBC_TWO])
+        self.assertEqual(self.index.prefix(u'bbc', limit=1), [BBC_ONE])
+        self.assertEqual(self.index.prefix(u'one'), [])
+        self.assertEqual(self.index.prefix(u''), [BBC_ONE, BBC_TWO, CANAL, ITV, TELE])
+
+    def test_prefix_filters(self):
+        self.assertEqual(self.index.prefix(u'i', category=u'UK'), [ITV])
+        self.assertEqual(self.index.prefix(u'i', category=u'FR'), [])
+        self.assertEqual(self.index.prefix(u'i', enabled=True), [])
+
+    def test_search_with_partial_last_word(self):
+        self.assertEqual(self.index.search(u'bbc o'), [BBC_ONE])
+        self.assertEqual(self.index.search(u'bb'), [BBC_ONE, BBC_TWO])
+        self.assertEqual(self.index.search(u'sport'), [CANAL])
+        self.assertEqual(self.index.search(u'on bbc'), [])
+        self.assertEqual(self.index.search(u'xyz'), [])
+
+    def test_search_without_words(self):
+        self.assertEqual(self.index.search(u''), range(5))
+        self.assertEqual(self.index.search(u' ', category=u'FR'), [TELE, CANAL])
+        self.assertEqual(self.index.search(u'', category=u'Empty'), [])
+        self.assertEqual(self.index.search(u'', enabled=False), [ITV])
+
+    def test_accents_folded(self):
+        self.assertEqual(self.index.search(u'tele prem'), [TELE])
+        self.assertEqual(self.index.search(u'T\xc9L\xc9'), [TELE])
+        self.assertEqual(self.index.prefix(u'tele'), [TELE])
+        self.assertEqual(e2m3u2b.normalise_channel_name(u'Cin\xe9ma \xc9T\xc9'), u'cinema ete')
+        self.assertEqual(e2m3u2b.normalise_channel_name('Caf\xc3\xa9'), u'cafe')
+
+    def test_exact_lookups(self):
+        self.assertEqual(self.index.find_tvg_id(u'bbc2.uk'), [BBC_TWO])
+        self.assertEqual(self.index.find_tvg_id(u'bbc2.uk', category=u'FR'), [])
+        self.assertEqual(self.index.find_service_ref('1:0:1:1:0:0:0:0:0:0'), [BBC_ONE])
+        self.assertEqual(self.index.find_tvg_id(u'itv.uk', enabled=True), [])
+
+    def test_update_rename(self):
+        self.index.update(BBC_TWO, {'nameOverride': u'Channel Deux'})
+        self.assertEqual(self.index.search(u'deux'), [BBC_TWO])
+        self.assertEqual(self.index.prefix(u'channel'), [BBC_TWO])
+        # still found by its own name
+        self.assertEqual(self.index.search(u'bbc two'), [BBC_TWO])
+        self.index.update(BBC_TWO, {'nameOverride': u''})
+        self.assertEqual(self.index.search(u'deux'), [])
+        self.assertEqual(self.index.prefix(u'channel'), [])
+        self.assertEqual(self.index.prefix(u'bbc'), [BBC_ONE, BBC_TWO])
+
+    def test_update_category(self):
+        self.index.update(CANAL, {'category': u'UK'})
+        self.assertEqual(self.index.search(u'', category=u'UK'), [BBC_ONE, BBC_TWO, ITV, CANAL])
+        self.assertEqual(self.index.search(u'', category=u'FR'), [TELE])
+        self.assertEqual(self.index.search(u'sport', category=u'UK'), [CANAL])
+
+    def test_update_enabled(self):
+        self.index.update(BBC_ONE, {'enabled': False})
+        self.index.update(ITV, {'enabled': True})
+        self.assertEqual(self.index.search(u'', category=u'UK', enabled=True), [BBC_TWO, ITV])
+        self.assertEqual(self.index.prefix(u'bbc', enabled=False), [BBC_ONE])
+        self.assertEqual(self.index.find_tvg_id(u'bbc1.uk', enabled=True), [])
+
+
+class ChannelIndexFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'test-channels.index')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_save_load_round_trip(self):
+        index = e2m3u2b.ChannelIndex.from_channels(CATEGORY_ORDER, CHANNELS)
+        index.update(CANAL, {'nameOverride': u'Sport Plus'})
+        index.save(self.filename)
+        loaded = e2m3u2b.ChannelIndex.load(self.filename)
+        self.assertEqual(len(loaded), len(index))
+        self.assertEqual([loaded.get(i) for i in xrange(len(loaded))], [index.get(i) for i in xrange(len(index))])
+        for text in (u'bbc', u'sport p', u'tele', u''):
+            self.assertEqual(loaded.search(text), index.search(text))
+            self.assertEqual(loaded.prefix(text), index.prefix(text))
+        # and can still be updated
+        loaded.update(TELE, {'nameOverride': u'TF1'})
+        self.assertEqual(loaded.search(u'tf1'), [TELE])
+
+    def test_missing_or_old_index_not_loaded(self):
+        self.assertIsNone(e2m3u2b.ChannelIndex.load(self.filename))
+        with open(self.filename, 'wb') as f:
+            pickle.dump({'version': e2m3u2b.CHANNEL_INDEX_VERSION - 1, 'index': {}}, f)
+        self.assertIsNone(e2m3u2b.ChannelIndex.load(self.filename))
+        with open(self.filename, 'wb') as f:
+            f.write('not a pickle')
+        self.assertIsNone(e2m3u2b.ChannelIndex.load(self.filename))
+
+
+if __name__ == '__main__':
+    unittest.main()
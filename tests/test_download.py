@@ -0,0 +1,260 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+from standin import Response, StandinServer
+
+BODY = ''.join(chr(i % 256) for i in xrange(64 * 1024))
+PNG = '\x89PNG\r\n\x1a\n' + '\0' * 1024
+PLAYLIST = '#EXTM3U\n#EXTINF:-1 tvg-id="one.uk" group-title="UK",One\nhttp://panel/user/pass/1.ts\n'
+# slack allowed on top of the expected time of a download
+SLACK = 1.0
+
+
+class StandinTestCase(unittest.TestCase):
+    """Stand-in server, temp folder and short retry delays / socket timeout for each test
+    """
+    SOCKET_TIMEOUT = 1
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = StandinServer()
+        self._retry_delay = e2m3u2b.DOWNLOAD_RETRY_DELAY
+        e2m3u2b.DOWNLOAD_RETRY_DELAY = 0.1
+        self._socket_timeout = socket.getdefaulttimeout()
+        socket.setdefaulttimeout(self.SOCKET_TIMEOUT)
+        self._tempdir = tempfile.tempdir
+        tempfile.tempdir = self.tmp
+        self._cfg_path = e2m3u2b.CFGPATH
+        e2m3u2b.CFGPATH = self.tmp + '/'
+        self.start = time.time()
+
+    def tearDown(self):
+        self.server.close()
+        e2m3u2b.DOWNLOAD_RETRY_DELAY = self._retry_delay
+        socket.setdefaulttimeout(self._socket_timeout)
+        tempfile.tempdir = self._tempdir
+        e2m3u2b.CFGPATH = self._cfg_path
+        shutil.rmtree(self.tmp)
+
+    def assertTookAtMost(self, seconds):
+        elapsed = time.time() - self.start
+        self.assertLessEqual(elapsed, seconds + SLACK, 'took {:.2f}s, expected at most {}s'.format(elapsed, seconds))
+
+    def assertTookAtLeast(self, seconds):
+        self.assertGreaterEqual(time.time() - self.start, seconds)
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def make_provider(self):
+        config = e2m3u2b.ProviderConfig()
+        config.name = 'Standin'
+        config.icon_path = os.path.join(self.tmp, 'picons')
+        os.makedirs(config.icon_path)
+        return e2m3u2b.Provider(config, e2m3u2b.RunContext())
+
+
+class DownloadFileTest(StandinTestCase):
+    def setUp(self):
+        StandinTestCase.setUp(self)
+        self.filename = os.path.join(self.tmp, 'download.bin')
+
+    def download(self, response, **kwargs):
+        self.server.add('/file', response)
+        return e2m3u2b.download_file(self.server.url('/file'), self.filename, **kwargs)
+
+    def assertNoPartFile(self):
+        self.assertFalse(os.path.exists(self.filename + '.part'))
+
+    def test_download(self):
+        self.download(Response(BODY))
+        self.assertEqual(self.read(self.filename), BODY)
+        self.assertEqual(self.server.hits('/file'), 1)
+        self.assertTookAtMost(0)
+
+    def test_latency(self):
+        self.download(Response(BODY, latency=0.5))
+        self.assertEqual(self.read(self.filename), BODY)
+        self.assertTookAtLeast(0.5)
+        self.assertTookAtMost(0.5)
+
+    def test_bandwidth_cap(self):
+        self.download(Response(BODY, rate=64 * 1024))
+        self.assertEqual(self.read(self.filename), BODY)
+        self.assertTookAtMost(1)
+
+    def test_deadline_cuts_slow_download_short(self):
+        with open(self.filename, 'wb') as f:
+            f.write('old')
+        # would take 4s
+        self.assertRaises(e2m3u2b.DownloadError, self.download, Response(BODY, rate=16 * 1024), deadline=1)
+        self.assertTookAtMost(1)
+        self.assertEqual(self.read(self.filename), 'old')
+        self.assertNoPartFile()
+
+    def test_server_errors_are_retried(self):
+        self.download(Response(BODY, fail=[503, 502]))
+        self.assertEqual(self.read(self.filename), BODY)
+        self.assertEqual(self.server.hits('/file'), 3)
+        # retry delays 0.1 + 0.2
+        self.assertTookAtMost(0.3)
+
+    def test_server_errors_give_up_after_retries(self):
+        self.assertRaises(e2m3u2b.DownloadError, self.download, Response(BODY, status=500), retries=2)
+        self.assertEqual(self.server.hits('/file'), 3)
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertNoPartFile()
+        self.assertTookAtMost(0.3)
+
+    def test_not_found_is_not_retried(self):
+        with open(self.filename, 'wb') as f:
+            f.write('old')
+        self.assertRaises(e2m3u2b.DownloadError, self.download, Response(BODY, status=404))
+        self.assertEqual(self.server.hits('/file'), 1)
+        self.assertEqual(self.read(self.filename), 'old')
+
+    def test_truncated_body_is_retried(self):
+        self.server.add('/file', Response(BODY, truncate=1000))
+        self.assertRaises(e2m3u2b.DownloadError, e2m3u2b.download_file, self.server.url('/file'), self.filename,
+                          retries=1)
+        self.assertEqual(self.server.hits('/file'), 2)
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertNoPartFile()
+
+    def test_connection_reset_is_retried(self):
+        self.download(Response(BODY, resets=1))
+        self.assertEqual(self.read(self.filename), BODY)
+        self.assertEqual(self.server.hits('/file'), 2)
+        self.assertTookAtMost(0.1)
+
+    def test_stalled_body_is_bounded_by_socket_timeout(self):
+        self.assertRaises(IOError, self.download, Response(BODY, stall=10), retries=1)
+        self.assertEqual(self.server.hits('/file'), 2)
+        self.assertNoPartFile()
+        # two attempts each cut off by the 1s socket timeout
+        self.assertTookAtMost(2 * self.SOCKET_TIMEOUT + 0.1)
+
+    def test_stalled_reply_is_bounded_by_socket_timeout(self):
+        self.assertRaises(IOError, self.download, Response(BODY, latency=10), retries=0)
+        self.assertTookAtMost(self.SOCKET_TIMEOUT)
+
+    def test_content_check_rejects_without_writing(self):
+        info = self.download(Response('<html>', content_type='text/html'),
+                             content_check=lambda info: info.maintype == 'image')
+        self.assertIsNone(info)
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertNoPartFile()
+
+
+class ProviderDownloadTest(StandinTestCase):
+    def test_download_m3u(self):
+        self.server.add('/get.php', Response(PLAYLIST, fail=[502]))
+        provider = self.make_provider()
+        provider.config.m3u_url = self.server.url('/get.php?username=u&password=p&type=m3u_plus')
+        provider.download_m3u()
+        self.assertEqual(self.read(provider._m3u_file), PLAYLIST)
+        self.assertEqual(self.server.hits('/get.php'), 2)
+        self.assertTookAtMost(0.1)
+
+    def test_download_m3u_failure(self):
+        self.server.add('/get.php', Response('', status=403))
+        provider = self.make_provider()
+        provider.config.m3u_url = self.server.url('/get.php')
+        provider.download_m3u()
+        self.assertIsNone(provider._m3u_file)
+        self.assertIn('HTTP error 403', e2m3u2b.Status.message)
+        self.assertTookAtMost(0)
+
+    def test_download_m3u_keeps_to_download_budget(self):
+        self.server.add('/get.php', Response(BODY, rate=8 * 1024))
+        provider = self.make_provider()
+        provider.config.m3u_url = self.server.url('/get.php')
+        provider._deadlines['download'] = time.time() + 1
+        provider.download_m3u()
+        self.assertIsNone(provider._m3u_file)
+        self.assertTookAtMost(1)
+
+    def test_download_panel_bouquet(self):
+        self.server.add('/panel_api.php', Response(
+            '#NAME Panel\n#SERVICE 4097:0:1:1A2B:3C:4D:5E:0:0:0:http%3a//panel/user/pass/1.ts\n', fail=[500]))
+        provider = self.make_provider()
+        provider.config.bouquet_url = self.server.url('/panel_api.php')
+        provider.download_panel_bouquet()
+        self.assertEqual(provider.get_panel_bouquet(), {'1.ts': '0:1:1A2B:3C:4D:5E:0:0:0'})
+        self.assertEqual(self.server.hits('/panel_api.php'), 2)
+
+    def test_download_panel_bouquet_failure(self):
+        self.server.add('/panel_api.php', Response('', truncate=0, latency=10))
+        provider = self.make_provider()
+        provider.config.bouquet_url = self.server.url('/panel_api.php')
+        provider.download_panel_bouquet()
+        self.assertEqual(provider.get_panel_bouquet(), {})
+        # the first attempt and the retries are each cut off by the socket timeout
+        self.assertTookAtMost((e2m3u2b.DOWNLOAD_RETRIES + 1) * self.SOCKET_TIMEOUT + 0.3)
+
+    def test_provider_update(self):
+        self.server.add('/update.txt', Response('New Name,http://panel/get.php,http://panel/xmltv.php\n', fail=[503]))
+        provider = self.make_provider()
+        provider.config.provider_update_url = self.server.url('/update.txt')
+        self.assertTrue(provider._process_provider_update())
+        self.assertEqual(provider.config.name, 'New Name')
+        self.assertEqual(provider.config.m3u_url, 'http://panel/get.php')
+        self.assertEqual(provider.config.epg_url, 'http://panel/xmltv.php')
+        self.assertTookAtMost(0.1)
+
+    def test_provider_update_failure(self):
+        self.server.add('/update.txt', Response('', status=404))
+        provider = self.make_provider()
+        provider.config.provider_update_url = self.server.url('/update.txt')
+        self.assertFalse(provider._process_provider_update())
+        self.assertEqual(provider.config.name, 'Standin')
+        self.assertTookAtMost(0)
+
+    def picon_channel(self, name, logo_path):
+        return e2m3u2b.new_service_dict({'tvg-logo': self.server.url(logo_path)}, name)
+
+    def test_download_picon(self):
+        self.server.add('/one.png', Response(PNG, content_type='image/png', fail=[503]))
+        provider = self.make_provider()
+        provider._download_picon_file(self.picon_channel(u'One', '/one.png'))
+        self.assertEqual(self.read(os.path.join(provider.config.icon_path, 'one.png')), PNG)
+        self.assertEqual(self.server.hits('/one.png'), 2)
+        self.assertTookAtMost(0.1)
+
+    def test_download_picon_not_an_image(self):
+        self.server.add('/one.png', Response('<html>', content_type='text/html'))
+        provider = self.make_provider()
+        provider._download_picon_file(self.picon_channel(u'One', '/one.png'))
+        self.assertEqual(os.listdir(provider.config.icon_path), ['one.None'])
+
+    def test_download_picon_gives_up_quickly(self):
+        self.server.add('/one.png', Response(PNG, content_type='image/png', status=500))
+        self.server.add('/two.png', Response(PNG, content_type='image/png', stall=10))
+        provider = self.make_provider()
+        provider._download_picon_file(self.picon_channel(u'One', '/one.png'))
+        provider._download_picon_file(self.picon_channel(u'Two', '/two.png'))
+        self.assertEqual(sorted(os.listdir(provider.config.icon_path)), ['one.None', 'two.None'])
+        # picons only get one retry
+        self.assertEqual(self.server.hits('/one.png'), 2)
+        self.assertEqual(self.server.hits('/two.png'), 2)
+        self.assertTookAtMost(2 * self.SOCKET_TIMEOUT + 0.1)
+
+    def test_picon_logo_fetched_once(self):
+        self.server.add('/logo.png', Response(PNG, content_type='image/png'))
+        provider = self.make_provider()
+        provider._download_picon_file(self.picon_channel(u'One', '/logo.png'))
+        provider._download_picon_file(self.picon_channel(u'One HD', '/logo.png'))
+        self.assertEqual(sorted(os.listdir(provider.config.icon_path)), ['one.png', 'onehd.png'])
+        self.assertEqual(self.server.hits('/logo.png'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+
+# 2020-01-28 19:30:00 UTC
+START = 1580239800
+SERVICE = (0x1a2b, 0x4d, 0x3c)
+OTHER_SERVICE = (0x1a2c, 0x4d, 0x3c)
+# magic, version and service count
+FILE_HEADER_SIZE = 21
+# sid, onid, tsid and event count
+SERVICE_HEADER_SIZE = 16
+
+
+class EpgDatTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp, 'epg.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self):
+        with open(self.filename, 'rb') as f:
+            return f.read()
+
+    def test_event_layout(self):
+        writer = e2m3u2b.EpgDatWriter()
+        writer.add_event([SERVICE], START, 5400, u'News', u'')
+        writer.write(self.filename)
+        data = self.read()
+        pos = FILE_HEADER_SIZE
+        self.assertEqual(struct.unpack_from('<iiii', data, pos), SERVICE + (1,))
+        pos += SERVICE_HEADER_SIZE
+        # Enigma2 reads a byte for the type and a byte for the length of the event
+        self.assertEqual(struct.unpack_from('<BB', data, pos), (e2m3u2b.EPGDAT_EVENT_TYPE, 14))
+        pos += 2
+        self.assertEqual(struct.unpack_from('>HH6B', data, pos), (1, 58876, 0x19, 0x30, 0x00, 0x01, 0x30, 0x00))
+        pos += 14
+        self.assertEqual(struct.unpack_from('<i', data, pos), (1,))
+
+    def test_round_trip(self):
+        writer = e2m3u2b.EpgDatWriter()
+        writer.add_event([SERVICE, OTHER_SERVICE], START, 3600, u'Caf\xe9', u'First')
+        writer.add_event([SERVICE], START + 3600, 1800, u'Second', u'x' * 1000)
+        writer.write(self.filename)
+        events = e2m3u2b.read_epgdat(self.filename)
+        self.assertEqual(events.keys(), [SERVICE, OTHER_SERVICE])
+        self.assertEqual(events[SERVICE], [(START, 3600, u'Caf\xe9', u'First'),
+                                           (START + 3600, 1800, u'Second', u'x' * 1000)])
+        self.assertEqual(events[OTHER_SERVICE], [(START, 3600, u'Caf\xe9', u'First')])
+
+    def test_dropped_events_descriptors_not_written(self):
+        writer = e2m3u2b.EpgDatWriter()
+        writer.add_event([SERVICE], START, 3600, u'Kept', u'')
+        # same start time, dropped
+        writer.add_event([SERVICE], START, 3600, u'Dropped', u'Never shown')
+        writer.write(self.filename)
+        data = self.read()
+        pos = FILE_HEADER_SIZE + SERVICE_HEADER_SIZE + 2 + 14
+        descriptor_count = struct.unpack_from('<i', data, pos)[0]
+        self.assertEqual(descriptor_count, 1)
+        self.assertEqual(struct.unpack_from('<i', data, pos + 8)[0], 1)
+        self.assertEqual(e2m3u2b.read_epgdat(self.filename)[SERVICE], [(START, 3600, u'Kept', u'')])
+
+    def test_event_length_fits_a_byte(self):
+        writer = e2m3u2b.EpgDatWriter()
+        writer.add_event([SERVICE], START, 3600, u'Long', u'x' * 100000)
+        writer.write(self.filename)
+        length = struct.unpack_from('<BB', self.read(), FILE_HEADER_SIZE + SERVICE_HEADER_SIZE)[1]
+        self.assertLessEqual(length, 255)
+        self.assertEqual(len(e2m3u2b.read_epgdat(self.filename)[SERVICE]), 1)
+
+
+class LoadEpgDatTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.commands = []
+        self._system = e2m3u2b.os.system
+        e2m3u2b.os.system = self.commands.append
+        self._output_root = e2m3u2b.OUTPUT_ROOT
+
+    def tearDown(self):
+        e2m3u2b.os.system = self._system
+        e2m3u2b.OUTPUT_ROOT = self._output_root
+        shutil.rmtree(self.tmp)
+
+    def test_loaded_through_the_web_interface_outside_enigma2(self):
+        e2m3u2b.write_epgdat(e2m3u2b.RunContext(), os.path.join(self.tmp, 'epg.dat'))
+        self.assertEqual(len(self.commands), 1)
+        self.assertIn('http://127.0.0.1/web/loadepg', self.commands[0])
+
+    def test_not_loaded_when_written_under_the_output_root(self):
+        e2m3u2b.OUTPUT_ROOT = self.tmp
+        e2m3u2b.write_epgdat(e2m3u2b.RunContext(), os.path.join(self.tmp, 'epg.dat'))
+        self.assertEqual(self.commands, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
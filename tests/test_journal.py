@@ -0,0 +1,179 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+from standin import Response, StandinServer
+
+PLAYLIST = ('#EXTM3U\n'
+            '#EXTINF:-1 tvg-id="one.uk" group-title="UK",One\nhttp://panel/user/pass/1.ts\n'
+            '#EXTINF:-1 tvg-id="two.uk" group-title="UK",Two\nhttp://panel/user/pass/2.ts\n')
+OUTPUT_GLOBALS = ('ENIGMAPATH', 'EPGIMPORTPATH', 'CFGPATH', 'PICONSPATH', 'OUTPUT_ROOT')
+
+
+def get_dead_pid():
+    process = subprocess.Popen(['true'])
+    process.wait()
+    return process.pid
+
+
+class RunJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.journal_file = os.path.join(self.tmp, 'test-run.journal')
+        self.owned_file = os.path.join(self.tmp, 'owned')
+        with open(self.owned_file, 'w') as f:
+            f.write('parsed')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def interrupted_run(self, key='key', **owner):
+        """Leave the journal of a run that got as far as the parse
+        """
+        journal = e2m3u2b.RunJournal(self.journal_file, key)
+        journal.checkpoint('parse', self.owned_file, owned=True)
+        if owner:
+            with open(self.journal_file, 'r') as f:
+                data = json.load(f)
+            data['owner'].update(owner)
+            with open(self.journal_file, 'w') as f:
+                json.dump(data, f)
+
+    def test_killed_run_carried_on(self):
+        self.interrupted_run(pid=get_dead_pid())
+        journal = e2m3u2b.RunJournal(self.journal_file, 'key')
+        self.assertTrue(journal.resumed)
+        self.assertTrue(journal.is_done('parse'))
+        self.assertEqual(journal.get_file('parse'), self.owned_file)
+
+    def test_run_before_a_reboot_carried_on(self):
+        # the pid may have been reused since
+        self.interrupted_run(pid=os.getppid(), boot_id='other boot')
+        self.assertTrue(e2m3u2b.RunJournal(self.journal_file, 'key').resumed)
+
+    def test_journal_of_a_run_still_going_not_used(self):
+        self.interrupted_run(pid=os.getppid())
+        journal = e2m3u2b.RunJournal(self.journal_file, 'key')
+        self.assertFalse(journal.resumed)
+        self.assertFalse(journal.is_done('parse'))
+        # the files are still the other runs
+        self.assertTrue(os.path.isfile(self.owned_file))
+
+    def test_other_settings_start_again(self):
+        self.interrupted_run(pid=get_dead_pid())
+        journal = e2m3u2b.RunJournal(self.journal_file, 'other key')
+        self.assertFalse(journal.resumed)
+        self.assertFalse(os.path.isfile(self.owned_file))
+
+    def test_old_journal_not_used(self):
+        self.interrupted_run(pid=get_dead_pid())
+        with open(self.journal_file, 'r') as f:
+            data = json.load(f)
+        data['started'] = time.time() - e2m3u2b.RUN_JOURNAL_MAX_AGE - 1
+        with open(self.journal_file, 'w') as f:
+            json.dump(data, f)
+        self.assertFalse(e2m3u2b.RunJournal(self.journal_file, 'key').resumed)
+
+    def test_changed_checkpoint_file_not_used(self):
+        self.interrupted_run(pid=get_dead_pid())
+        with open(self.owned_file, 'a') as f:
+            f.write(' and changed')
+        journal = e2m3u2b.RunJournal(self.journal_file, 'key')
+        self.assertTrue(journal.resumed)
+        self.assertIsNone(journal.get_file('parse'))
+
+    def test_complete_removes_journal_and_owned_files(self):
+        journal = e2m3u2b.RunJournal(self.journal_file, 'key')
+        journal.checkpoint('parse', self.owned_file, owned=True)
+        journal.complete()
+        self.assertFalse(os.path.exists(self.journal_file))
+        self.assertFalse(os.path.exists(self.owned_file))
+        # late checkpoints of background work are ignored
+        journal.checkpoint('picons')
+        self.assertFalse(os.path.exists(self.journal_file))
+
+
+class InterruptedRunTest(unittest.TestCase):
+    """Provider runs carrying on (or not) from the journal and parse cache of the last run
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = StandinServer()
+        self.server.add('/get.php', Response(PLAYLIST))
+        self._globals = dict((name, getattr(e2m3u2b, name)) for name in OUTPUT_GLOBALS)
+        self._tempdir = tempfile.tempdir
+        tempfile.tempdir = self.tmp
+        e2m3u2b.set_output_root(os.path.join(self.tmp, 'output'))
+
+    def tearDown(self):
+        self.server.close()
+        for name, value in self._globals.iteritems():
+            setattr(e2m3u2b, name, value)
+        tempfile.tempdir = self._tempdir
+        shutil.rmtree(self.tmp)
+
+    def make_provider(self):
+        config = e2m3u2b.ProviderConfig()
+        config.name = 'Test'
+        config.m3u_url = self.server.url('/get.php')
+        return e2m3u2b.Provider(config)
+
+    def journal_file(self):
+        return os.path.join(e2m3u2b.CFGPATH, 'test-run.journal')
+
+    def bouquet_file(self):
+        return os.path.join(e2m3u2b.ENIGMAPATH, 'userbouquet.suls_iptv_test_uk.tv')
+
+    def run_failing(self, error):
+        """Run a provider that stops with error after the parse
+        """
+        provider = self.make_provider()
+
+        def fail():
+            raise error
+        provider._process_parsed_channels = fail
+        self.assertRaises(type(error), provider.process_provider)
+
+    def test_run_completes(self):
+        self.make_provider().process_provider()
+        self.assertTrue(os.path.isfile(self.bouquet_file()))
+        self.assertFalse(os.path.exists(self.journal_file()))
+        self.assertEqual(self.server.hits('/get.php'), 1)
+
+    def test_killed_run_carried_on_from_the_parse(self):
+        self.run_failing(KeyboardInterrupt())
+        self.assertTrue(os.path.isfile(self.journal_file()))
+        self.assertFalse(os.path.exists(self.bouquet_file()))
+        self.make_provider().process_provider()
+        # no download and the channels from the parse of the killed run
+        self.assertEqual(self.server.hits('/get.php'), 1)
+        with open(self.bouquet_file(), 'r') as f:
+            self.assertIn('#DESCRIPTION Two', f.read())
+        self.assertFalse(os.path.exists(self.journal_file()))
+
+    def test_failed_run_not_carried_on(self):
+        self.run_failing(ValueError('bad override'))
+        self.assertFalse(os.path.exists(self.journal_file()))
+        self.make_provider().process_provider()
+        self.assertEqual(self.server.hits('/get.php'), 2)
+        self.assertTrue(os.path.isfile(self.bouquet_file()))
+
+    def test_failed_run_discards_the_other_providers_journals(self):
+        run_context = e2m3u2b.RunContext()
+        config = self.make_provider().config
+        e2m3u2b.Provider(config, run_context).process_provider()
+        # the run fails before its output is committed
+        self.assertTrue(os.path.isfile(self.journal_file()))
+        run_context.discard_journals()
+        self.assertFalse(os.path.exists(self.journal_file()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+from standin import Response, StandinServer
+
+PLAYLISTS = {'One': '#EXTM3U\n#EXTINF:-1 tvg-id="one.uk" group-title="UK",One\nhttp://one/user/pass/1.ts\n',
+             'Two': '#EXTM3U\n#EXTINF:-1 tvg-id="two.fr" group-title="FR",Two\nhttp://two/user/pass/2.ts\n'}
+FOREIGN_LINE = '#SERVICE 1:7:1:0:0:0:0:0:0:0:FROM BOUQUET "userbouquet.favourites.tv" ORDER BY bouquet\n'
+OLD_BOUQUET_LINE = '#SERVICE 1:7:1:0:0:0:0:0:0:0:FROM BOUQUET "userbouquet.suls_iptv_one_old.tv" ORDER BY bouquet\n'
+OUTPUT_GLOBALS = ('ENIGMAPATH', 'EPGIMPORTPATH', 'CFGPATH', 'PICONSPATH', 'OUTPUT_ROOT')
+
+
+class OutputTransactionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.output = e2m3u2b.OutputTransaction()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, filename, data):
+        with open(filename, 'w') as f:
+            f.write(data)
+
+    def read(self, filename):
+        with open(filename, 'r') as f:
+            return f.read()
+
+    def test_files_only_in_place_after_commit(self):
+        live = os.path.join(self.tmp, 'live')
+        new = os.path.join(self.tmp, 'new')
+        self.write(live, 'old')
+        self.write(self.output.path(live), 'changed')
+        self.write(self.output.path(new), 'new')
+        self.assertEqual(self.read(live), 'old')
+        self.assertFalse(os.path.exists(new))
+        committed = []
+        self.output.on_commit(lambda: committed.append(self.read(live)))
+        self.output.commit()
+        self.assertEqual(self.read(live), 'changed')
+        self.assertEqual(self.read(new), 'new')
+        self.assertEqual(committed, ['changed'])
+        # and the staging folder is gone
+        self.assertEqual(sorted(os.listdir(self.tmp)), ['live', 'new'])
+
+    def test_removals_only_at_commit(self):
+        old = os.path.join(self.tmp, 'old')
+        rewritten = os.path.join(self.tmp, 'rewritten')
+        self.write(old, 'old')
+        self.write(rewritten, 'old')
+        self.output.remove(old)
+        self.output.remove(rewritten)
+        self.write(self.output.path(rewritten), 'new')
+        self.assertTrue(os.path.isfile(old))
+        self.output.commit()
+        self.assertFalse(os.path.exists(old))
+        # written again this run
+        self.assertEqual(self.read(rewritten), 'new')
+
+    def test_rollback_leaves_live_files(self):
+        live = os.path.join(self.tmp, 'live')
+        self.write(live, 'old')
+        self.write(self.output.path(live), 'changed')
+        self.output.remove(live)
+        self.output.rollback()
+        self.output.commit()
+        self.assertEqual(self.read(live), 'old')
+        self.assertEqual(os.listdir(self.tmp), ['live'])
+
+
+class TwoProviderCommitTest(unittest.TestCase):
+    """Providers processed in one run are staged and put in place together
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = StandinServer()
+        for name, playlist in PLAYLISTS.items():
+            self.server.add('/{}.m3u'.format(name), Response(playlist))
+        self._globals = dict((name, getattr(e2m3u2b, name)) for name in OUTPUT_GLOBALS)
+        self._tempdir = tempfile.tempdir
+        tempfile.tempdir = self.tmp
+        e2m3u2b.set_output_root(os.path.join(self.tmp, 'output'))
+        self.bouquets_tv = os.path.join(e2m3u2b.ENIGMAPATH, 'bouquets.tv')
+        self.old_bouquet = os.path.join(e2m3u2b.ENIGMAPATH, 'userbouquet.suls_iptv_one_old.tv')
+        with open(self.bouquets_tv, 'w') as f:
+            f.write('#NAME Bouquets (TV)\n' + FOREIGN_LINE + OLD_BOUQUET_LINE)
+        with open(self.old_bouquet, 'w') as f:
+            f.write('#NAME One - Old\n')
+        self.run_context = e2m3u2b.RunContext()
+        self.bouquets_tv_writes = 0
+        path = self.run_context.output.path
+
+        def counting_path(final_path):
+            if final_path == self.bouquets_tv:
+                self.bouquets_tv_writes += 1
+            return path(final_path)
+        self.run_context.output.path = counting_path
+
+    def tearDown(self):
+        self.server.close()
+        for name, value in self._globals.iteritems():
+            setattr(e2m3u2b, name, value)
+        tempfile.tempdir = self._tempdir
+        shutil.rmtree(self.tmp)
+
+    def process(self):
+        for name in sorted(PLAYLISTS):
+            config = e2m3u2b.ProviderConfig()
+            config.name = name
+            config.m3u_url = self.server.url('/{}.m3u'.format(name))
+            e2m3u2b.Provider(config, self.run_context).process_provider()
+
+    def read_bouquets_tv(self):
+        with open(self.bouquets_tv, 'r') as f:
+            return f.readlines()
+
+    def test_live_files_untouched_until_commit(self):
+        self.process()
+        self.assertEqual(self.read_bouquets_tv(), ['#NAME Bouquets (TV)\n', FOREIGN_LINE, OLD_BOUQUET_LINE])
+        self.assertTrue(os.path.isfile(self.old_bouquet))
+        self.assertFalse(os.path.exists(os.path.join(e2m3u2b.ENIGMAPATH, 'userbouquet.suls_iptv_one_uk.tv')))
+        self.assertEqual(self.bouquets_tv_writes, 0)
+
+    def test_commit_merges_both_providers_into_bouquets_tv(self):
+        self.process()
+        self.run_context.output.commit()
+        self.assertEqual(self.bouquets_tv_writes, 1)
+        lines = self.read_bouquets_tv()
+        self.assertEqual(lines[:2], ['#NAME Bouquets (TV)\n', FOREIGN_LINE])
+        self.assertEqual(len(lines), 4)
+        self.assertIn('"userbouquet.suls_iptv_one_uk.tv"', lines[2])
+        self.assertIn('"userbouquet.suls_iptv_two_fr.tv"', lines[3])
+        for line in lines[2:]:
+            bouquet = line.split('"')[1]
+            self.assertTrue(os.path.isfile(os.path.join(e2m3u2b.ENIGMAPATH, bouquet)))
+        # the providers old bouquet is removed with its entry
+        self.assertFalse(os.path.exists(self.old_bouquet))
+        self.assertFalse(os.path.exists(os.path.join(e2m3u2b.ENIGMAPATH, e2m3u2b.OUTPUT_STAGING_DIR)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+
+OVERRIDE = ('<mapping><categories>'
+            '<category name="UK" nameOverride="British" enabled="true" />'
+            '<category name="FR" enabled="false" />'
+            '</categories><channels>'
+            '<channel name="One" category="UK" tvg-id="one.uk" />'
+            '</channels></mapping>')
+
+
+class OverrideCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.mapping_file = os.path.join(self.tmp, 'test-sort-override.xml')
+        self.cache_file = os.path.join(self.tmp, 'test-sort-override.cache')
+        self.write_override(OVERRIDE)
+        self._parse_override_file = e2m3u2b._parse_override_file
+        self.parses = 0
+
+        def counting_parse(mapping_file):
+            self.parses += 1
+            return self._parse_override_file(mapping_file)
+        e2m3u2b._parse_override_file = counting_parse
+
+    def tearDown(self):
+        e2m3u2b._parse_override_file = self._parse_override_file
+        shutil.rmtree(self.tmp)
+
+    def write_override(self, data, mtime=1500000000):
+        with open(self.mapping_file, 'w') as f:
+            f.write(data)
+        os.utime(self.mapping_file, (mtime, mtime))
+
+    def load(self):
+        return e2m3u2b.load_override_model(self.mapping_file, self.cache_file)
+
+    def test_cached_model_reused(self):
+        model = self.load()
+        self.assertEqual(model.category_order, [u'UK', u'FR'])
+        cached = self.load()
+        self.assertEqual(self.parses, 1)
+        self.assertEqual(cached.__dict__, model.__dict__)
+        self.assertEqual(cached.channels_by_key[('UK', 'One')]['tvg-id'], 'one.uk')
+
+    def test_edited_override_file_invalidates_the_cache(self):
+        self.load()
+        self.write_override(OVERRIDE.replace('"British"', '"Great Britain"'))
+        model = self.load()
+        self.assertEqual(self.parses, 2)
+        self.assertEqual(model.category_options[u'UK']['nameOverride'], u'Great Britain')
+
+    def test_edit_of_the_same_size_and_mtime_invalidates_the_cache(self):
+        self.load()
+        # e.g. saved again within the same second
+        self.write_override(OVERRIDE.replace('"true"', '"fals"'))
+        model = self.load()
+        self.assertEqual(self.parses, 2)
+        self.assertFalse(model.category_options[u'UK']['enabled'])
+        # and the new model is cached
+        self.load()
+        self.assertEqual(self.parses, 2)
+
+    def test_corrupt_cache_rebuilt(self):
+        self.load()
+        for data in ('not a pickle', pickle.dumps(['no', 'key']), open(self.cache_file, 'rb').read()[:20]):
+            with open(self.cache_file, 'wb') as f:
+                f.write(data)
+            parses = self.parses
+            model = self.load()
+            self.assertEqual(self.parses, parses + 1)
+            self.assertEqual(model.category_order, [u'UK', u'FR'])
+            with open(self.cache_file, 'rb') as f:
+                self.assertEqual(pickle.load(f)['model'], model.__dict__)
+
+    def test_old_cache_version_rebuilt(self):
+        self.load()
+        with open(self.cache_file, 'rb') as f:
+            cached = pickle.load(f)
+        cached['key'] = (e2m3u2b.OVERRIDE_CACHE_VERSION - 1,) + cached['key'][1:]
+        with open(self.cache_file, 'wb') as f:
+            pickle.dump(cached, f)
+        self.load()
+        self.assertEqual(self.parses, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+import codecs
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+
+GROUPS = [u'Cin\xe9ma {}', u'UK Sport {}', u'S\xe9ries {}', u'VOD Acci\xf3n {}']
+
+
+def playlist_text(entries):
+    lines = [u'#EXTM3U']
+    for i in xrange(entries):
+        group = GROUPS[i % len(GROUPS)].format(i % 3)
+        ext = u'mp4' if group.startswith(u'VOD') else u'ts'
+        lines.append(u'#EXTINF:-1 tvg-id="ch{0}.fr" tvg-name="Cha\xeene {0}" tvg-logo="http://logo/{0}.png" '
+                     u'group-title="{1}",Cha\xeene {0} \xe9t\xe9'.format(i, group))
+        lines.append(u'http://panel:8080/user/pass/{}.{}'.format(i, ext))
+    return u'\n'.join(lines) + u'\n'
+
+
+def tokenize(text):
+    return list(e2m3u2b.M3uTokenizer().services(io.StringIO(text, newline=None)))
+
+
+class ExtinfTest(unittest.TestCase):
+    def test_attributes_and_name(self):
+        attributes, name = e2m3u2b.parse_extinf(
+            u'#EXTINF:-1 tvg-id="one.uk" tvg-name="One" tvg-logo="http://logo/one.png" group-title="UK",One HD')
+        self.assertEqual(attributes, {'tvg-id': u'one.uk', 'tvg-name': u'One', 'tvg-logo': u'http://logo/one.png',
+                                      'group-title': u'UK'})
+        self.assertEqual(name, u'One HD')
+
+    def test_no_space_between_attributes(self):
+        attributes, name = e2m3u2b.parse_extinf(u'#EXTINF:-1 tvg-id="h"group-title="UK",NoSpace')
+        self.assertEqual(attributes, {'tvg-id': u'h', 'group-title': u'UK'})
+        self.assertEqual(name, u'NoSpace')
+
+    def test_quotes_and_commas_inside_values(self):
+        attributes, name = e2m3u2b.parse_extinf(
+            u'#EXTINF:-1 tvg-name="The "Best" One, HD" tvg-logo="http://logo/a,b.png" group-title="Films, "New"",Best')
+        self.assertEqual(attributes, {'tvg-name': u'The "Best" One, HD', 'tvg-logo': u'http://logo/a,b.png',
+                                      'group-title': u'Films, "New"'})
+        self.assertEqual(name, u'Best')
+
+    def test_upper_case_attribute_names(self):
+        attributes, name = e2m3u2b.parse_extinf(u'#EXTINF:-1 TVG-ID="one.uk" Group-Title="UK",One')
+        self.assertEqual(attributes, {'tvg-id': u'one.uk', 'group-title': u'UK'})
+
+    def test_name_with_quote_and_comma(self):
+        attributes, name = e2m3u2b.parse_extinf(u'#EXTINF:-1 tvg-id="one.uk" group-title="UK",One", the "best", HD')
+        self.assertEqual(attributes['group-title'], u'UK')
+        self.assertEqual(name, u'One", the "best", HD')
+
+    def test_no_attributes(self):
+        self.assertEqual(e2m3u2b.parse_extinf(u'#EXTINF:-1,One'), ({}, None))
+        self.assertEqual(e2m3u2b.parse_extinf(u'#EXTINF:-1'), ({}, None))
+
+
+class M3uTokenizerTest(unittest.TestCase):
+    def test_services(self):
+        services = tokenize(u'#EXTM3U\n'
+                            u'#EXTINF:-1 tvg-id="one.uk" group-title="UK",One\n'
+                            u'http://panel/user/pass/1.ts\n'
+                            u'#EXTINF:-1 tvg-id="two.uk" group-title="UK",Two\n'
+                            u'rtmp://panel/live/2\n')
+        self.assertEqual([(x['tvg-id'], x['group-title'], x['stream-name'], x['stream-url']) for x in services],
+                         [(u'one.uk', u'UK', u'One', 'http://panel/user/pass/1.ts'),
+                          (u'two.uk', u'UK', u'Two', 'rtmp://panel/live/2')])
+        self.assertIs(type(services[0]['stream-url']), str)
+
+    def test_empty_group(self):
+        services = tokenize(u'#EXTINF:-1 tvg-id="one.uk" group-title="",One\nhttp://panel/1.ts\n')
+        self.assertEqual(services[0]['group-title'], u'None')
+
+    def test_crlf_line_endings(self):
+        services = tokenize(u'#EXTM3U\r\n#EXTINF:-1 tvg-id="one.uk" group-title="UK",One\r\nhttp://panel/1.ts\r\n')
+        self.assertEqual([(x['group-title'], x['stream-name'], x['stream-url']) for x in services],
+                         [(u'UK', u'One', 'http://panel/1.ts')])
+
+    def test_options_between_extinf_and_url(self):
+        services = tokenize(u'#EXTINF:-1 tvg-id="one.uk" group-title="UK",One\n'
+                            u'#EXTVLCOPT:http-user-agent=Mozilla/5.0\n'
+                            u'#EXTVLCOPT:http-referrer=http://panel/\n'
+                            u'http://panel/1.ts\n')
+        self.assertEqual([(x['stream-name'], x['stream-url']) for x in services], [(u'One', 'http://panel/1.ts')])
+
+    def test_entries_without_extended_info_or_url_skipped(self):
+        tokenizer = e2m3u2b.M3uTokenizer()
+        services = list(tokenizer.services([u'#EXTINF:-1,Plain\n', u'http://panel/1.ts\n',
+                                            u'#EXTINF:-1 group-title="UK",No url\n',
+                                            u'#EXTINF:-1 group-title="UK",Two\n', u'http://panel/2.ts\n']))
+        self.assertTrue(tokenizer.valid_services_found)
+        self.assertEqual([x['stream-name'] for x in services], [u'Two'])
+
+
+class ParallelParseTest(unittest.TestCase):
+    """The worker process parse has to give the same channels as the single process parse
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._cfg_path = e2m3u2b.CFGPATH
+        e2m3u2b.CFGPATH = self.tmp + '/'
+        self._min_size = e2m3u2b.PARALLEL_PARSE_MIN_SIZE
+        e2m3u2b.PARALLEL_PARSE_MIN_SIZE = 0
+
+    def tearDown(self):
+        e2m3u2b.CFGPATH = self._cfg_path
+        e2m3u2b.PARALLEL_PARSE_MIN_SIZE = self._min_size
+        shutil.rmtree(self.tmp)
+
+    def parse(self, data, workers):
+        m3u_file = os.path.join(self.tmp, 'test.m3u')
+        # parse_m3u removes the file once it's parsed
+        with open(m3u_file, 'wb') as f:
+            f.write(data)
+        config = e2m3u2b.ProviderConfig()
+        config.name = 'Test'
+        run_context = e2m3u2b.RunContext()
+        run_context.parse_workers = workers
+        provider = e2m3u2b.Provider(config, run_context)
+        provider._m3u_file = m3u_file
+        provider.parse_m3u()
+        return provider._dictchannels
+
+    def assertSameChannels(self, data):
+        single = self.parse(data, 1)
+        parallel = self.parse(data, 3)
+        self.assertEqual(parallel.keys(), single.keys())
+        self.assertEqual(parallel, single)
+        return single
+
+    def test_cp1252_playlist(self):
+        channels = self.assertSameChannels(playlist_text(2000).encode('cp1252'))
+        self.assertIn(u'Cin\xe9ma 2', channels)
+        self.assertEqual(len(channels), 12)
+
+    def test_utf8_playlist(self):
+        channels = self.assertSameChannels(playlist_text(2000).encode('utf-8'))
+        self.assertEqual(len(channels), 12)
+
+    def test_utf8_playlist_with_byte_order_mark(self):
+        channels = self.assertSameChannels(codecs.BOM_UTF8 + playlist_text(2000).encode('utf-8'))
+        self.assertEqual(channels.keys()[0], u'Cin\xe9ma 0')
+
+
+DUPLICATED_STREAMS = (u'#EXTM3U\n'
+                      u'#EXTINF:-1 tvg-id="one.uk" tvg-logo="http://logo/one.png" group-title="UK",One\n'
+                      u'http://panel/user/pass/1.ts\n'
+                      u'#EXTINF:-1 tvg-id="two.uk" group-title="UK",Two\n'
+                      u'http://panel/user/pass/2.ts\n'
+                      u'#EXTINF:-1 tvg-id="one.uk" tvg-logo="http://logo/one.png" group-title="HD",One\n'
+                      u'http://panel/user/pass/1.ts\n'
+                      u'#EXTINF:-1 tvg-id="one.uk" group-title="Favourites",One HD\n'
+                      u'http://panel/user/pass/1.ts\n'
+                      u'#EXTINF:-1 tvg-id="two.uk" group-title="HD",Two\n'
+                      u'http://panel/user/pass/2.ts\n')
+OUTPUT_GLOBALS = ('ENIGMAPATH', 'EPGIMPORTPATH', 'CFGPATH', 'PICONSPATH', 'OUTPUT_ROOT')
+
+
+class DuplicatedStreamsTest(unittest.TestCase):
+    """Copies of a stream listed in several categories share their strings without changing the output
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._globals = dict((name, getattr(e2m3u2b, name)) for name in OUTPUT_GLOBALS)
+        self._shared_fields = e2m3u2b.SHARED_SERVICE_FIELDS
+
+    def tearDown(self):
+        for name, value in self._globals.iteritems():
+            setattr(e2m3u2b, name, value)
+        e2m3u2b.SHARED_SERVICE_FIELDS = self._shared_fields
+        shutil.rmtree(self.tmp)
+
+    def run_provider(self, output_root):
+        """Return the generated bouquets and EPG-Importer files of a run
+        """
+        e2m3u2b.set_output_root(os.path.join(self.tmp, output_root))
+        m3u_file = os.path.join(self.tmp, 'test.m3u')
+        with open(m3u_file, 'wb') as f:
+            f.write(DUPLICATED_STREAMS.encode('utf-8'))
+        config = e2m3u2b.ProviderConfig()
+        config.name = 'Test'
+        provider = e2m3u2b.Provider(config)
+        provider._prepare_config()
+        provider._m3u_file = m3u_file
+        provider.parse_m3u()
+        self.assertEqual(provider._streams, {})
+        provider._process_parsed_channels()
+        provider._run.output.commit()
+        files = {}
+        for path in (e2m3u2b.ENIGMAPATH, e2m3u2b.EPGIMPORTPATH):
+            for fname in os.listdir(path):
+                if fname.startswith(('userbouquet.', 'suls_iptv_')):
+                    with open(os.path.join(path, fname), 'rb') as f:
+                        files[fname] = f.read()
+        return files
+
+    def test_same_output_as_unshared_copies(self):
+        shared = self.run_provider('shared')
+        e2m3u2b.SHARED_SERVICE_FIELDS = ()
+        unshared = self.run_provider('unshared')
+        self.assertIn('suls_iptv_test_channels.xml', shared)
+        self.assertIn('userbouquet.suls_iptv_test_hd.tv', shared)
+        self.assertEqual(sorted(shared), sorted(unshared))
+        for fname in shared:
+            self.assertEqual(shared[fname], unshared[fname], fname)
+
+
+if __name__ == '__main__':
+    unittest.main()
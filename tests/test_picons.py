@@ -0,0 +1,123 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+
+
+class PiconCleanUpTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.icon_path = os.path.join(self.tmp, 'picons')
+        os.makedirs(self.icon_path)
+        self._cfg_path = e2m3u2b.CFGPATH
+        e2m3u2b.CFGPATH = self.tmp + '/'
+        self.run_context = e2m3u2b.RunContext()
+
+    def tearDown(self):
+        e2m3u2b.CFGPATH = self._cfg_path
+        shutil.rmtree(self.tmp)
+
+    def add_file(self, fname, size=100, age=0):
+        filepath = os.path.join(self.icon_path, fname)
+        with open(filepath, 'wb') as f:
+            f.write('x' * size)
+        mtime = time.time() - age
+        os.utime(filepath, (mtime, mtime))
+
+    def files(self):
+        return sorted(os.listdir(self.icon_path))
+
+    def collect(self, claims, created=()):
+        self.run_context.new_picons = {self.icon_path: set(created)}
+        self.run_context.picon_claims = {self.icon_path: claims}
+        self.run_context.collect_picons()
+
+    def test_files_not_created_by_the_script_are_left_alone(self):
+        for fname in ('user.png', 'user', 'user.part', 'user.None'):
+            self.add_file(fname, age=30 * 86400)
+        self.collect({'Provider': set()})
+        self.assertEqual(self.files(), ['user', 'user.None', 'user.part', 'user.png'])
+
+    def test_partial_downloads_and_stale_markers_removed(self):
+        for fname in ('one', 'two.part', 'three.None'):
+            self.add_file(fname)
+        self.add_file('four.None', age=e2m3u2b.PICON_MARKER_MAX_AGE + 60)
+        self.collect({'Provider': {'one', 'two', 'three', 'four'}}, ['one', 'two', 'three', 'four'])
+        self.assertEqual(self.files(), ['three.None'])
+
+    def test_orphans_removed(self):
+        self.add_file('one.png')
+        self.add_file('two.png')
+        self.collect({'Provider': {'one', 'two'}}, ['one', 'two'])
+        self.collect({'Provider': {'one'}})
+        self.assertEqual(self.files(), ['one.png'])
+
+    def test_other_providers_claims_kept(self):
+        self.add_file('one.png')
+        self.collect({'First': {'one'}, 'Second': {'one'}}, ['one'])
+        self.collect({'Second': set()})
+        self.assertEqual(self.files(), ['one.png'])
+
+    def test_budget_removes_least_recently_wanted(self):
+        for piconname in ('one', 'two', 'three'):
+            self.add_file(piconname + '.png')
+        self.collect({'Old': {'one'}, 'Older': {'two'}, 'Current': {'three'}}, ['one', 'two', 'three'])
+        index = e2m3u2b.PiconIndex(os.path.join(self.tmp, e2m3u2b.PICON_INDEX_FILE))
+        index._index[self.icon_path]['two']['Older'] -= 1000
+        index.save()
+        self.run_context.picon_budget = 250
+        self.collect({'Current': {'three'}})
+        self.assertEqual(self.files(), ['one.png', 'three.png'])
+
+    def test_budget_never_removes_picons_in_use(self):
+        for piconname in ('one', 'two', 'three'):
+            self.add_file(piconname + '.png')
+        self.run_context.picon_budget = 150
+        self.collect({'Provider': {'one', 'two', 'three'}}, ['one', 'two', 'three'])
+        self.assertEqual(self.files(), ['one.png', 'three.png', 'two.png'])
+
+
+class PiconClaimsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._cfg_path = e2m3u2b.CFGPATH
+        e2m3u2b.CFGPATH = self.tmp + '/'
+
+    def tearDown(self):
+        e2m3u2b.CFGPATH = self._cfg_path
+        shutil.rmtree(self.tmp)
+
+    def test_disabled_channels_keep_their_picons(self):
+        config = e2m3u2b.ProviderConfig()
+        config.name = 'Provider'
+        config.icon_path = os.path.join(self.tmp, 'picons')
+        run_context = e2m3u2b.RunContext()
+        run_context.background_picons = False
+        provider = e2m3u2b.Provider(config, run_context)
+        downloaded = []
+        provider._download_picon_file = lambda x: downloaded.append(x['stream-name'])
+
+        def channel(name, enabled=True):
+            x = e2m3u2b.new_service_dict({'tvg-logo': 'http://logo/{}.png'.format(name)}, name)
+            x['enabled'] = enabled
+            return x
+
+        provider._dictchannels = e2m3u2b.OrderedDict([
+            (u'UK', [channel(u'One'), channel(u'Dead', enabled=False)]),
+            (u'Off', [channel(u'Hidden')]),
+            (u'VOD - Films', [channel(u'Film')])])
+        provider._category_order = provider._dictchannels.keys()
+        provider._category_options = {u'UK': {}, u'Off': {'enabled': False}, u'VOD - Films': {'type': 'vod'}}
+        provider.download_picons()
+        self.assertEqual(downloaded, [u'One'])
+        self.assertEqual(run_context.picon_claims, {os.path.normpath(config.icon_path):
+                                                    {'Provider': {'one', 'dead', 'hidden'}}})
+
+
+if __name__ == '__main__':
+    unittest.main()
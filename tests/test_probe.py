@@ -0,0 +1,128 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+from standin import Response, StandinServer
+
+# slack allowed on top of the expected time of a check
+SLACK = 1.0
+
+
+class StreamProberTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmp, 'probe.cache')
+        self.server = StandinServer()
+        self._fail_ttl = e2m3u2b.PROBE_FAIL_TTL
+        self.start = time.time()
+
+    def tearDown(self):
+        self.server.close()
+        e2m3u2b.PROBE_FAIL_TTL = self._fail_ttl
+        shutil.rmtree(self.tmp)
+
+    def add_streams(self, server, count, response):
+        urls = []
+        for i in xrange(count):
+            server.add('/live/user/pass/{}.ts'.format(i), response)
+            urls.append(server.url('/live/user/pass/{}.ts'.format(i)))
+        return urls
+
+    def assertTookAtMost(self, seconds):
+        elapsed = time.time() - self.start
+        self.assertLessEqual(elapsed, seconds + SLACK, 'took {:.2f}s, expected at most {}s'.format(elapsed, seconds))
+
+    def test_one_connection_per_host_by_default(self):
+        urls = self.add_streams(self.server, 8, Response(latency=0.1))
+        prober = e2m3u2b.StreamProber(self.cache_file)
+        self.assertEqual(prober.probe(urls), 8)
+        self.assertEqual(self.server.peak_connections, 1)
+        self.assertFalse(any(prober.is_dead(url) for url in urls))
+
+    def test_host_connections_setting(self):
+        urls = self.add_streams(self.server, 8, Response(latency=0.2))
+        prober = e2m3u2b.StreamProber(self.cache_file, host_connections=2)
+        prober.probe(urls)
+        self.assertEqual(self.server.peak_connections, 2)
+        # 4 rounds of 2 checks
+        self.assertTookAtMost(0.8)
+
+    def test_hosts_checked_in_parallel(self):
+        other_server = StandinServer()
+        try:
+            urls = self.add_streams(self.server, 4, Response(latency=0.3))
+            urls += self.add_streams(other_server, 4, Response(latency=0.3))
+            prober = e2m3u2b.StreamProber(self.cache_file)
+            self.assertEqual(prober.probe(urls), 8)
+            self.assertEqual(self.server.peak_connections, 1)
+            self.assertEqual(other_server.peak_connections, 1)
+            self.assertTookAtMost(1.2)
+        finally:
+            other_server.close()
+
+    def test_dead_after_failing_repeatedly(self):
+        e2m3u2b.PROBE_FAIL_TTL = 0
+        urls = self.add_streams(self.server, 1, Response(status=404))
+        prober = e2m3u2b.StreamProber(self.cache_file)
+        for i in xrange(e2m3u2b.PROBE_FAIL_THRESHOLD):
+            self.assertFalse(prober.is_dead(urls[0]))
+            prober.probe(urls)
+        self.assertTrue(prober.is_dead(urls[0]))
+
+    def test_connection_limit_and_socket_errors_are_inconclusive(self):
+        e2m3u2b.PROBE_FAIL_TTL = 0
+        urls = []
+        for status in (403, 429, 458):
+            self.server.add('/{}.ts'.format(status), Response(status=status))
+            urls.append(self.server.url('/{}.ts'.format(status)))
+        self.server.add('/reset.ts', Response(resets=1000))
+        self.server.add('/slow.ts', Response(latency=2))
+        urls += [self.server.url('/reset.ts'), self.server.url('/slow.ts')]
+        prober = e2m3u2b.StreamProber(self.cache_file, timeout=0.5)
+        for i in xrange(e2m3u2b.PROBE_FAIL_THRESHOLD + 1):
+            self.assertEqual(prober.probe(urls), len(urls))
+        self.assertFalse(any(prober.is_dead(url) for url in urls))
+        prober.save(urls)
+        # nothing recorded so they are checked again next run
+        self.assertEqual(e2m3u2b.StreamProber(self.cache_file).probe(urls[:3]), 3)
+
+    def test_head_rejected_falls_back_to_range_get(self):
+        urls = self.add_streams(self.server, 1, Response(head_status=405))
+        prober = e2m3u2b.StreamProber(self.cache_file)
+        prober.probe(urls)
+        self.assertEqual(prober._results[urls[0]][1], True)
+        methods = [(method, headers.get('range')) for method, path, query, headers in self.server.requests]
+        self.assertEqual(methods, [('HEAD', None), ('GET', 'bytes=0-1023')])
+
+    def test_redirect_followed(self):
+        self.server.add('/dead.ts', Response(status=404))
+        self.server.add('/moved.ts', Response(status=302, headers={'Location': self.server.url('/dead.ts')}))
+        e2m3u2b.PROBE_FAIL_TTL = 0
+        prober = e2m3u2b.StreamProber(self.cache_file)
+        for i in xrange(e2m3u2b.PROBE_FAIL_THRESHOLD):
+            prober.probe([self.server.url('/moved.ts')])
+        self.assertTrue(prober.is_dead(self.server.url('/moved.ts')))
+
+    def test_cached_results_not_checked_again(self):
+        urls = self.add_streams(self.server, 3, Response())
+        prober = e2m3u2b.StreamProber(self.cache_file)
+        prober.probe(urls)
+        prober.save(urls)
+        self.assertEqual(e2m3u2b.StreamProber(self.cache_file).probe(urls), 0)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_deadline_stops_new_checks(self):
+        urls = self.add_streams(self.server, 20, Response(latency=0.2))
+        prober = e2m3u2b.StreamProber(self.cache_file)
+        checked = prober.probe(urls, time.time() + 0.5)
+        self.assertLess(checked, 20)
+        self.assertTookAtMost(0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+
+PLAYLIST = (u'#EXTM3U\n'
+            u'#EXTINF:-1 tvg-id="one.uk" group-title="UK",BBC One\nhttp://panel/user/pass/1.ts\n'
+            u'#EXTINF:-1 tvg-id="two.uk" group-title="UK",BBC Two Adult\nhttp://panel/user/pass/2.ts\n'
+            u'#EXTINF:-1 tvg-id="tf1.fr" group-title="Cin\xe9ma",T\xe9l\xe9 Premi\xe8re\nhttp://panel/user/pass/3.ts\n'
+            u'#EXTINF:-1 tvg-id="" group-title="Films",Film\nhttp://panel/movie/user/pass/4.mp4\n'
+            u'#EXTINF:-1 tvg-id="de.de" group-title="DE",Das Erste\nhttp://panel/user/pass/5.ts\n')
+
+
+def allows(rules, group=u'UK', name=u'BBC One', tvg_id=u'one.uk', category_type='live'):
+    channel_rules = e2m3u2b.ChannelRules(rules)
+    attributes = {'group-title': group, 'tvg-id': tvg_id}
+    return channel_rules.allows_info(attributes, name) and channel_rules.allows_category_type(category_type)
+
+
+class ChannelRulesTest(unittest.TestCase):
+    def test_no_rules(self):
+        self.assertFalse(e2m3u2b.ChannelRules([]))
+        self.assertTrue(allows([]))
+
+    def test_exclude_wins_over_include(self):
+        rules = [('include', 'group', u'^UK$'), ('exclude', 'name', u'Adult')]
+        self.assertTrue(allows(rules))
+        self.assertFalse(allows(rules, name=u'BBC Two Adult'))
+        self.assertFalse(allows(rules, group=u'FR'))
+        # also when include and exclude are for the same field
+        rules = [('exclude', 'group', u'UK'), ('include', 'group', u'UK')]
+        self.assertFalse(allows(rules))
+
+    def test_includes_of_a_field_any_match(self):
+        rules = [('include', 'group', u'^UK$'), ('include', 'group', u'^FR$')]
+        self.assertTrue(allows(rules))
+        self.assertTrue(allows(rules, group=u'FR'))
+        self.assertFalse(allows(rules, group=u'DE'))
+
+    def test_includes_of_each_field_have_to_match(self):
+        rules = [('include', 'group', u'^UK$'), ('include', 'name', u'^BBC')]
+        self.assertTrue(allows(rules))
+        self.assertFalse(allows(rules, name=u'ITV'))
+        self.assertFalse(allows(rules, group=u'FR'))
+
+    def test_group_field(self):
+        self.assertFalse(allows([('exclude', 'group', u'UK')]))
+        self.assertTrue(allows([('exclude', 'group', u'UK')], group=u'FR'))
+        # a blank group is matched as the None group it is put in
+        self.assertFalse(allows([('exclude', 'group', u'^None$')], group=u''))
+        self.assertFalse(allows([('include', 'group', u'^UK$')], group=None))
+
+    def test_name_field(self):
+        self.assertFalse(allows([('exclude', 'name', u'One')]))
+        self.assertTrue(allows([('include', 'name', u'One')]))
+        self.assertFalse(allows([('include', 'name', u'One')], name=u'BBC Two'))
+        # the name may not be known yet
+        channel_rules = e2m3u2b.ChannelRules([('include', 'name', u'One')])
+        self.assertTrue(channel_rules.allows_info({'stream-name': u'BBC One'}, None))
+
+    def test_tvg_id_field(self):
+        self.assertFalse(allows([('exclude', 'tvg-id', u'\\.uk$')]))
+        self.assertTrue(allows([('exclude', 'tvg-id', u'\\.uk$')], tvg_id=u'tf1.fr'))
+        self.assertFalse(allows([('include', 'tvg-id', u'.')], tvg_id=u''))
+
+    def test_type_field(self):
+        rules = [('exclude', 'type', u'^vod$')]
+        self.assertTrue(allows(rules))
+        self.assertFalse(allows(rules, category_type='vod'))
+        channel_rules = e2m3u2b.ChannelRules([('include', 'type', u'live')])
+        self.assertTrue(channel_rules.allows_type({'category_type': 'live'}))
+        self.assertFalse(channel_rules.allows_type({'category_type': 'vod'}))
+        # the type isn't known from the #EXTINF details
+        self.assertTrue(channel_rules.allows_info({'group-title': u'UK'}, u'BBC One'))
+
+    def test_unknown_and_invalid_rules_ignored(self):
+        rules = [('drop', 'group', u'UK'), ('exclude', 'country', u'UK'), ('exclude', 'name', u'BBC (')]
+        channel_rules = e2m3u2b.ChannelRules(rules)
+        self.assertFalse(channel_rules)
+        self.assertTrue(allows(rules))
+
+    def test_non_ascii_patterns(self):
+        rules = [('include', 'group', u'^Cin\xe9ma$'), ('exclude', 'name', u'T\xe9l\xe9')]
+        self.assertTrue(allows(rules, group=u'Cin\xe9ma', name=u'Film'))
+        self.assertFalse(allows(rules, group=u'Cin\xe9ma', name=u'T\xe9l\xe9 Premi\xe8re'))
+        self.assertFalse(allows(rules, group=u'Cinema', name=u'Film'))
+        # patterns are unicode aware
+        self.assertTrue(allows([('include', 'name', u'^\\w+ Premi\xe8re$')], name=u'T\xe9l\xe9 Premi\xe8re'))
+
+
+class ConfigRulesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._cfg_path = e2m3u2b.CFGPATH
+        e2m3u2b.CFGPATH = self.tmp + '/'
+
+    def tearDown(self):
+        e2m3u2b.CFGPATH = self._cfg_path
+        shutil.rmtree(self.tmp)
+
+    def test_rules_round_trip(self):
+        rules = [('include', 'group', u'^Cin\xe9ma|UK$'), ('exclude', 'name', u'T\xe9l\xe9 <"&>'),
+                 ('exclude', 'type', u'vod')]
+        config = e2m3u2b.Config()
+        provider = e2m3u2b.ProviderConfig()
+        provider.name = 'Test'
+        provider.rules = rules
+        config.providers[provider.name] = provider
+        config.write_config()
+
+        read = e2m3u2b.Config()
+        read.read_config(os.path.join(self.tmp, 'config.xml'))
+        self.assertEqual(read.providers['Test'].rules, rules)
+        # the written file is still a complete config
+        self.assertEqual(os.listdir(self.tmp), ['config.xml'])
+
+    def test_rules_without_field_are_group_rules(self):
+        config_file = os.path.join(self.tmp, 'config.xml')
+        with open(config_file, 'w') as f:
+            f.write('<config><supplier><name>Test</name>'
+                    '<rules><exclude pattern="UK" /><other field="name" pattern="BBC" /></rules>'
+                    '</supplier></config>')
+        config = e2m3u2b.Config()
+        config.read_config(config_file)
+        self.assertEqual(config.providers['Test'].rules, [('exclude', 'group', 'UK')])
+
+
+class ProviderRulesTest(unittest.TestCase):
+    """Rules and disabled override categories applied while the playlist is parsed
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._cfg_path = e2m3u2b.CFGPATH
+        e2m3u2b.CFGPATH = self.tmp + '/'
+        self._min_size = e2m3u2b.PARALLEL_PARSE_MIN_SIZE
+        e2m3u2b.PARALLEL_PARSE_MIN_SIZE = 0
+
+    def tearDown(self):
+        e2m3u2b.CFGPATH = self._cfg_path
+        e2m3u2b.PARALLEL_PARSE_MIN_SIZE = self._min_size
+        shutil.rmtree(self.tmp)
+
+    def parse(self, rules, workers=1):
+        m3u_file = os.path.join(self.tmp, 'test.m3u')
+        with open(m3u_file, 'wb') as f:
+            f.write(PLAYLIST.encode('utf-8'))
+        config = e2m3u2b.ProviderConfig()
+        config.name = 'Test'
+        config.rules = rules
+        run_context = e2m3u2b.RunContext()
+        run_context.parse_workers = workers
+        provider = e2m3u2b.Provider(config, run_context)
+        provider._m3u_file = m3u_file
+        provider.parse_m3u()
+        return dict((cat, [x['stream-name'] for x in channels])
+                    for cat, channels in provider._dictchannels.iteritems())
+
+    def test_rules_applied(self):
+        rules = [('exclude', 'name', u'Adult'), ('exclude', 'group', u'^DE$'), ('exclude', 'type', u'vod')]
+        expected = {u'UK': [u'BBC One'], u'Cin\xe9ma': [u'T\xe9l\xe9 Premi\xe8re']}
+        self.assertEqual(self.parse(rules), expected)
+        self.assertEqual(self.parse(rules, workers=3), expected)
+
+    def test_non_ascii_rules_applied(self):
+        rules = [('include', 'group', u'^Cin\xe9ma$'), ('include', 'type', u'live')]
+        expected = {u'Cin\xe9ma': [u'T\xe9l\xe9 Premi\xe8re']}
+        self.assertEqual(self.parse(rules), expected)
+        self.assertEqual(self.parse(rules, workers=3), expected)
+
+    def test_disabled_override_categories_pruned(self):
+        with open(os.path.join(self.tmp, 'test-sort-override.xml'), 'w') as f:
+            f.write('<mapping><categories>'
+                    '<category name="UK" enabled="false" />'
+                    '<category name="Cin&#233;ma" enabled="false" />'
+                    '</categories><channels>'
+                    '<channel name="BBC One" category="UK" categoryOverride="Favourites" />'
+                    '</channels></mapping>')
+        channels = self.parse([])
+        # the disabled categories are kept (empty) for the override file
+        self.assertEqual(channels[u'UK'], [u'BBC One'])
+        self.assertEqual(channels[u'Cin\xe9ma'], [])
+        self.assertEqual(channels[u'DE'], [u'Das Erste'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+
+
+def channel(url, name, tvg_id=u''):
+    return e2m3u2b.new_service_dict({'tvg-id': tvg_id, 'stream-url': url}, name)
+
+
+class StreamKeyTest(unittest.TestCase):
+    def test_key_survives_credential_and_host_changes(self):
+        old = e2m3u2b.get_stream_key('http://panel:8080/live/user/pass/123.ts', {'user', 'pass'})
+        new = e2m3u2b.get_stream_key('https://other.host/live/newuser/p%40ss/123.ts', {'newuser', 'p@ss', 'p%40ss'})
+        self.assertEqual(old, u'live/123.ts')
+        self.assertEqual(new, old)
+
+    def test_key_keeps_path_of_same_named_streams(self):
+        keys = e2m3u2b.get_stream_keys([channel('http://cdn/one/index.m3u8', u'One'),
+                                         channel('http://cdn/two/index.m3u8', u'Two')])
+        self.assertEqual(keys, [u'one/index.m3u8', u'two/index.m3u8'])
+
+    def test_key_of_non_ascii_unicode_url(self):
+        key = e2m3u2b.get_stream_key(u'http://cdn/cha\xeene/1.ts')
+        self.assertEqual(key, u'cha\xeene/1.ts')
+        self.assertIs(type(key), unicode)
+
+    def test_streams_not_told_apart_by_path_keep_their_keys(self):
+        channels = [channel('http://cdn/live/index.m3u8?token=a', u'One', u'one.uk'),
+                    channel('http://cdn/live/index.m3u8?token=b', u'Two', u'two.uk'),
+                    channel('http://cdn/live/index.m3u8?token=c', u'Three', u'three.uk')]
+        keys = e2m3u2b.get_stream_keys(channels)
+        self.assertEqual(len(set(keys)), 3)
+        # dropping a channel doesn't change the others keys
+        self.assertEqual(e2m3u2b.get_stream_keys(channels[1:]), keys[1:])
+
+    def test_same_stream_listed_twice(self):
+        channels = [channel('http://panel/u/p/1.ts', u'One'), channel('http://panel/u/p/2.ts', u'Two'),
+                    channel('http://panel/u/p/1.ts', u'One')]
+        keys = e2m3u2b.get_stream_keys(channels, {'u', 'p'})
+        self.assertEqual(keys, [u'\tOne', u'2.ts', u'\tOne#2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
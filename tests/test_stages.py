@@ -0,0 +1,125 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+from standin import Response, StandinServer
+
+PLAYLIST = ('#EXTM3U\n'
+            '#EXTINF:-1 tvg-id="one.uk" group-title="UK",One\nhttp://panel/user/pass/1.ts\n'
+            '#EXTINF:-1 tvg-id="two.uk" group-title="UK",Two\nhttp://panel/user/pass/2.ts\n')
+PANEL_BOUQUET = '#NAME Panel\n#SERVICE 4097:0:1:1A2B:3C:4D:5E:0:0:0:http%3a//panel/user/pass/1.ts\n'
+OUTPUT_GLOBALS = ('ENIGMAPATH', 'EPGIMPORTPATH', 'CFGPATH', 'PICONSPATH', 'OUTPUT_ROOT')
+
+
+class ParseStagesTest(unittest.TestCase):
+    def test_parse_stages(self):
+        self.assertEqual(e2m3u2b.parse_stages('picons, bouquets'), {'picons', 'bouquets'})
+        self.assertEqual(e2m3u2b.parse_stages('epg'), {'epg'})
+
+    def test_unknown_stage(self):
+        self.assertRaises(ValueError, e2m3u2b.parse_stages, 'bouquets,download')
+        self.assertRaises(ValueError, e2m3u2b.parse_stages, '')
+
+    def test_stage_selected(self):
+        run_context = e2m3u2b.RunContext()
+        self.assertTrue(run_context.stage_selected('bouquets'))
+        run_context.stages = {'picons'}
+        self.assertFalse(run_context.stage_selected('bouquets'))
+        self.assertFalse(run_context.stage_selected('bouquets', 'epg'))
+        self.assertTrue(run_context.stage_selected('bouquets', 'picons'))
+
+
+class SelectedStagesRunTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = StandinServer()
+        self.server.add('/get.php', Response(PLAYLIST))
+        self.server.add('/panel.php', Response(PANEL_BOUQUET))
+        self._globals = dict((name, getattr(e2m3u2b, name)) for name in OUTPUT_GLOBALS)
+        self._tempdir = tempfile.tempdir
+        tempfile.tempdir = self.tmp
+        e2m3u2b.set_output_root(os.path.join(self.tmp, 'output'))
+
+    def tearDown(self):
+        self.server.close()
+        for name, value in self._globals.iteritems():
+            setattr(e2m3u2b, name, value)
+        tempfile.tempdir = self._tempdir
+        shutil.rmtree(self.tmp)
+
+    def run_provider(self, stages=None, rules=()):
+        config = e2m3u2b.ProviderConfig()
+        config.name = 'Test'
+        config.m3u_url = self.server.url('/get.php?username=user&password=pass&type=m3u_plus')
+        config.username = 'user'
+        config.password = 'pass'
+        config.bouquet_download = True
+        config.bouquet_url = self.server.url('/panel.php')
+        config.rules = list(rules)
+        run_context = e2m3u2b.RunContext()
+        run_context.stages = stages
+        e2m3u2b.Provider(config, run_context).process_provider()
+        run_context.output.commit()
+
+    def bouquet_file(self):
+        return os.path.join(e2m3u2b.ENIGMAPATH, 'userbouquet.suls_iptv_test_uk.tv')
+
+    def epg_sources_file(self):
+        return os.path.join(e2m3u2b.EPGIMPORTPATH, 'suls_iptv_test.sources.xml')
+
+    def stored_streams(self):
+        store = e2m3u2b.ServiceRefStore(os.path.join(e2m3u2b.CFGPATH, e2m3u2b.SERVICE_REF_DB_FILE), 'Test')
+        return sorted(stream for category, stream in store._refs)
+
+    def test_selected_stages_use_the_parsed_channels(self):
+        self.run_provider()
+        os.remove(self.bouquet_file())
+        os.remove(self.epg_sources_file())
+        self.run_provider({'bouquets'})
+        self.assertEqual(self.server.hits('/get.php'), 1)
+        self.assertTrue(os.path.isfile(self.bouquet_file()))
+        # the epg stage wasn't selected
+        self.assertFalse(os.path.exists(self.epg_sources_file()))
+
+    def test_channel_index_rebuilt_without_the_mapxml_stage(self):
+        self.run_provider()
+        index_file = os.path.join(e2m3u2b.CFGPATH, 'test-channels.index')
+        os.remove(index_file)
+        self.run_provider({'bouquets'}, rules=[('exclude', 'name', u'Two')])
+        index = e2m3u2b.ChannelIndex.load(index_file)
+        self.assertEqual([index.get(i)['stream-name'] for i in xrange(len(index))], [u'One'])
+
+    def test_stages_without_saved_channels_fetch_the_panel_bouquet(self):
+        self.run_provider({'picons'})
+        self.assertEqual(self.server.hits('/get.php'), 1)
+        self.assertEqual(self.server.hits('/panel.php'), 1)
+        # no ref allocated for the stream the panel has a service ref for
+        self.assertEqual(self.stored_streams(), [u'2.ts'])
+        self.assertFalse(os.path.exists(self.bouquet_file()))
+        # and the channels saved for the next runs have the panel bouquet
+        self.run_provider({'bouquets'})
+        self.assertEqual(self.server.hits('/get.php'), 1)
+        with open(self.bouquet_file(), 'r') as f:
+            self.assertIn('#SERVICE 1:0:1:1A2B:3C:4D:5E:0:0:0:http%3A//panel/user/pass/1.ts:\n', f.readlines())
+
+    def test_edited_override_file_invalidates_the_parsed_channels(self):
+        self.run_provider()
+        with open(os.path.join(e2m3u2b.CFGPATH, 'test-sort-override.xml'), 'w') as f:
+            f.write('<mapping><categories><category name="UK" nameOverride="British" /></categories></mapping>')
+        self.run_provider({'bouquets'})
+        self.assertEqual(self.server.hits('/get.php'), 2)
+
+    def test_changed_rules_invalidate_the_parsed_channels(self):
+        self.run_provider()
+        self.run_provider({'bouquets'}, rules=[('exclude', 'name', u'Two')])
+        self.assertEqual(self.server.hits('/get.php'), 2)
+        with open(self.bouquet_file(), 'r') as f:
+            self.assertNotIn('#DESCRIPTION Two', f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import e2m3u2bouquet as e2m3u2b
+from standin import Response, StandinServer
+
+LIVE_CATEGORIES = [{'category_id': '1', 'category_name': 'UK Sport'},
+                   {'category_id': '2', 'category_name': u'F\xfatbol'}]
+LIVE_STREAMS = [{'stream_id': 11, 'name': 'Sport 1', 'category_id': '1', 'epg_channel_id': 'sport1.uk',
+                 'stream_icon': 'http://logo/sport1.png'},
+                {'stream_id': 12, 'name': 'Liga', 'category_id': 2, 'epg_channel_id': None, 'stream_icon': ''}]
+VOD_CATEGORIES = [{'category_id': '5', 'category_name': 'Action'}]
+VOD_STREAMS = [{'stream_id': 51, 'name': 'Film', 'category_id': '5', 'container_extension': 'mkv'},
+               {'stream_id': 52, 'name': 'TS Film', 'category_id': '5', 'container_extension': 'ts'}]
+
+
+class XtreamApiTest(unittest.TestCase):
+    def setUp(self):
+        self.cfg_path = tempfile.mkdtemp()
+        self._cfg_path = e2m3u2b.CFGPATH
+        e2m3u2b.CFGPATH = self.cfg_path + '/'
+        self.auth = '1'
+        self.server = StandinServer()
+        self.server.add('/player_api.php', self.player_api)
+
+    def tearDown(self):
+        self.server.close()
+        e2m3u2b.CFGPATH = self._cfg_path
+        shutil.rmtree(self.cfg_path)
+
+    def player_api(self, query):
+        if query.get('username') != 'user' or query.get('password') != 'p&ss':
+            return Response(json.dumps({'user_info': {'auth': 0}}))
+        replies = {None: {'user_info': {'auth': self.auth}},
+                   'get_live_categories': LIVE_CATEGORIES, 'get_live_streams': LIVE_STREAMS,
+                   'get_vod_categories': VOD_CATEGORIES, 'get_vod_streams': VOD_STREAMS}
+        return Response(json.dumps(replies[query.get('action')]), content_type='application/json')
+
+    def make_provider(self):
+        config = e2m3u2b.ProviderConfig()
+        config.name = 'Xtream'
+        config.m3u_url = self.server.url('/get.php?username=user&password=p%26ss&type=m3u_plus&output=ts')
+        config.xtream_api = True
+        return e2m3u2b.Provider(config, e2m3u2b.RunContext())
+
+    def actions(self):
+        return [query.get('action') for method, path, query, headers in self.server.requests]
+
+    def test_loads_categories_and_streams(self):
+        provider = self.make_provider()
+        self.assertTrue(provider.load_xtream_api())
+        channels = provider._dictchannels
+        self.assertEqual(channels.keys(), [u'UK Sport', u'F\xfatbol', u'VOD - Action'])
+
+        sport = channels[u'UK Sport'][0]
+        self.assertEqual(sport['stream-url'], self.server.url('/user/p&ss/11'))
+        self.assertEqual(sport['tvg-id'], 'sport1.uk')
+        self.assertEqual(sport['tvg-logo'], 'http://logo/sport1.png')
+        self.assertEqual(sport['category_type'], 'live')
+        self.assertEqual(channels[u'F\xfatbol'][0]['tvg-id'], u'')
+
+        films = channels[u'VOD - Action']
+        self.assertEqual([x['stream-url'] for x in films],
+                         [self.server.url('/movie/user/p&ss/51.mkv'), self.server.url('/movie/user/p&ss/52.ts')])
+        # the type comes from the endpoint, a .ts movie isn't taken for a live stream
+        self.assertEqual([x['category_type'] for x in films], ['vod', 'vod'])
+        self.assertEqual([x['stream-type'] for x in films], ['4097', '4097'])
+        self.assertFalse(any('api_category_type' in x for cat in channels.values() for x in cat))
+
+    def test_skips_vod_endpoints_when_vod_disabled(self):
+        with open(os.path.join(self.cfg_path, 'xtream-sort-override.xml'), 'w') as f:
+            f.write('<mapping><categories><category name="VOD" enabled="false" /></categories></mapping>')
+        provider = self.make_provider()
+        self.assertTrue(provider.load_xtream_api())
+        self.assertEqual(provider._dictchannels.keys(), [u'UK Sport', u'F\xfatbol'])
+        self.assertEqual(sorted(filter(None, self.actions())), ['get_live_categories', 'get_live_streams'])
+
+    def test_skips_vod_endpoints_excluded_by_rules(self):
+        provider = self.make_provider()
+        provider.config.rules = [('exclude', 'type', 'vod')]
+        self.assertTrue(provider.load_xtream_api())
+        self.assertEqual(provider._dictchannels.keys(), [u'UK Sport', u'F\xfatbol'])
+        self.assertNotIn('get_vod_streams', self.actions())
+
+    def test_login_failure_falls_back_to_m3u(self):
+        self.auth = '0'
+        provider = self.make_provider()
+        self.assertFalse(provider.load_xtream_api())
+        self.assertFalse(provider._dictchannels)
+
+    def test_server_error_falls_back_to_m3u(self):
+        self.server.add('/player_api.php', Response('down', status=500))
+        provider = self.make_provider()
+        self.assertFalse(provider.load_xtream_api())
+
+
+if __name__ == '__main__':
+    unittest.main()